@@ -0,0 +1,339 @@
+#!/usr/bin/python
+"""
+Lexer and parser benchmarks.
+
+strings: lexer benchmark on pathological inputs, used to check that the lexing time
+grows linearly with the input size. Every case is generated at a base size and at
+two and four times that size, and lexed several times, keeping the best time. The
+growth of a case is the time per character at the largest size divided by the time
+per character at the base size: about 1 for a linear lexer and about 4 for a
+quadratic one. The script exits with status 1 if the growth of any case is above the
+limit (--max-growth).
+
+The base size should be larger than the lexer chunk size (PvLexer.chunk_size), so
+that the lines of every size are lexed in chunks. Otherwise the strings that fit in
+a chunk and the ones that don't are compared, and the growth means nothing.
+
+throughput: lexer and parser throughput on a synthetic corpus, optionally on several
+interpreters (e.g. python2.7, python3.12 and pypy3). The corpus is generated once, so
+every interpreter reads the same file, and each interpreter runs this script on it.
+
+    python pvbench.py strings
+    python pvbench.py strings --size 200000 --patterns
+    python pvbench.py throughput -p python2.7 -p python3 -p pypy3
+"""
+import os
+import sys
+import json
+import random
+import tempfile
+import subprocess
+from argparse import ArgumentParser, SUPPRESS
+
+from pvlexer import PvLexer, TOKEN_EOF
+from pvparser import PvParser, timer
+from pvmetrics import PvMetrics
+
+# Name and generator of each case. The generators return about size characters.
+CASES = [
+    ('many_quotes', lambda size: 'string a[' + str(size // 5) + '] = {' + ', '.join(['"x"'] * (size // 5)) + '};\n'),
+    ('adjacent_quotes', lambda size: '"' * size + '\n'),
+    ('long_string', lambda size: 'string a = "' + 'x' * size + '";\n'),
+    ('unterminated_string', lambda size: 'string a = "' + 'x' * size + '\n'),
+    ('escaped_quotes', lambda size: 'string a = "' + '\\"' * (size // 2) + '";\n'),
+    ('unterminated_escapes', lambda size: 'string a = "' + '\\"' * (size // 2) + '\n'),
+    ('backslashes', lambda size: 'string a = "' + '\\' * size + '\n'),
+    ('string_lines', lambda size: 'string s = "a \\"b\\" c"; # "d\n' * (size // 30)),
+]
+
+# Input sizes, as multiples of the base size
+SCALES = [1, 2, 4]
+
+# Every case is lexed at least REPEAT times and for at least MIN_TIME seconds,
+# and the best time is kept
+REPEAT = 3
+MIN_TIME = 0.2
+
+# Seed of the synthetic corpus
+CORPUS_SEED = 1
+
+
+def lex_file(file_name, identifier_first=True):
+    """
+    Lex a file
+    :param file_name: file name
+    :type file_name: str
+    :param identifier_first: lexer mode (see PvLexer)
+    :type identifier_first: bool
+    :return: number of tokens and time in seconds
+    :rtype: tuple
+    """
+    lex = PvLexer(identifier_first)
+    tokens = 0
+    with open(file_name, 'r') as f:
+        start = timer()
+        while not lex.next_token(f).match(TOKEN_EOF):
+            tokens += 1
+        seconds = timer() - start
+    return tokens, seconds
+
+
+def run_case(generator, size, identifier_first=True):
+    """
+    Generate a case and lex it
+    :return: number of characters, number of tokens and best time in seconds
+    :rtype: tuple
+    """
+    text = generator(size)
+    fd, file_name = tempfile.mkstemp(suffix='.pv')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+        result_list = []
+        while len(result_list) < REPEAT or sum([seconds for tokens, seconds in result_list]) < MIN_TIME:
+            result_list.append(lex_file(file_name, identifier_first))
+    finally:
+        os.remove(file_name)
+    return len(text), result_list[0][0], min([seconds for tokens, seconds in result_list])
+
+
+def write_corpus(file_name, statements, seed=CORPUS_SEED):
+    """
+    Write a synthetic pvload file with a mix of the statements found in real files.
+    Only random() is used, so every interpreter writes the same file for a seed.
+    :param file_name: file name
+    :type file_name: str
+    :param statements: number of statements
+    :type statements: int
+    :param seed: random seed
+    :type seed: int
+    :return: None
+    """
+    rng = random.Random(seed)
+    with open(file_name, 'w') as f:
+        f.write('# synthetic corpus, seed ' + str(seed) + '\n')
+        i = 0
+        while i < statements:
+            name = '$(top)dev%d:sig%d' % (i % 97, i)
+            r = rng.random()
+            if r < 0.35:
+                f.write('double %s.VAL = %.6g ;   # saved\n' % (name, (rng.random() - 0.5) * 2000))
+            elif r < 0.55:
+                f.write('long %s.VAL = %d;\n' % (name, int(rng.random() * 100000)))
+            elif r < 0.65:
+                f.write('string %s.DESC = "device %d \\"%s\\"";\n' % (name, i % 97, 'abc'[i % 3]))
+            elif r < 0.75:
+                f.write('double %s.VAL = %.4g * 3 mm;\n' % (name, rng.random() * 100))
+            elif r < 0.85:
+                count = 2 + int(rng.random() * 14)
+                values = ', '.join(['%.5g' % rng.random() for j in range(count)])
+                f.write('double %s.VAL[%d] = { %s };\n' % (name, count, values))
+            elif r < 0.9:
+                count = 2 + int(rng.random() * 6)
+                values = ', '.join(['[%d] %d' % (j, int(rng.random() * 1000)) for j in range(count)])
+                f.write('%%long %s.VAL[%d] = {%s};\n' % (name, count, values))
+            elif r < 0.97:
+                f.write('group {\n')
+                for j in range(1 + int(rng.random() * 5)):
+                    f.write('    short %s_%d.VAL = %d;\n' % (name, j, int(rng.random() * 100)))
+                    i += 1
+                f.write('}\n')
+            else:
+                f.write('sleep %.2g;\n' % rng.random())
+            i += 1
+
+
+def _best_time(run):
+    """
+    Call a routine at least REPEAT times and for at least MIN_TIME seconds
+    :return: result of the first call and best time in seconds
+    :rtype: tuple
+    """
+    result_list = []
+    while len(result_list) < REPEAT or sum([seconds for result, seconds in result_list]) < MIN_TIME:
+        result_list.append(run())
+    return result_list[0][0], min([seconds for result, seconds in result_list])
+
+
+def measure_throughput(file_name):
+    """
+    Measure the lexer and parser throughput on a file
+    :param file_name: file name
+    :type file_name: str
+    :return: interpreter, bytes, tokens, statements, lex and parse times in seconds
+    :rtype: dict
+    """
+    def parse():
+        with open(os.devnull, 'w') as f_null:
+            pv_parser = PvParser(message_file=f_null)
+            metrics = PvMetrics()
+            pv_parser.add_handler(metrics)
+            start = timer()
+            pv_parser.pv_file(file_name)
+            seconds = timer() - start
+        return metrics.statements, seconds
+
+    tokens, lex_seconds = _best_time(lambda: lex_file(file_name))
+    statements, parse_seconds = _best_time(parse)
+    implementation = getattr(sys, 'implementation', None)
+    name = implementation.name if implementation is not None else 'cpython'
+    return {'interpreter': name + ' ' + sys.version.split()[0],
+            'bytes': os.path.getsize(file_name),
+            'tokens': tokens,
+            'statements': statements,
+            'lex_seconds': lex_seconds,
+            'parse_seconds': parse_seconds}
+
+
+def _print_throughput(result):
+    print('%-20s %12.0f %12.0f %10.2f %10.2f' % (result['interpreter'],
+                                                 result['tokens'] / result['lex_seconds'],
+                                                 result['tokens'] / result['parse_seconds'],
+                                                 result['bytes'] / result['lex_seconds'] / 1e6,
+                                                 result['bytes'] / result['parse_seconds'] / 1e6))
+
+
+def strings_command(args, parser):
+    case_map = dict(CASES)
+    for name in args.case_list:
+        if name not in case_map:
+            parser.error('unknown case ' + name)
+
+    print(sys.version.split()[0] + (' patterns' if args.patterns else ' identifier-first'))
+    print('%-22s %10s %10s %10s %12s' % ('case', 'chars', 'tokens', 'seconds', 'chars/s'))
+    failed = []
+    for name, generator in CASES:
+        if args.case_list and name not in args.case_list:
+            continue
+        per_char = []
+        for scale in SCALES:
+            chars, tokens, seconds = run_case(generator, args.size * scale, not args.patterns)
+            per_char.append(seconds / chars)
+            print('%-22s %10d %10d %10.4f %12.0f' % (name, chars, tokens, seconds, chars / seconds if seconds else 0))
+        growth = per_char[-1] / per_char[0] if per_char[0] else 0.0
+        print('%-22s growth %.2f' % (name, growth))
+        if growth > args.max_growth:
+            failed.append(name)
+    if failed:
+        print('super-linear: ' + ', '.join(failed))
+        return 1
+    return 0
+
+
+def throughput_command(args, parser):
+    if args.corpus:
+        file_name = args.corpus
+    else:
+        fd, file_name = tempfile.mkstemp(suffix='.pv')
+        os.close(fd)
+        write_corpus(file_name, args.statements)
+    try:
+        if args.json:
+            print(json.dumps(measure_throughput(file_name), sort_keys=True))
+            return 0
+        print(file_name + ': ' + str(os.path.getsize(file_name)) + ' bytes')
+        print('%-20s %12s %12s %10s %10s' % ('interpreter', 'lex tok/s', 'parse tok/s', 'lex MB/s', 'parse MB/s'))
+        status = 0
+        for interpreter in args.interpreter_list or [sys.executable]:
+            if interpreter == sys.executable:
+                _print_throughput(measure_throughput(file_name))
+                continue
+            try:
+                process = subprocess.Popen([interpreter, os.path.abspath(__file__), 'throughput', '--json',
+                                            '--corpus', file_name], stdout=subprocess.PIPE)
+                out = process.communicate()[0]
+            except OSError as e:
+                print('%-20s %s' % (interpreter, e))
+                status = 1
+                continue
+            if process.returncode != 0:
+                print('%-20s failed with status %d' % (interpreter, process.returncode))
+                status = 1
+                continue
+            _print_throughput(json.loads(out.decode('utf-8').strip().splitlines()[-1]))
+        return status
+    finally:
+        if not args.corpus:
+            os.remove(file_name)
+
+
+def main(argv):
+    parser = ArgumentParser(prog='pvbench.py',
+                            description='lexer and parser benchmarks')
+
+    subparsers = parser.add_subparsers(dest='action')
+
+    strings_parser = subparsers.add_parser('strings',
+                                           help='check that the lexer runs in linear time on pathological inputs')
+
+    strings_parser.add_argument('--size',
+                                action='store',
+                                type=int,
+                                dest='size',
+                                default=100000,
+                                help='base input size in characters, larger than the lexer chunk size '
+                                     '(default: %(default)s)')
+
+    strings_parser.add_argument('--max-growth',
+                                action='store',
+                                type=float,
+                                dest='max_growth',
+                                default=2.0,
+                                help='largest accepted growth of the time per character (default: %(default)s)')
+
+    strings_parser.add_argument('--patterns',
+                                action='store_true',
+                                dest='patterns',
+                                default=False,
+                                help='use the pattern table lexer mode instead of the identifier-first mode')
+
+    strings_parser.add_argument(action='store',
+                                nargs='*',
+                                dest='case_list',
+                                default=[],
+                                metavar='CASE',
+                                help='cases to run (default: all): ' + ', '.join([name for name, generator in CASES]))
+
+    throughput_parser = subparsers.add_parser('throughput',
+                                              help='lexer and parser throughput on a synthetic corpus')
+
+    throughput_parser.add_argument('-p', '--python',
+                                   action='append',
+                                   dest='interpreter_list',
+                                   default=[],
+                                   metavar='INTERPRETER',
+                                   help='interpreter to run the benchmark with, can be repeated '
+                                        '(default: the current one)')
+
+    throughput_parser.add_argument('--statements',
+                                   action='store',
+                                   type=int,
+                                   dest='statements',
+                                   default=20000,
+                                   help='number of statements in the corpus (default: %(default)s)')
+
+    throughput_parser.add_argument('--corpus',
+                                   action='store',
+                                   dest='corpus',
+                                   default=None,
+                                   metavar='FILE',
+                                   help='use an existing file instead of the synthetic corpus')
+
+    throughput_parser.add_argument('--json',
+                                   action='store_true',
+                                   dest='json',
+                                   default=False,
+                                   help=SUPPRESS)
+
+    args = parser.parse_args(argv)
+
+    if args.action == 'strings':
+        return strings_command(args, parser)
+    elif args.action == 'throughput':
+        return throughput_command(args, parser)
+    else:
+        parser.error('expected strings or throughput')
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
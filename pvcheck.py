@@ -2,13 +2,29 @@
 import sys
 from argparse import ArgumentParser, SUPPRESS
 from pvparser import PvParser
+from pvdb import PvDatabase
+from pvmacro import parse_macros
+from pvformat import format_single
+from pvsnapshot import PvSnapshotWriter, PvSnapshot
+from pvdiff import PvStatementStore, PvDiff, BUFFER_SIZE
+from pvestimate import PvEstimator, LATENCY, BANDWIDTH, DEFAULT_SLEEP
+from pvplan import PvPlanner
+from pvfmt import format_file
+from pvindex import PvIndex, PvDuplicateCheck, build_index
+from pvmetrics import PvMetrics, write_metrics_file
+from pvreport import WRITERS
+from pvgit import changed_files
+from pvschedule import check_files
+from pvshard import parse_shard, check_shard, read_results, merge_results
+from pvoverlay import PvOverlay, FORMATS
 
-if __name__ == '__main__':
+
+def check_command(argv):
     """
-    Entry point for the pvload file check program.
+    Check the syntax of a list of pvload files. This is the default command.
+    :param argv: command line arguments
+    :type argv: list
     """
-
-    # Command line arguments
     parser = ArgumentParser(epilog='')
 
     parser.add_argument(action='store',
@@ -22,16 +38,905 @@ if __name__ == '__main__':
                         dest='verbose',
                         default=False)
 
+    parser.add_argument('--values',
+                        action='store_true',
+                        dest='print_values',
+                        default=False,
+                        help='print the values of each pv, after applying scales and units')
+
+    parser.add_argument('--db',
+                        action='append',
+                        dest='db_list',
+                        default=[],
+                        metavar='PATH',
+                        help='check the pvs against the records in an EPICS database file or directory')
+
+    parser.add_argument('--db-cache',
+                        action='store',
+                        dest='db_cache',
+                        default='.pvcheck_db.cache',
+                        metavar='FILE',
+                        help='database index cache file (default: %(default)s, empty for no cache)')
+
+    parser.add_argument('-m', '--macros',
+                        action='store',
+                        dest='macros',
+                        default='',
+                        help='macro definitions used to expand pv names (e.g. top=tcs:,sadtop=sad:)')
+
+    parser.add_argument('--changed-since',
+                        action='store',
+                        dest='changed_since',
+                        default=None,
+                        metavar='REV',
+                        help='only check the pvload files changed since a git revision, '
+                             'limited to the files and directories given, if any')
+
+    parser.add_argument('--duplicates',
+                        action='store_true',
+                        dest='duplicates',
+                        default=False,
+                        help='warn about pvs that are set by more than one file, '
+                             'including the indexed files not being checked')
+
+    parser.add_argument('--index',
+                        action='store',
+                        dest='index',
+                        default='.pvcheck_index',
+                        metavar='FILE',
+                        help='index used by --duplicates, built with \'pvcheck.py index build\' '
+                             '(default: %(default)s, not required)')
+
+    parser.add_argument('-j', '--jobs',
+                        action='store',
+                        type=int,
+                        dest='jobs',
+                        default=1,
+                        metavar='N',
+                        help='number of worker processes, largest files first (default: %(default)s)')
+
+    parser.add_argument('--split-size',
+                        action='store',
+                        type=int,
+                        dest='split_size',
+                        default=0,
+                        metavar='BYTES',
+                        help='with --jobs, split the files larger than this into sections parsed '
+                             'by different workers (default: no split)')
+
+    parser.add_argument('--times-cache',
+                        action='store',
+                        dest='times_cache',
+                        default='.pvcheck_times.cache',
+                        metavar='FILE',
+                        help='parse times of the previous runs, used with --jobs '
+                             '(default: %(default)s, empty for no cache)')
+
+    parser.add_argument('--token-cache',
+                        action='store',
+                        type=int,
+                        dest='token_cache',
+                        default=0,
+                        metavar='BYTES',
+                        help='keep the tokens of the lines seen before, up to about this much memory, '
+                             'to lex the lines repeated across files only once (default: no cache)')
+
+    parser.add_argument('--shard',
+                        action='store',
+                        dest='shard',
+                        default=None,
+                        metavar='I/N',
+                        help='only check the files of shard I of N (e.g. 2/4), balanced by size, '
+                             'and save the results for \'pvcheck.py merge\'')
+
+    parser.add_argument('--shard-result',
+                        action='store',
+                        dest='shard_result',
+                        default=None,
+                        metavar='FILE',
+                        help='shard result file (default: pvcheck-shard-I-of-N.json)')
+
+    parser.add_argument('--format',
+                        action='store',
+                        dest='format',
+                        choices=sorted(WRITERS),
+                        default='text',
+                        help='format of the error and warning messages (default: %(default)s)')
+
+    parser.add_argument('-o', '--output',
+                        action='store',
+                        dest='output',
+                        default=None,
+                        metavar='FILE',
+                        help='write the error and warning messages to a file (default: standard output)')
+
+    parser.add_argument('--metrics',
+                        action='store',
+                        dest='metrics_json',
+                        default=None,
+                        metavar='FILE',
+                        help='write the run metrics (throughput, counts and phase times) as JSON')
+
+    parser.add_argument('--metrics-prom',
+                        action='store',
+                        dest='metrics_prom',
+                        default=None,
+                        metavar='FILE',
+                        help='write the run metrics in the Prometheus text format')
+
     parser.add_argument('-d', '--debug',
                         action='store_true',
                         dest='debug',
                         default=False,
                         help=SUPPRESS)
 
-    args = parser.parse_args(sys.argv[1:])
+    args = parser.parse_args(argv)
+
+    try:
+        macro_dict = parse_macros(args.macros)
+    except ValueError as e:
+        parser.error(str(e))
 
-    pv_parser = PvParser(args.debug, args.verbose)
-    # pv_parser.set_debug(args.debug)
+    if args.jobs < 1:
+        parser.error('the number of jobs must be at least 1')
+    if args.split_size < 0:
+        parser.error('the split size cannot be negative')
+    if args.token_cache < 0:
+        parser.error('the token cache size cannot be negative')
+    if args.jobs > 1 and (args.duplicates or args.metrics_json or args.metrics_prom):
+        parser.error('--duplicates and --metrics cannot be used with more than one job')
+    if args.shard is not None:
+        try:
+            shard, shards = parse_shard(args.shard)
+        except ValueError as e:
+            parser.error(str(e))
+        if args.jobs > 1:
+            parser.error('--shard cannot be used with more than one job')
+        if args.duplicates:
+            parser.error('with --shard, duplicates are found by \'pvcheck.py merge --duplicates\'')
+        if args.shard_result is None:
+            args.shard_result = 'pvcheck-shard-' + str(shard) + '-of-' + str(shards) + '.json'
 
+    try:
+        f_out = open(args.output, 'w') if args.output else sys.stdout
+    except (IOError, OSError) as e:
+        parser.error(str(e))
+    reporter = WRITERS[args.format](f_out)
+
+    file_list = args.file_list
+    if args.changed_since is not None:
+        try:
+            file_list = changed_files(args.changed_since, args.file_list)
+        except (OSError, ValueError) as e:
+            parser.error(str(e))
+        if args.verbose:
+            print(str(len(file_list)) + ' files changed since ' + args.changed_since)
+
+    metrics = PvMetrics() if args.metrics_json or args.metrics_prom else None
+    pv_parser = PvParser(args.debug, args.verbose, args.print_values, reporter=reporter)
+    pv_parser.lex.set_cache_size(args.token_cache)
+
+    if args.db_list:
+        database = PvDatabase(macro_dict)
+        try:
+            database.load(args.db_list, args.db_cache)
+        except (IOError, OSError) as e:
+            parser.error(str(e))
+        if args.verbose:
+            print(str(len(database)) + ' records, ' + str(database.parsed_files) + ' database files parsed')
+        pv_parser.add_handler(database)
+
+    index = None
+    if args.duplicates:
+        try:
+            index = PvIndex(args.index)
+        except (IOError, OSError):
+            pass
+        except ValueError as e:
+            parser.error(str(e))
+        duplicate_check = PvDuplicateCheck(index, file_list)
+        if args.verbose and index is not None:
+            print(str(len(index)) + ' indexed statements, ' + str(duplicate_check.stale_files) +
+                  ' indexed files changed since the index was built')
+        pv_parser.add_handler(duplicate_check)
+
+    if metrics is not None:
+        pv_parser.timing = True
+        pv_parser.add_handler(metrics)
+
+    if args.shard is not None:
+        try:
+            check_shard(pv_parser, file_list, shard, shards, reporter, args.shard_result)
+        except (IOError, OSError) as e:
+            parser.error(str(e))
+    elif args.jobs > 1:
+        check_files(file_list, args.jobs, reporter, pv_parser.handler_list, args.debug, args.verbose,
+                    args.print_values, args.split_size, args.times_cache, args.token_cache)
+    else:
+        for file_name in file_list:
+            pv_parser.pv_file(file_name)
+    if args.verbose and args.token_cache and args.jobs == 1:
+        stats = pv_parser.lex.cache_stats()
+        print('token cache: {0} hits, {1} misses ({2:.1%} hits), {3} lines, {4} bytes'.format(
+            stats['hits'], stats['misses'], stats['hit_rate'], stats['lines'], stats['bytes']))
+    reporter.close()
+    if f_out is not sys.stdout:
+        f_out.close()
+    if index is not None:
+        index.close()
+
+    if metrics is not None:
+        summary = metrics.summary(pv_parser)
+        try:
+            if args.metrics_json:
+                write_metrics_file(args.metrics_json, PvMetrics.write_json, summary)
+            if args.metrics_prom:
+                write_metrics_file(args.metrics_prom, PvMetrics.write_prometheus, summary)
+        except (IOError, OSError) as e:
+            parser.error(str(e))
+
+
+def export_command(argv):
+    """
+    Convert one or more pvload files into a binary snapshot.
+    :param argv: command line arguments
+    :type argv: list
+    """
+    parser = ArgumentParser(prog='pvcheck.py export',
+                            description='convert pvload files into a binary snapshot')
+
+    parser.add_argument(action='store',
+                        nargs='+',
+                        dest='file_list',
+                        help='list of input files')
+
+    parser.add_argument('-o', '--output',
+                        action='store',
+                        dest='output',
+                        required=True,
+                        help='snapshot file name')
+
+    args = parser.parse_args(argv)
+
+    writer = PvSnapshotWriter()
+    pv_parser = PvParser()
+    pv_parser.add_handler(writer)
     for file_name in args.file_list:
-        pv_parser.pv_file(file_name)
+        if not pv_parser.pv_file(file_name):
+            parser.error('cannot read ' + file_name)
+    try:
+        writer.write(args.output)
+    except (IOError, OSError) as e:
+        parser.error(str(e))
+
+
+def import_command(argv):
+    """
+    Convert a binary snapshot back into canonical pvload text.
+    :param argv: command line arguments
+    :type argv: list
+    """
+    parser = ArgumentParser(prog='pvcheck.py import',
+                            description='convert a binary snapshot into pvload text')
+
+    parser.add_argument(action='store',
+                        dest='snapshot',
+                        help='snapshot file name')
+
+    parser.add_argument('-o', '--output',
+                        action='store',
+                        dest='output',
+                        default=None,
+                        help='output file name (default: standard output)')
+
+    args = parser.parse_args(argv)
+
+    try:
+        snapshot = PvSnapshot(args.snapshot)
+        f_out = open(args.output, 'w') if args.output else sys.stdout
+    except (IOError, OSError, ValueError) as e:
+        parser.error(str(e))
+    for name, data_type, count, index_list, value_list in snapshot:
+        f_out.write(format_single(data_type, name, count, index_list, value_list) + '\n')
+    if f_out is not sys.stdout:
+        f_out.close()
+    snapshot.close()
+
+
+def diff_command(argv):
+    """
+    Compare two pvload files by pv name. The exit status is 1 if the files are different.
+    :param argv: command line arguments
+    :type argv: list
+    """
+    parser = ArgumentParser(prog='pvcheck.py diff',
+                            description='compare two pvload files by pv name')
+
+    parser.add_argument(action='store',
+                        dest='file_a',
+                        help='first (old) file')
+
+    parser.add_argument(action='store',
+                        dest='file_b',
+                        help='second (new) file')
+
+    parser.add_argument('-m', '--macros',
+                        action='store',
+                        dest='macros',
+                        default='',
+                        help='macro definitions used to expand pv names (e.g. top=tcs:,sadtop=sad:)')
+
+    parser.add_argument('--tolerance',
+                        action='store',
+                        type=float,
+                        dest='tolerance',
+                        default=0.0,
+                        help='absolute tolerance used to compare numbers (default: %(default)s)')
+
+    parser.add_argument('--max-elements',
+                        action='store',
+                        type=int,
+                        dest='max_elements',
+                        default=10,
+                        help='maximum number of array element differences shown per pv (default: %(default)s)')
+
+    parser.add_argument('--buffer-size',
+                        action='store',
+                        type=int,
+                        dest='buffer_size',
+                        default=BUFFER_SIZE,
+                        help='number of values kept in memory per file before using disk (default: %(default)s)')
+
+    args = parser.parse_args(argv)
+
+    try:
+        macro_dict = parse_macros(args.macros)
+    except ValueError as e:
+        parser.error(str(e))
+
+    store_list = []
+    for file_name in [args.file_a, args.file_b]:
+        store = PvStatementStore(macro_dict, args.buffer_size)
+        pv_parser = PvParser(message_file=sys.stderr)
+        pv_parser.add_handler(store)
+        if not pv_parser.pv_file(file_name):
+            parser.error('cannot read ' + file_name)
+        store_list.append(store)
+
+    pv_diff = PvDiff(sys.stdout, args.tolerance, args.max_elements)
+    different = pv_diff.compare(store_list[0], store_list[1])
+    for store in store_list:
+        store.close()
+    print(pv_diff.summary())
+    sys.exit(1 if different else 0)
+
+
+def estimate_command(argv):
+    """
+    Estimate the time pvload takes to execute a list of files.
+    :param argv: command line arguments
+    :type argv: list
+    """
+    parser = ArgumentParser(prog='pvcheck.py estimate',
+                            description='estimate the pvload execution time')
+
+    parser.add_argument(action='store',
+                        nargs='+',
+                        dest='file_list',
+                        help='list of input files')
+
+    parser.add_argument('--latency',
+                        action='store',
+                        type=float,
+                        dest='latency',
+                        default=LATENCY,
+                        help='put round trip latency in seconds (default: %(default)s)')
+
+    parser.add_argument('--bandwidth',
+                        action='store',
+                        type=float,
+                        dest='bandwidth',
+                        default=BANDWIDTH,
+                        help='bandwidth in bytes per second (default: %(default)s)')
+
+    parser.add_argument('--default-sleep',
+                        action='store',
+                        type=float,
+                        dest='default_sleep',
+                        default=DEFAULT_SLEEP,
+                        help='time used for sleep statements with no time (default: %(default)s)')
+
+    parser.add_argument('--no-groups',
+                        action='store_false',
+                        dest='show_groups',
+                        default=True,
+                        help='do not show the breakdown per group')
+
+    args = parser.parse_args(argv)
+
+    if args.bandwidth <= 0:
+        parser.error('the bandwidth must be positive')
+
+    estimator = PvEstimator(args.latency, args.bandwidth, args.default_sleep)
+    pv_parser = PvParser()
+    pv_parser.add_handler(estimator)
+    for file_name in args.file_list:
+        if not pv_parser.pv_file(file_name):
+            parser.error('cannot read ' + file_name)
+    estimator.report(sys.stdout, args.show_groups)
+
+
+def plan_command(argv):
+    """
+    Write an execution plan for a list of pvload files.
+    :param argv: command line arguments
+    :type argv: list
+    """
+    parser = ArgumentParser(prog='pvcheck.py plan',
+                            description='write a concurrent execution plan for pvload files')
+
+    parser.add_argument(action='store',
+                        nargs='+',
+                        dest='file_list',
+                        help='list of input files')
+
+    parser.add_argument('-o', '--output',
+                        action='store',
+                        dest='output',
+                        default=None,
+                        help='plan file name (default: standard output)')
+
+    parser.add_argument('-m', '--macros',
+                        action='store',
+                        dest='macros',
+                        default='',
+                        help='macro definitions used to expand pv names (e.g. top=tcs:,sadtop=sad:)')
+
+    parser.add_argument('--max-batch',
+                        action='store',
+                        type=int,
+                        dest='max_batch',
+                        default=0,
+                        help='maximum number of concurrent puts in a batch (default: no limit)')
+
+    parser.add_argument('--default-sleep',
+                        action='store',
+                        type=float,
+                        dest='default_sleep',
+                        default=DEFAULT_SLEEP,
+                        help='time used for sleep statements with no time (default: %(default)s)')
+
+    parser.add_argument('--values',
+                        action='store_true',
+                        dest='include_values',
+                        default=False,
+                        help='include the values in the plan')
+
+    args = parser.parse_args(argv)
+
+    try:
+        macro_dict = parse_macros(args.macros)
+    except ValueError as e:
+        parser.error(str(e))
+
+    planner = PvPlanner(macro_dict, args.max_batch, args.default_sleep)
+    pv_parser = PvParser()
+    pv_parser.add_handler(planner)
+    for file_name in args.file_list:
+        if not pv_parser.pv_file(file_name):
+            parser.error('cannot read ' + file_name)
+    try:
+        f_out = open(args.output, 'w') if args.output else sys.stdout
+    except (IOError, OSError) as e:
+        parser.error(str(e))
+    planner.write(f_out, args.include_values)
+    if f_out is not sys.stdout:
+        f_out.close()
+
+
+def replay_command(argv):
+    """
+    Replay pvload files against a fake pv server and report the throughput.
+    :param argv: command line arguments
+    :type argv: list
+    """
+    parser = ArgumentParser(prog='pvcheck.py replay',
+                            description='replay pvload files against a fake pv server')
+
+    parser.add_argument(action='store',
+                        nargs='+',
+                        dest='file_list',
+                        help='list of input files')
+
+    parser.add_argument('--strategy',
+                        action='store',
+                        dest='strategy',
+                        choices=['sequential', 'planned'],
+                        default='sequential',
+                        help='execute the files in pvload order or with the planned batches (default: %(default)s)')
+
+    parser.add_argument('--concurrency',
+                        action='store',
+                        type=int,
+                        dest='concurrency',
+                        default=16,
+                        help='maximum number of puts in flight (default: %(default)s)')
+
+    parser.add_argument('--latency',
+                        action='store',
+                        type=float,
+                        dest='latency',
+                        default=LATENCY,
+                        help='fake server put latency in seconds (default: %(default)s)')
+
+    parser.add_argument('--jitter',
+                        action='store',
+                        type=float,
+                        dest='jitter',
+                        default=0.0,
+                        help='maximum random delay added to each put in seconds (default: %(default)s)')
+
+    parser.add_argument('--bandwidth',
+                        action='store',
+                        type=float,
+                        dest='bandwidth',
+                        default=0.0,
+                        help='fake server bandwidth in bytes per second (default: no limit)')
+
+    parser.add_argument('--loopback',
+                        action='store_true',
+                        dest='loopback',
+                        default=False,
+                        help='run the fake server on a loopback TCP connection')
+
+    parser.add_argument('--sleep-scale',
+                        action='store',
+                        type=float,
+                        dest='sleep_scale',
+                        default=1.0,
+                        help='factor applied to the sleep times, 0 to skip them (default: %(default)s)')
+
+    parser.add_argument('--default-sleep',
+                        action='store',
+                        type=float,
+                        dest='default_sleep',
+                        default=DEFAULT_SLEEP,
+                        help='time used for sleep statements with no time (default: %(default)s)')
+
+    parser.add_argument('-m', '--macros',
+                        action='store',
+                        dest='macros',
+                        default='',
+                        help='macro definitions used to expand pv names (e.g. top=tcs:,sadtop=sad:)')
+
+    args = parser.parse_args(argv)
+
+    if sys.version_info < (3, 7):
+        parser.error('the replay command requires Python 3.7 or later')
+    if args.concurrency < 1:
+        parser.error('the concurrency must be at least 1')
+
+    try:
+        macro_dict = parse_macros(args.macros)
+    except ValueError as e:
+        parser.error(str(e))
+
+    import asyncio
+    from pvreplay import PvFakeServer, replay
+
+    planner = PvPlanner(macro_dict, default_sleep=args.default_sleep, concurrent=args.strategy == 'planned')
+    pv_parser = PvParser()
+    pv_parser.add_handler(planner)
+    for file_name in args.file_list:
+        if not pv_parser.pv_file(file_name):
+            parser.error('cannot read ' + file_name)
+
+    fake_server = PvFakeServer(args.latency, args.jitter, args.bandwidth)
+    pv_replay = asyncio.run(replay(planner.step_list, fake_server, args.loopback, args.concurrency,
+                                   args.sleep_scale))
+    pv_replay.report(sys.stdout)
+
+
+def fmt_command(argv):
+    """
+    Rewrite pvload files in canonical or compact form.
+    :param argv: command line arguments
+    :type argv: list
+    """
+    parser = ArgumentParser(prog='pvcheck.py fmt',
+                            description='rewrite pvload files in canonical or compact form')
+
+    parser.add_argument(action='store',
+                        nargs='+',
+                        dest='file_list',
+                        help='list of input files')
+
+    parser.add_argument('-o', '--output',
+                        action='store',
+                        dest='output',
+                        default=None,
+                        help='output file name (default: standard output)')
+
+    parser.add_argument('-i', '--in-place',
+                        action='store_true',
+                        dest='in_place',
+                        default=False,
+                        help='replace the input files (not supported for compressed files)')
+
+    parser.add_argument('--compact',
+                        action='store_true',
+                        dest='compact',
+                        default=False,
+                        help='drop sequential indices, white space and redundant digits')
+
+    parser.add_argument('--strip-comments',
+                        action='store_false',
+                        dest='keep_comments',
+                        default=True,
+                        help='do not copy the comments')
+
+    parser.add_argument('--no-verify',
+                        action='store_false',
+                        dest='verify',
+                        default=True,
+                        help='do not parse the output to check it has the same meaning as the input')
+
+    parser.add_argument('-v', '--verbose',
+                        action='store_true',
+                        dest='verbose',
+                        default=False,
+                        help='print the size of each file before and after formatting')
+
+    args = parser.parse_args(argv)
+
+    if args.in_place and args.output:
+        parser.error('--output cannot be used with --in-place')
+    if not args.in_place and len(args.file_list) > 1:
+        parser.error('only one input file can be formatted unless --in-place is used')
+
+    status = 0
+    for file_name in args.file_list:
+        try:
+            size_in, size_out = format_file(file_name, file_name if args.in_place else args.output,
+                                            args.compact, args.keep_comments, args.verify)
+        except (IOError, OSError, ValueError) as e:
+            sys.stderr.write(str(e) + '\n')
+            status = 1
+            continue
+        if args.verbose:
+            saved = 100.0 * (size_in - size_out) / size_in if size_in else 0.0
+            sys.stderr.write('{0}: {1} -> {2} bytes ({3:.1f}% smaller)\n'.format(file_name, size_in, size_out, saved))
+    sys.exit(status)
+
+
+def index_command(argv):
+    """
+    Build or query the index of the pvs written by a tree of pvload files.
+    :param argv: command line arguments
+    :type argv: list
+    """
+    parser = ArgumentParser(prog='pvcheck.py index',
+                            description='find which pvload files set which pvs')
+
+    parser.add_argument('--index',
+                        action='store',
+                        dest='index',
+                        default='.pvcheck_index',
+                        metavar='FILE',
+                        help='index file name (default: %(default)s)')
+
+    subparsers = parser.add_subparsers(dest='action')
+
+    build_parser = subparsers.add_parser('build',
+                                         help='build or update the index')
+
+    build_parser.add_argument(action='store',
+                              nargs='+',
+                              dest='path_list',
+                              help='list of pvload files and directories')
+
+    build_parser.add_argument('-v', '--verbose',
+                              action='store_true',
+                              dest='verbose',
+                              default=False)
+
+    query_parser = subparsers.add_parser('query',
+                                         help='list the statements that set the pvs matching a pattern')
+
+    query_parser.add_argument(action='store',
+                              nargs='+',
+                              dest='pattern_list',
+                              help='pv name or glob pattern (e.g. \'$(top)cc:*\')')
+
+    query_parser.add_argument('-l', '--files',
+                              action='store_true',
+                              dest='files_only',
+                              default=False,
+                              help='only list the file names')
+
+    args = parser.parse_args(argv)
+
+    if args.action == 'build':
+        try:
+            files, parsed_files, entries = build_index(args.path_list, args.index)
+        except (IOError, OSError) as e:
+            parser.error(str(e))
+        if args.verbose:
+            print(str(entries) + ' statements in ' + str(files) + ' files, ' + str(parsed_files) + ' files parsed')
+    elif args.action == 'query':
+        try:
+            index = PvIndex(args.index)
+        except (IOError, OSError, ValueError) as e:
+            parser.error(str(e))
+        found = False
+        file_set = set()
+        for pattern in args.pattern_list:
+            for name, file_name, line_number, type_name, count in index.query(pattern):
+                found = True
+                if args.files_only:
+                    if file_name not in file_set:
+                        file_set.add(file_name)
+                        print(file_name)
+                else:
+                    head = (type_name + ' ' if type_name else '') + name + ('[' + str(count) + ']' if count > 1 else '')
+                    print(file_name + ':' + str(line_number) + ': ' + head)
+        index.close()
+        sys.exit(0 if found else 1)
+    else:
+        parser.error('expected build or query')
+
+
+def merge_command(argv):
+    """
+    Merge the results of a check split with --shard.
+    :param argv: command line arguments
+    :type argv: list
+    """
+    parser = ArgumentParser(prog='pvcheck.py merge',
+                            description='write the messages of all the shards of a check, in the order of the files')
+
+    parser.add_argument(action='store',
+                        nargs='+',
+                        dest='result_list',
+                        help='result files of all the shards')
+
+    parser.add_argument('--duplicates',
+                        action='store_true',
+                        dest='duplicates',
+                        default=False,
+                        help='warn about pvs that are set by more than one file')
+
+    parser.add_argument('--format',
+                        action='store',
+                        dest='format',
+                        choices=sorted(WRITERS),
+                        default='text',
+                        help='format of the error and warning messages (default: %(default)s)')
+
+    parser.add_argument('-o', '--output',
+                        action='store',
+                        dest='output',
+                        default=None,
+                        metavar='FILE',
+                        help='write the error and warning messages to a file (default: standard output)')
+
+    args = parser.parse_args(argv)
+
+    try:
+        file_result_list = read_results(args.result_list)
+    except (IOError, OSError, ValueError) as e:
+        parser.error(str(e))
+
+    try:
+        f_out = open(args.output, 'w') if args.output else sys.stdout
+    except (IOError, OSError) as e:
+        parser.error(str(e))
+    reporter = WRITERS[args.format](f_out)
+    merge_results(file_result_list, reporter, args.duplicates)
+    reporter.close()
+    if f_out is not sys.stdout:
+        f_out.close()
+
+
+def overlay_command(argv):
+    """
+    Write the effective state of pvload files loaded one after the other.
+    The exit status is 1 if any file has errors.
+    :param argv: command line arguments
+    :type argv: list
+    """
+    parser = ArgumentParser(prog='pvcheck.py overlay',
+                            description='write the state of the pvs after loading pvload files in order '
+                                        '(the last statement written to a pv wins)')
+
+    parser.add_argument(action='store',
+                        nargs='+',
+                        dest='file_list',
+                        help='list of input files, in load order')
+
+    parser.add_argument('-m', '--macros',
+                        action='store',
+                        dest='macros',
+                        default='',
+                        help='macro definitions used to expand pv names (e.g. top=tcs:,sadtop=sad:)')
+
+    parser.add_argument('--format',
+                        action='store',
+                        dest='format',
+                        choices=sorted(FORMATS),
+                        default='pv',
+                        help='output format: pvload text or a JSON object (default: %(default)s)')
+
+    parser.add_argument('-o', '--output',
+                        action='store',
+                        dest='output',
+                        default=None,
+                        help='output file name (default: standard output)')
+
+    parser.add_argument('--buffer-size',
+                        action='store',
+                        type=int,
+                        dest='buffer_size',
+                        default=BUFFER_SIZE,
+                        help='number of values kept in memory before using disk (default: %(default)s)')
+
+    parser.add_argument('-v', '--verbose',
+                        action='store_true',
+                        dest='verbose',
+                        default=False,
+                        help='print the number of statements and pvs')
+
+    args = parser.parse_args(argv)
+
+    try:
+        macro_dict = parse_macros(args.macros)
+    except ValueError as e:
+        parser.error(str(e))
+
+    # the messages do not go to the standard output, which may hold the state
+    overlay = PvOverlay(macro_dict, args.buffer_size)
+    pv_parser = PvParser(message_file=sys.stderr)
+    pv_parser.add_handler(overlay)
+    for file_name in args.file_list:
+        if not pv_parser.pv_file(file_name):
+            overlay.close()
+            parser.error('cannot read ' + file_name)
+
+    try:
+        f_out = open(args.output, 'w') if args.output else sys.stdout
+    except (IOError, OSError) as e:
+        overlay.close()
+        parser.error(str(e))
+    pvs = FORMATS[args.format](overlay.sorted_items(), f_out)
+    if f_out is not sys.stdout:
+        f_out.close()
+    if args.verbose:
+        sys.stderr.write('{0} statements, {1} pvs{2}\n'.format(len(overlay), pvs,
+                                                              ' (used disk)' if overlay.spilled() else ''))
+    overlay.close()
+    sys.exit(1 if pv_parser.errors else 0)
+
+
+# Commands other than the default check
+command_map = {
+    'export': export_command,
+    'import': import_command,
+    'diff': diff_command,
+    'estimate': estimate_command,
+    'plan': plan_command,
+    'replay': replay_command,
+    'fmt': fmt_command,
+    'index': index_command,
+    'merge': merge_command,
+    'overlay': overlay_command,
+}
+
+if __name__ == '__main__':
+    """
+    Entry point for the pvload file check program.
+    The first argument selects a command, otherwise the files are checked.
+    """
+    if len(sys.argv) > 1 and sys.argv[1] in command_map:
+        command_map[sys.argv[1]](sys.argv[2:])
+    else:
+        check_command(sys.argv[1:])
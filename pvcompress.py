@@ -0,0 +1,174 @@
+"""
+Reading of compressed pvload/pvsave files (e.g. archived snapshots saved as
+.pv.gz, .pv.xz or .pv.bz2).
+
+A file is read as compressed when its first bytes are the ones of a compression
+and its name has the matching extension, so a text file that happens to start with
+the same characters (e.g. "BZh") is still read as text.
+Compressed files are decompressed as they are read, with large read buffers, so
+nothing is written to disk. The time spent reading and decompressing is measured
+so it can be told apart from the time spent lexing.
+
+xz files need the lzma module (python 3.3 or later), otherwise they are reported
+as errors.
+"""
+import io
+import os
+import sys
+import bz2
+import time
+import gzip
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+timer = getattr(time, 'perf_counter', time.time)
+
+# Bytes read at a time from the compressed file, and decompressed bytes buffered
+READ_BUFFER_SIZE = 1024 * 1024
+
+# First bytes and file name extensions of the files of each compression
+MAGIC_LIST = [
+    (b'\x1f\x8b', 'gzip', ['.gz', '.tgz']),
+    (b'BZh', 'bzip2', ['.bz2']),
+    (b'\xfd7zXZ\x00', 'xz', ['.xz']),
+]
+MAGIC_LENGTH = max([len(magic) for magic, compression, extensions in MAGIC_LIST])
+
+# Errors raised by the decompressors on corrupt or truncated data
+DECOMPRESS_ERRORS = (IOError, OSError, EOFError, zlib.error) + ((lzma.LZMAError,) if lzma is not None else ())
+
+
+class PvDecompressError(IOError):
+    """
+    Raised when the data of a compressed file cannot be decompressed
+    """
+    pass
+
+
+def compression(f, file_name):
+    """
+    Detect the compression of a file from its first bytes and its name
+    :param f: file, open in binary mode at its start (it's left there)
+    :type f: file
+    :param file_name: file name
+    :type file_name: str
+    :return: compression name, or None if the file is not compressed
+    :rtype: str
+    """
+    extension = os.path.splitext(file_name)[1].lower()
+    head = f.read(MAGIC_LENGTH)
+    f.seek(0)
+    for magic, name, extension_list in MAGIC_LIST:
+        if head.startswith(magic) and extension in extension_list:
+            return name
+    return None
+
+
+def file_compression(file_name):
+    """
+    Detect the compression of a file
+    :param file_name: file name
+    :type file_name: str
+    :return: compression name, or None if the file is not compressed or cannot be read
+    :rtype: str
+    """
+    try:
+        with open(file_name, 'rb') as f:
+            return compression(f, file_name)
+    except (IOError, OSError):
+        return None
+
+
+class PvDecompressReader(io.RawIOBase):
+    """
+    Decompressed data of a compressed file. Keeps the time spent reading
+    and decompressing, and the number of bytes read and decompressed.
+    """
+
+    def __init__(self, f_raw, name, file_name):
+        """
+        :param f_raw: compressed file, open in binary mode at its start
+        :type f_raw: file
+        :param name: compression name (see MAGIC_LIST)
+        :type name: str
+        :param file_name: file name
+        :type file_name: str
+        """
+        io.RawIOBase.__init__(self)
+        self.f_raw = f_raw
+        self.compression = name
+        self.file_name = file_name
+        self.seconds = 0.0
+        self.bytes = 0  # decompressed bytes
+        if name == 'gzip':
+            self.f_data = gzip.GzipFile(fileobj=f_raw, mode='rb')
+        elif name == 'bzip2':
+            # the python 2 module only opens files by name
+            self.f_data = bz2.BZ2File(f_raw if sys.version_info[0] >= 3 else file_name)
+        elif lzma is not None:
+            self.f_data = lzma.LZMAFile(f_raw)
+        else:
+            self.f_data = None  # reported when the file is read
+
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if self.f_data is None:
+            raise PvDecompressError('reading ' + self.compression + ' files needs the lzma module')
+        start = timer()
+        try:
+            data = self.f_data.read(len(b))
+        except DECOMPRESS_ERRORS as e:
+            raise PvDecompressError('cannot decompress (' + str(e) + ')')
+        finally:
+            self.seconds += timer() - start
+        b[:len(data)] = data
+        self.bytes += len(data)
+        return len(data)
+
+    def compressed_bytes(self):
+        """
+        :return: size of the compressed file
+        :rtype: int
+        """
+        return os.fstat(self.f_raw.fileno()).st_size
+
+    def close(self):
+        if not self.closed:
+            if self.f_data is not None:
+                self.f_data.close()
+            self.f_raw.close()
+        io.RawIOBase.close(self)
+
+
+def open_input(file_name, buffer_size=READ_BUFFER_SIZE):
+    """
+    Open a pvload file for reading as text, decompressing it if needed
+    :param file_name: file name
+    :type file_name: str
+    :param buffer_size: read buffer size of compressed files in bytes
+    :type buffer_size: int
+    :return: file and decompressed data reader (None if the file is not compressed)
+    :rtype: tuple
+    :raises: IOError if the file cannot be opened
+    """
+    f_raw = open(file_name, 'rb', buffer_size)
+    try:
+        name = compression(f_raw, file_name)
+        if name is None:
+            f_raw.close()
+            return open(file_name, 'r'), None
+        reader = PvDecompressReader(f_raw, name, file_name)
+    except (IOError, OSError):
+        f_raw.close()
+        raise
+    f_buffered = io.BufferedReader(reader, buffer_size)
+    if sys.version_info[0] < 3:
+        return f_buffered, reader  # str lines, as open()
+    return io.TextIOWrapper(f_buffered), reader
@@ -0,0 +1,389 @@
+"""
+Index of the records defined in local EPICS database files, used to check that the
+process variables written by a pvload file exist and have a compatible type and size.
+
+Database files contain record definitions such as
+
+    record(waveform, "$(top)arr1") {
+        field(FTVL, "DOUBLE")
+        field(NELM, "3")
+    }
+
+The index maps every record name to its record type and the fields defined in the file.
+Field types are taken from a built-in table covering the most used fields of the standard
+record types. Fields missing from the table, and the fields of unknown record types
+(e.g. device specific records), are not checked.
+
+Parsing the database files is slow compared to reading the index, so the records
+found in each file are cached in a JSON file, together with the file modification
+time and size. Only the files that changed since the last run are parsed again.
+"""
+import os
+import re
+import json
+import tempfile
+
+from pvhandler import PvHandler
+from pvmacro import expand_macros
+from pvparser import TYPE_INTEGER, TYPE_FLOAT, TYPE_STRING
+
+# Version of the cache file format. Caches with a different version are ignored.
+CACHE_VERSION = 2
+
+# File extensions of the database files searched for in directories
+DB_EXTENSIONS = ['.db', '.vdb', '.template']
+
+# Basic field types. Menu fields accept both the choice string and its index.
+DBF_STRING = 'STRING'
+DBF_INTEGER = 'INTEGER'
+DBF_FLOAT = 'FLOAT'
+DBF_MENU = 'MENU'
+DBF_LINK = 'LINK'
+
+# Map the FTVL field values (waveform element type) into basic field types
+FTVL_MAP = {
+    'STRING': DBF_STRING,
+    'CHAR': DBF_INTEGER, 'UCHAR': DBF_INTEGER,
+    'SHORT': DBF_INTEGER, 'USHORT': DBF_INTEGER,
+    'LONG': DBF_INTEGER, 'ULONG': DBF_INTEGER,
+    'INT64': DBF_INTEGER, 'UINT64': DBF_INTEGER,
+    'FLOAT': DBF_FLOAT, 'DOUBLE': DBF_FLOAT,
+    'ENUM': DBF_MENU,
+}
+
+# Fields common to all records
+COMMON_FIELDS = {
+    'NAME': DBF_STRING, 'DESC': DBF_STRING, 'ASG': DBF_STRING, 'SCAN': DBF_MENU,
+    'PINI': DBF_MENU, 'PHAS': DBF_INTEGER, 'EVNT': DBF_STRING, 'TSE': DBF_INTEGER,
+    'TSEL': DBF_LINK, 'DTYP': DBF_MENU, 'DISV': DBF_INTEGER, 'DISA': DBF_INTEGER,
+    'SDIS': DBF_LINK, 'DISS': DBF_MENU, 'PRIO': DBF_MENU, 'FLNK': DBF_LINK,
+    'TPRO': DBF_INTEGER, 'PROC': DBF_INTEGER, 'STAT': DBF_MENU, 'SEVR': DBF_MENU,
+    'UDF': DBF_INTEGER, 'UDFS': DBF_MENU, 'ACKS': DBF_MENU, 'ACKT': DBF_MENU,
+}
+
+# Alarm and display fields shared by the analog records
+_ANALOG_FIELDS = dict([(f, DBF_FLOAT) for f in ['HOPR', 'LOPR', 'HIHI', 'HIGH', 'LOW', 'LOLO', 'HYST',
+                                                 'ADEL', 'MDEL']] +
+                      [(f, DBF_MENU) for f in ['HHSV', 'HSV', 'LSV', 'LLSV']] +
+                      [('EGU', DBF_STRING), ('PREC', DBF_INTEGER)])
+
+_INTEGER_FIELDS = dict(_ANALOG_FIELDS, **dict([(f, DBF_INTEGER) for f in ['HOPR', 'LOPR', 'HIHI', 'HIGH', 'LOW',
+                                                                        'LOLO', 'HYST', 'ADEL', 'MDEL']]))
+
+_MBB_FIELDS = dict([(p + 'ST', DBF_STRING) for p in ['ZR', 'ON', 'TW', 'TH', 'FR', 'FV', 'SX', 'SV',
+                                                     'EI', 'NI', 'TE', 'EL', 'TV', 'TT', 'FT', 'FF']] +
+                   [(p + 'VL', DBF_INTEGER) for p in ['ZR', 'ON', 'TW', 'TH', 'FR', 'FV', 'SX', 'SV',
+                                                      'EI', 'NI', 'TE', 'EL', 'TV', 'TT', 'FT', 'FF']])
+
+_CALC_FIELDS = dict([(f, DBF_FLOAT) for f in 'ABCDEFGHIJKL'] +
+                    [('INP' + f, DBF_LINK) for f in 'ABCDEFGHIJKL'] +
+                    [('CALC', DBF_STRING), ('VAL', DBF_FLOAT)])
+
+# Field types of the standard record types. The array records get the type
+# of the VAL field from FTVL.
+RECORD_FIELDS = {
+    'ai': dict(_ANALOG_FIELDS, VAL=DBF_FLOAT, INP=DBF_LINK, RVAL=DBF_INTEGER, LINR=DBF_MENU,
+               ESLO=DBF_FLOAT, EOFF=DBF_FLOAT, SMOO=DBF_FLOAT, AOFF=DBF_FLOAT, ASLO=DBF_FLOAT),
+    'ao': dict(_ANALOG_FIELDS, VAL=DBF_FLOAT, OUT=DBF_LINK, DOL=DBF_LINK, OMSL=DBF_MENU, RVAL=DBF_INTEGER,
+               OROC=DBF_FLOAT, DRVH=DBF_FLOAT, DRVL=DBF_FLOAT, LINR=DBF_MENU, ESLO=DBF_FLOAT,
+               EOFF=DBF_FLOAT, AOFF=DBF_FLOAT, ASLO=DBF_FLOAT, IVOA=DBF_MENU, IVOV=DBF_FLOAT),
+    'longin': dict(_INTEGER_FIELDS, VAL=DBF_INTEGER, INP=DBF_LINK),
+    'longout': dict(_INTEGER_FIELDS, VAL=DBF_INTEGER, OUT=DBF_LINK, DOL=DBF_LINK, OMSL=DBF_MENU,
+                    DRVH=DBF_INTEGER, DRVL=DBF_INTEGER, IVOA=DBF_MENU, IVOV=DBF_INTEGER),
+    'bi': dict(VAL=DBF_MENU, INP=DBF_LINK, ZNAM=DBF_STRING, ONAM=DBF_STRING, RVAL=DBF_INTEGER,
+               ZSV=DBF_MENU, OSV=DBF_MENU, COSV=DBF_MENU),
+    'bo': dict(VAL=DBF_MENU, OUT=DBF_LINK, DOL=DBF_LINK, OMSL=DBF_MENU, ZNAM=DBF_STRING, ONAM=DBF_STRING,
+               RVAL=DBF_INTEGER, HIGH=DBF_FLOAT, ZSV=DBF_MENU, OSV=DBF_MENU, COSV=DBF_MENU, IVOA=DBF_MENU,
+               IVOV=DBF_INTEGER),
+    'mbbi': dict(_MBB_FIELDS, VAL=DBF_MENU, INP=DBF_LINK, RVAL=DBF_INTEGER, NOBT=DBF_INTEGER,
+                 SHFT=DBF_INTEGER),
+    'mbbo': dict(_MBB_FIELDS, VAL=DBF_MENU, OUT=DBF_LINK, DOL=DBF_LINK, OMSL=DBF_MENU, RVAL=DBF_INTEGER,
+                 NOBT=DBF_INTEGER, SHFT=DBF_INTEGER, IVOA=DBF_MENU, IVOV=DBF_INTEGER),
+    'stringin': dict(VAL=DBF_STRING, INP=DBF_LINK),
+    'stringout': dict(VAL=DBF_STRING, OUT=DBF_LINK, DOL=DBF_LINK, OMSL=DBF_MENU, IVOA=DBF_MENU,
+                      IVOV=DBF_STRING),
+    'calc': dict(_ANALOG_FIELDS, **_CALC_FIELDS),
+    'calcout': dict(_ANALOG_FIELDS, OUT=DBF_LINK, OCAL=DBF_STRING, DOPT=DBF_MENU, OOPT=DBF_MENU,
+                    ODLY=DBF_FLOAT, OVAL=DBF_FLOAT, **_CALC_FIELDS),
+    'waveform': dict(_ANALOG_FIELDS, INP=DBF_LINK, NELM=DBF_INTEGER, FTVL=DBF_MENU, NORD=DBF_INTEGER,
+                     RARM=DBF_INTEGER),
+    'aai': dict(_ANALOG_FIELDS, INP=DBF_LINK, NELM=DBF_INTEGER, FTVL=DBF_MENU, NORD=DBF_INTEGER),
+    'aao': dict(_ANALOG_FIELDS, OUT=DBF_LINK, DOL=DBF_LINK, OMSL=DBF_MENU, NELM=DBF_INTEGER,
+                FTVL=DBF_MENU, NORD=DBF_INTEGER),
+    'subArray': dict(_ANALOG_FIELDS, INP=DBF_LINK, NELM=DBF_INTEGER, FTVL=DBF_MENU, MALM=DBF_INTEGER,
+                     INDX=DBF_INTEGER, NORD=DBF_INTEGER),
+}
+
+# Records where VAL is an array of FTVL elements
+ARRAY_RECORDS = ['waveform', 'aai', 'aao', 'subArray']
+
+# Pvload basic types that can be written to each basic field type
+COMPATIBLE_TYPES = {
+    DBF_STRING: [TYPE_STRING],
+    DBF_INTEGER: [TYPE_INTEGER],
+    DBF_FLOAT: [TYPE_INTEGER, TYPE_FLOAT],
+    DBF_MENU: [TYPE_INTEGER, TYPE_STRING],
+    DBF_LINK: [TYPE_STRING],
+}
+
+# Database file syntax. Quoted strings are matched as a whole, so that '#' and '}'
+# inside them are not taken as a comment or the end of a record.
+comment_pattern = re.compile(r'"(?:[^"\\\n]|\\.)*"|#[^\n]*')
+body_end_pattern = re.compile(r'"(?:[^"\\]|\\.)*"|\}')
+record_pattern = re.compile(r'g?record\s*\(\s*"?(\w+)"?\s*,\s*"([^"]*)"\s*\)\s*(\{)?')
+field_pattern = re.compile(r'field\s*\(\s*"?(\w+)"?\s*,\s*"((?:[^"\\]|\\.)*)"\s*\)')
+alias_pattern = re.compile(r'alias\s*\(\s*"([^"]*)"\s*,\s*"([^"]*)"\s*\)')
+record_alias_pattern = re.compile(r'alias\s*\(\s*"([^"]*)"\s*\)')
+
+
+def parse_db_file(file_name):
+    """
+    Extract the record definitions from a database file.
+    Only the fields needed to check the pvload files (FTVL and NELM) keep their values.
+    :param file_name: database file name
+    :type file_name: str
+    :return: list of (record name, record type, field dictionary) tuples
+    :rtype: list
+    :raises: IOError
+    """
+    with open(file_name, 'r') as f:
+        text = comment_pattern.sub(lambda m: m.group(0) if m.group(0).startswith('"') else '', f.read())
+
+    record_list = []
+    alias_list = []
+    pos = 0
+    while True:
+        m = record_pattern.search(text, pos)
+        if m is None:
+            break
+        record_type, record_name = m.group(1), m.group(2)
+        fields = {}
+        pos = m.end()
+        if m.group(3):
+            end = len(text)
+            m_end = body_end_pattern.search(text, pos)
+            while m_end is not None:
+                if m_end.group(0) == '}':
+                    end = m_end.start()
+                    break
+                m_end = body_end_pattern.search(text, m_end.end())
+            body = text[pos:end]
+            for field_name, field_value in field_pattern.findall(body):
+                fields[field_name] = field_value if field_name in ['FTVL', 'NELM'] else ''
+            for alias_name in record_alias_pattern.findall(body):
+                alias_list.append((alias_name, record_name))
+            pos = end + 1
+        record_list.append((record_name, record_type, fields))
+
+    alias_list.extend(alias_pattern.findall(text))
+    record_map = dict([(r[0], r) for r in record_list])
+    for alias_name, record_name in alias_list:
+        if record_name in record_map:
+            record_list.append((alias_name,) + record_map[record_name][1:])
+
+    return record_list
+
+
+def find_db_files(path_list):
+    """
+    Expand a list of files and directories into a list of database files.
+    Directories are searched recursively.
+    :param path_list: list of file and directory names
+    :type path_list: list
+    :return: sorted list of database file names
+    :rtype: list
+    """
+    file_list = []
+    for path in path_list:
+        if os.path.isdir(path):
+            for dir_path, dir_names, file_names in os.walk(path):
+                for file_name in file_names:
+                    if os.path.splitext(file_name)[1] in DB_EXTENSIONS:
+                        file_list.append(os.path.join(dir_path, file_name))
+        else:
+            file_list.append(path)
+    return sorted(set(file_list))
+
+
+class PvDatabase(PvHandler):
+    """
+    Record index built from a set of database files. It's also a parser handler
+    that checks every single statement against the index.
+    """
+
+    def __init__(self, macro_dict=None):
+        """
+        :param macro_dict: macros used to expand the record names and the pv names
+        :type macro_dict: dict
+        """
+        self.macro_dict = macro_dict if macro_dict else {}
+        self.record_map = {}  # record name -> (record type, field dictionary)
+        self.parsed_files = 0  # number of files parsed (not read from the cache)
+
+    def __len__(self):
+        return len(self.record_map)
+
+    def load(self, path_list, cache_file_name=None):
+        """
+        Build the index from a list of database files and directories.
+        The cache is only updated if any of the files changed.
+        :param path_list: list of database files and directories
+        :type path_list: list
+        :param cache_file_name: cache file name (None for no cache)
+        :type cache_file_name: str
+        :return: None
+        :raises: IOError if a database file cannot be read
+        """
+        cache = self._read_cache(cache_file_name)
+        file_map = {}
+        self.parsed_files = 0
+        for file_name in find_db_files(path_list):
+            st = os.stat(file_name)
+            key = os.path.abspath(file_name)
+            signature = (st.st_mtime, st.st_size)
+            if key in cache and cache[key][0] == signature:
+                file_map[key] = cache[key]
+            else:
+                file_map[key] = (signature, parse_db_file(file_name))
+                self.parsed_files += 1
+
+        if cache_file_name and (self.parsed_files > 0 or set(file_map) != set(cache)):
+            self._write_cache(cache_file_name, file_map)
+
+        self.record_map = {}
+        for key in sorted(file_map):
+            for record_name, record_type, fields in file_map[key][1]:
+                self.record_map[expand_macros(record_name, self.macro_dict)] = (record_type, fields)
+
+    @staticmethod
+    def _read_cache(cache_file_name):
+        """
+        Read the cache file. A missing, unreadable or old cache is treated as empty.
+        :param cache_file_name: cache file name
+        :type cache_file_name: str
+        :return: dictionary file name -> ((mtime, size), record list)
+        :rtype: dict
+        """
+        if not cache_file_name:
+            return {}
+        try:
+            with open(cache_file_name, 'r') as f:
+                data = json.load(f)
+            if data['version'] != CACHE_VERSION:
+                return {}
+            file_map = {}
+            for key, (mtime, size, record_list) in data['files'].items():
+                file_map[key] = ((mtime, size), [(str(record_name), str(record_type), dict(fields))
+                                                 for record_name, record_type, fields in record_list])
+            return file_map
+        except (IOError, OSError, ValueError, TypeError, KeyError, AttributeError):
+            return {}
+
+    @staticmethod
+    def _write_cache(cache_file_name, file_map):
+        """
+        Write the cache file. It's written to a temporary file which is then renamed,
+        so an interrupted run does not leave a partial cache. Failing to write the cache
+        is not an error.
+        :param cache_file_name: cache file name
+        :type cache_file_name: str
+        :param file_map: dictionary file name -> ((mtime, size), record list)
+        :type file_map: dict
+        :return: None
+        """
+        data = {'version': CACHE_VERSION,
+                'files': dict([(key, [mtime, size, record_list])
+                               for key, ((mtime, size), record_list) in file_map.items()])}
+        temp_file_name = None
+        try:
+            fd, temp_file_name = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(cache_file_name)))
+            with os.fdopen(fd, 'w') as f:
+                json.dump(data, f)
+            os.rename(temp_file_name, cache_file_name)
+        except (IOError, OSError):
+            if temp_file_name is not None and os.path.exists(temp_file_name):
+                os.remove(temp_file_name)
+
+    def lookup(self, pv_name):
+        """
+        Find the record and field for a pv name.
+        :param pv_name: pv name (with macros expanded), with or without field
+        :type pv_name: str
+        :return: record type, field dictionary and field name, or None if the record does not exist
+        :rtype: tuple
+        """
+        record_name, dot, field_name = pv_name.partition('.')
+        if not field_name:
+            field_name = 'VAL'
+        record = self.record_map.get(record_name)
+        if record is None:
+            return None
+        return record[0], record[1], field_name
+
+    @staticmethod
+    def field_type(record_type, fields, field_name):
+        """
+        Return the basic type of a field.
+        :return: basic field type, or None if unknown
+        :rtype: str
+        """
+        if field_name == 'VAL' and record_type in ARRAY_RECORDS:
+            return FTVL_MAP.get(fields.get('FTVL', 'STRING').upper())
+        if field_name in COMMON_FIELDS:
+            return COMMON_FIELDS[field_name]
+        return RECORD_FIELDS.get(record_type, {}).get(field_name)
+
+    def check(self, pv_name, data_type, count):
+        """
+        Check that a pv exists and that the type and array size are compatible.
+        :param pv_name: pv name (macros are expanded here)
+        :type pv_name: str
+        :param data_type: pvload basic type (TYPE_NONE if not defined)
+        :type data_type: int
+        :param count: number of elements written
+        :type count: int
+        :return: list of (kind, warning message) tuples
+        :rtype: list
+        """
+        pv_name = expand_macros(pv_name, self.macro_dict)
+        found = self.lookup(pv_name)
+        if found is None:
+            return [('db_record_not_found', 'record not found in database')]
+        record_type, fields, field_name = found
+
+        field_type = self.field_type(record_type, fields, field_name)
+        if field_type is None:
+            return []  # unknown record type or field missing from the table, nothing else can be checked
+
+        message_list = []
+        if data_type in COMPATIBLE_TYPES[field_type] or data_type not in [TYPE_INTEGER, TYPE_FLOAT, TYPE_STRING]:
+            pass
+        elif field_type == DBF_INTEGER and data_type == TYPE_FLOAT:
+            message_list.append(('db_float_to_integer', 'float value written to integer field ' + field_name))
+        else:
+            message_list.append(('db_type_mismatch',
+                                 'type does not match ' + field_name + ' field type (' + field_type.lower() + ')'))
+
+        if field_name == 'VAL' and record_type in ARRAY_RECORDS:
+            try:
+                nelm = int(fields.get('NELM', '1'))
+            except ValueError:
+                nelm = None  # NELM defined by a macro
+            if nelm is not None and count > nelm:
+                message_list.append(('db_array_too_large',
+                                     'array size ' + str(count) + ' larger than NELM (' + str(nelm) + ')'))
+        elif count > 1:
+            message_list.append(('db_array_for_scalar', 'array size ' + str(count) + ' for scalar field ' + field_name))
+
+        return message_list
+
+    def pv_single(self, parser):
+        """
+        Check a single statement against the index
+        :param parser: parser
+        :type parser: PvParser
+        :return: list of warning messages
+        :rtype: list
+        """
+        count = max(parser.single_count, len(parser.single_value_list))
+        return self.check(parser.single_name, parser.single_data_type, count)
@@ -0,0 +1,307 @@
+"""
+Comparison of two pvload/pvsave files by pv name.
+
+The single statements of each file are collected by a PvStatementStore, keyed by the
+pv name after expanding macros. When a name is written more than once in the same
+file the last statement wins. Values are compared after applying scales and units,
+element by element for arrays.
+
+Files that fit in the memory budget are compared with a hash join. Larger files are
+spilled to disk in sorted runs, and the runs are merged and compared in name order
+(sort-merge join), so memory use stays bounded regardless of the file size. Either
+way the differences are reported in name order, so the output does not depend on the
+memory budget.
+"""
+import heapq
+import pickle
+import tempfile
+
+from pvhandler import PvHandler
+from pvmacro import expand_macros
+from pvformat import format_single, format_value, TYPE_NAMES
+from pvparser import TYPE_STRING
+from pvscale import expand_indices
+
+# Default memory budget, in number of values (plus one per statement) kept in memory per file
+BUFFER_SIZE = 1000000
+
+
+def _read_run(f):
+    """
+    Iterate over the records stored in a run file
+    """
+    f.seek(0)
+    while True:
+        try:
+            yield pickle.load(f)
+        except EOFError:
+            break
+
+
+def _last_by_name(item_iterator):
+    """
+    Collapse consecutive records with the same name (sorted by name and sequence
+    number), keeping the last one.
+    """
+    last = None
+    for item in item_iterator:
+        if last is not None and item[0] != last[0]:
+            yield last
+        last = item
+    if last is not None:
+        yield last
+
+
+class PvStatementStore(PvHandler):
+    """
+    Parser handler that keeps the single statements of a file, within a memory budget.
+    Each statement is kept as a (name, sequence number, record) tuple, where record is
+    (data type, count, index list, value list).
+    """
+
+    # Warning for the statements whose values do not match the type
+    skip_message = ('statement_skipped', 'statement not compared (values do not match the type)')
+
+    def __init__(self, macro_dict=None, buffer_size=BUFFER_SIZE):
+        """
+        :param macro_dict: macros used to expand the pv names
+        :type macro_dict: dict
+        :param buffer_size: memory budget in number of values
+        :type buffer_size: int
+        """
+        self.macro_dict = macro_dict if macro_dict else {}
+        self.buffer_size = buffer_size
+        self.item_list = []
+        self.size = 0  # number of values kept in memory
+        self.run_list = []  # temporary files with sorted runs
+        self.sequence = 0
+
+    def __len__(self):
+        return self.sequence
+
+    def spilled(self):
+        """
+        :return: true if the statements did not fit in memory
+        :rtype: bool
+        """
+        return len(self.run_list) > 0
+
+    def add(self, name, data_type, count, index_list, value_list):
+        """
+        Add a statement to the store
+        :return: None
+        """
+        record = (data_type, count, list(index_list), list(value_list))
+        self.item_list.append((expand_macros(name, self.macro_dict), self.sequence, record))
+        self.sequence += 1
+        self.size += 1 + len(value_list)
+        if self.size > self.buffer_size:
+            self._spill()
+
+    def pv_single(self, parser):
+        """
+        Keep the single statement found by the parser
+        :param parser: parser
+        :type parser: PvParser
+        :return: list of warning messages
+        :rtype: list
+        """
+        value_list = parser.evaluate_single()
+        if value_list is None:
+            return [self.skip_message]
+        if not isinstance(value_list, list):
+            value_list = value_list.tolist()  # numpy array
+        index_list = expand_indices(parser.single_index_list, len(value_list), parser.single_index_position_list)
+        self.add(parser.single_name, parser.single_basic_type(), parser.single_count, index_list, value_list)
+        return []
+
+    def _spill(self):
+        """
+        Write the statements in memory to a temporary file, sorted by name
+        """
+        self.item_list.sort()
+        f = tempfile.TemporaryFile()
+        for item in self.item_list:
+            pickle.dump(item, f, pickle.HIGHEST_PROTOCOL)
+        self.run_list.append(f)
+        self.item_list = []
+        self.size = 0
+
+    def close(self):
+        """
+        Remove the temporary files
+        """
+        for f in self.run_list:
+            f.close()
+        self.run_list = []
+        self.item_list = []
+
+    def mapping(self):
+        """
+        Return the statements as a dictionary, used for the hash join.
+        Only valid if the statements were not spilled to disk.
+        :return: dictionary name -> record
+        :rtype: dict
+        """
+        return dict([(name, record) for name, sequence, record in self.item_list])
+
+    def sorted_items(self):
+        """
+        Iterate over the statements sorted by name, one per name.
+        :return: iterator of (name, sequence, record) tuples
+        """
+        self.item_list.sort()
+        iterator_list = [_read_run(f) for f in self.run_list] + [iter(self.item_list)]
+        return _last_by_name(heapq.merge(*iterator_list))
+
+
+def element_map(index_list, value_list):
+    """
+    Map array elements to their values, using the indices if present.
+    :return: dictionary index -> value
+    :rtype: dict
+    """
+    index_list = expand_indices(index_list, len(value_list))
+    if index_list:
+        return dict(zip(index_list, value_list))
+    return dict(enumerate(value_list))
+
+
+def equal_values(value_a, value_b, tolerance):
+    """
+    Compare two values, numbers within an absolute tolerance.
+    :rtype: bool
+    """
+    if isinstance(value_a, str) or isinstance(value_b, str):
+        return value_a == value_b
+    if value_a == value_b or (value_a != value_a and value_b != value_b):
+        return True  # also infinities and nan, where the difference is nan
+    return abs(value_a - value_b) <= tolerance
+
+
+class PvDiff:
+    """
+    Comparison of two statement stores
+    """
+
+    def __init__(self, f_out, tolerance=0.0, max_elements=10):
+        """
+        :param f_out: output file
+        :type f_out: file
+        :param tolerance: absolute tolerance used to compare numbers
+        :type tolerance: float
+        :param max_elements: maximum number of array element differences reported per pv
+        :type max_elements: int
+        """
+        self.f_out = f_out
+        self.tolerance = tolerance
+        self.max_elements = max_elements
+        self.added = 0
+        self.removed = 0
+        self.changed = 0
+
+    def differences(self, record_a, record_b):
+        """
+        Compare two records
+        :return: list of differences (empty if the records are the same)
+        :rtype: list
+        """
+        type_a, count_a, index_list_a, value_list_a = record_a
+        type_b, count_b, index_list_b, value_list_b = record_b
+        difference_list = []
+        if type_a != type_b:
+            difference_list.append('type ' + TYPE_NAMES[type_a] + ' -> ' + TYPE_NAMES[type_b])
+            if TYPE_STRING in [type_a, type_b]:
+                value_list_a = [str(value) for value in value_list_a]
+                value_list_b = [str(value) for value in value_list_b]
+        if count_a != count_b:
+            difference_list.append('count ' + str(count_a) + ' -> ' + str(count_b))
+
+        elements_a = element_map(index_list_a, value_list_a)
+        elements_b = element_map(index_list_b, value_list_b)
+        element_differences = 0
+        for index in sorted(set(elements_a) | set(elements_b)):
+            value_a = elements_a.get(index)
+            value_b = elements_b.get(index)
+            if value_a is not None and value_b is not None and equal_values(value_a, value_b, self.tolerance):
+                continue
+            element_differences += 1
+            if element_differences <= self.max_elements:
+                text_a = '(none)' if value_a is None else format_value(type_a, value_a)
+                text_b = '(none)' if value_b is None else format_value(type_b, value_b)
+                difference_list.append('[' + str(index) + '] ' + text_a + ' -> ' + text_b)
+        if element_differences > self.max_elements:
+            difference_list.append('... ' + str(element_differences - self.max_elements) + ' more elements')
+        return difference_list
+
+    def report_added(self, name, record):
+        self.added += 1
+        self.f_out.write('+ ' + format_single(record[0], name, record[1], record[2], record[3]) + '\n')
+
+    def report_removed(self, name, record):
+        self.removed += 1
+        self.f_out.write('- ' + format_single(record[0], name, record[1], record[2], record[3]) + '\n')
+
+    def report_changed(self, name, record_a, record_b):
+        difference_list = self.differences(record_a, record_b)
+        if difference_list:
+            self.changed += 1
+            self.f_out.write('~ ' + name + '\n')
+            for text in difference_list:
+                self.f_out.write('    ' + text + '\n')
+
+    def hash_join(self, store_a, store_b):
+        """
+        Compare two stores that fit in memory, in name order (as merge_join).
+        """
+        mapping_a = store_a.mapping()
+        mapping_b = store_b.mapping()
+        for name in sorted(set(mapping_a) | set(mapping_b)):
+            record_a = mapping_a.get(name)
+            record_b = mapping_b.get(name)
+            if record_a is None:
+                self.report_added(name, record_b)
+            elif record_b is None:
+                self.report_removed(name, record_a)
+            else:
+                self.report_changed(name, record_a, record_b)
+
+    def merge_join(self, store_a, store_b):
+        """
+        Compare two stores in name order. Memory use is bounded by the number of runs.
+        """
+        iterator_a = store_a.sorted_items()
+        iterator_b = store_b.sorted_items()
+        item_a = next(iterator_a, None)
+        item_b = next(iterator_b, None)
+        while item_a is not None or item_b is not None:
+            if item_b is None or (item_a is not None and item_a[0] < item_b[0]):
+                self.report_removed(item_a[0], item_a[2])
+                item_a = next(iterator_a, None)
+            elif item_a is None or item_b[0] < item_a[0]:
+                self.report_added(item_b[0], item_b[2])
+                item_b = next(iterator_b, None)
+            else:
+                self.report_changed(item_a[0], item_a[2], item_b[2])
+                item_a = next(iterator_a, None)
+                item_b = next(iterator_b, None)
+
+    def compare(self, store_a, store_b):
+        """
+        Compare two stores, choosing the join method according to their size.
+        :return: true if the stores are different
+        :rtype: bool
+        """
+        if store_a.spilled() or store_b.spilled():
+            self.merge_join(store_a, store_b)
+        else:
+            self.hash_join(store_a, store_b)
+        return self.added + self.removed + self.changed > 0
+
+    def summary(self):
+        """
+        :return: summary of the differences
+        :rtype: str
+        """
+        return str(self.added) + ' added, ' + str(self.removed) + ' removed, ' + str(self.changed) + ' changed'
+
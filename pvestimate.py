@@ -0,0 +1,147 @@
+"""
+Estimation of the time pvload takes to execute a file.
+
+The estimate uses a simple cost model:
+- Single statements outside groups are written one at a time, and pvload waits for
+  each put to complete, so every one of them pays the round trip latency.
+- The puts in a group are issued together and pvload waits for all of them at the
+  end of the group, so the latency is paid once per group.
+- The data transferred costs its size divided by the bandwidth.
+- Sleep statements add their time. A sleep with no time uses a default value.
+"""
+from pvhandler import PvHandler
+from pvparser import TYPE_INTEGER, TYPE_FLOAT, TYPE_STRING
+
+# Size in bytes of one element of each basic type, as transferred by channel access
+ELEMENT_SIZE = {TYPE_INTEGER: 4, TYPE_FLOAT: 8, TYPE_STRING: 40}
+
+# Default model parameters
+LATENCY = 0.002  # seconds per put round trip
+BANDWIDTH = 10.0e6  # bytes per second
+DEFAULT_SLEEP = 1.0  # seconds
+
+
+class PvCost:
+    """
+    Counters for a block of puts (a group, or the statements outside groups)
+    """
+
+    def __init__(self, name='', line_number=0):
+        self.name = name
+        self.line_number = line_number
+        self.puts = 0
+        self.elements = 0
+        self.bytes = 0
+        self.round_trips = 0
+
+    def add(self, other):
+        self.puts += other.puts
+        self.elements += other.elements
+        self.bytes += other.bytes
+        self.round_trips += other.round_trips
+
+    def time(self, latency, bandwidth):
+        """
+        :return: estimated time in seconds
+        :rtype: float
+        """
+        return self.round_trips * latency + self.bytes / float(bandwidth)
+
+
+class PvEstimator(PvHandler):
+    """
+    Parser handler that accumulates the cost of executing the files
+    """
+
+    def __init__(self, latency=LATENCY, bandwidth=BANDWIDTH, default_sleep=DEFAULT_SLEEP):
+        """
+        :param latency: put round trip latency in seconds
+        :type latency: float
+        :param bandwidth: bandwidth in bytes per second
+        :type bandwidth: float
+        :param default_sleep: time used for sleep statements with no time
+        :type default_sleep: float
+        """
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.default_sleep = default_sleep
+        self.sleeps = 0
+        self.sleep_time = 0.0
+        self.single_cost = PvCost('outside groups')  # statements outside groups
+        self.group_list = []  # PvCost for every group
+        self.group = None  # current group
+
+    def pv_file_end(self, parser):
+        if self.group is not None:  # group not closed because of a syntax error
+            self.pv_group_end(parser)
+
+    def pv_group_start(self, parser):
+        line_number, line_text = parser.lex.get_last_line()
+        self.group = PvCost(parser.file_name + ':' + str(line_number), line_number)
+        self.group.round_trips = 1
+
+    def pv_group_end(self, parser):
+        self.group_list.append(self.group)
+        self.group = None
+
+    def pv_sleep(self, parser, sleep_time):
+        self.sleeps += 1
+        self.sleep_time += self.default_sleep if sleep_time is None else sleep_time
+
+    def pv_single(self, parser):
+        """
+        Add the cost of a single statement
+        :param parser: parser
+        :type parser: PvParser
+        :return: list of warning messages
+        :rtype: list
+        """
+        elements = max(parser.single_count, len(parser.single_value_list))
+        cost = self.group if self.group is not None else self.single_cost
+        cost.puts += 1
+        cost.elements += elements
+        cost.bytes += elements * ELEMENT_SIZE[parser.single_basic_type()]
+        if self.group is None:
+            cost.round_trips += 1
+        return []
+
+    def total(self):
+        """
+        :return: cost of all the puts
+        :rtype: PvCost
+        """
+        total = PvCost('total')
+        total.add(self.single_cost)
+        for group in self.group_list:
+            total.add(group)
+        return total
+
+    def time(self):
+        """
+        :return: estimated execution time in seconds
+        :rtype: float
+        """
+        return self.total().time(self.latency, self.bandwidth) + self.sleep_time
+
+    def report(self, f_out, show_groups=True):
+        """
+        Write a report with the estimate
+        :param f_out: output file
+        :type f_out: file
+        :param show_groups: include the breakdown per group
+        :type show_groups: bool
+        :return: None
+        """
+        total = self.total()
+        f_out.write('puts:            {0}\n'.format(total.puts))
+        f_out.write('elements:        {0}\n'.format(total.elements))
+        f_out.write('bytes:           {0}\n'.format(total.bytes))
+        f_out.write('groups:          {0}\n'.format(len(self.group_list)))
+        f_out.write('sleeps:          {0} ({1:.3f} s)\n'.format(self.sleeps, self.sleep_time))
+        f_out.write('model:           {0:g} s latency, {1:g} bytes/s\n'.format(self.latency, self.bandwidth))
+        f_out.write('estimated time:  {0:.3f} s\n'.format(self.time()))
+        if show_groups:
+            f_out.write('\n{0:<40} {1:>8} {2:>10} {3:>10}\n'.format('block', 'puts', 'elements', 'time (s)'))
+            for cost in [self.single_cost] + self.group_list:
+                f_out.write('{0:<40} {1:>8} {2:>10} {3:>10.3f}\n'.format(cost.name, cost.puts, cost.elements,
+                                                                        cost.time(self.latency, self.bandwidth)))
@@ -0,0 +1,366 @@
+"""
+Rewriting of pvload files in canonical or compact form.
+
+The formatter is a parser handler, so the output is written as the statements are
+recognized and memory use does not depend on the file size. Values are written with
+the scales and units applied, and blank lines and padding are removed. Comments are
+kept unless requested otherwise.
+
+The compact form also drops the indices that just count 0..n-1, the array count when
+it's 1 and all the optional white space, and writes numbers in their shortest form:
+
+    double arr1.VAL[3]={0.1,0.2,0.3};
+
+The output is checked by parsing it again: the digest of the statements found in the
+output (see PvDigest) must be the same as the digest of the input. The output file is
+only replaced, or copied to the standard output, once it has been checked.
+"""
+import os
+import sys
+import shutil
+import hashlib
+import tempfile
+from fractions import Fraction
+
+from pvhandler import PvHandler
+from pvparser import PvParser, TYPE_INTEGER, TYPE_STRING
+from pvscale import to_int, NO_SCALE
+from pvcompress import file_compression
+from pvformat import format_float, format_non_finite
+
+
+def compact_float(value):
+    """
+    Short text of a real value that reads back as the same value
+    (e.g. 5.0 -> '5', 1e-05 -> '1e-5', 4500000.0 -> '45e5').
+    :param value: value
+    :type value: float
+    :rtype: str
+    """
+    text = format_non_finite(float(value), '')
+    if text is not None:
+        return text
+    text = repr(float(value))
+    mantissa, e, exponent = text.partition('e')
+    exponent = int(exponent) if e else 0
+    if mantissa.endswith('.0'):
+        mantissa = mantissa[:-2]
+        digits = mantissa.rstrip('0')
+        if len(mantissa) - len(digits) > 2:
+            exponent += len(mantissa) - len(digits)
+            mantissa = digits
+    return mantissa + 'e' + str(exponent) if exponent else mantissa
+
+
+def exact_integers(value_list, scale_list):
+    """
+    Check whether the values of an integer statement are whole numbers once the scales
+    are applied, so that writing the evaluated values does not truncate them
+    (e.g. 7 / 2 or 3.5 in a long statement are not).
+    The check is done with exact fractions: when the exact result is a whole number,
+    the floating point evaluation gives that same number.
+    :param value_list: list of value constants, as returned by the lexer
+    :type value_list: list
+    :param scale_list: list of (operator, operand) scales, one per value
+    :type scale_list: list
+    :rtype: bool
+    """
+    for value, (operator, operand) in zip(value_list, scale_list):
+        try:
+            number = Fraction(value)
+        except ValueError:
+            number = Fraction(to_int(value))  # hexadecimal constant
+        scaled = number / Fraction(operand) if operator == '/' else number * Fraction(operand)
+        if number.denominator != 1 or scaled.denominator != 1:
+            return False
+    return True
+
+
+def _operand_text(operand):
+    """
+    :return: text of a scale operand, as written in the input (integers without a decimal point)
+    :rtype: str
+    """
+    return repr(operand) if isinstance(operand, float) else str(operand)
+
+
+def normalized_indices(index_list, value_count):
+    """
+    Return the index list of a statement, or an empty list if the indices just
+    count 0..n-1 and can be dropped.
+    :param index_list: list of indices
+    :type index_list: list
+    :param value_count: number of values
+    :type value_count: int
+    :rtype: list
+    """
+    if index_list == list(range(value_count)):
+        return []
+    return index_list
+
+
+def _value_list(parser):
+    """
+    :return: evaluated values of the single statement as a list, or None on type mismatch
+    :rtype: list
+    """
+    value_list = parser.evaluate_single()
+    if value_list is not None and not isinstance(value_list, list):
+        value_list = value_list.tolist()  # numpy array
+    return value_list
+
+
+class PvDigest(PvHandler):
+    """
+    Parser handler that computes a digest of what a file does: the groups, sleeps and
+    single statements with their evaluated values. Two files with the same digest
+    have the same meaning, regardless of formatting, comments or scales.
+    """
+
+    def __init__(self):
+        self.sha = hashlib.sha1()
+
+    def _update(self, item):
+        text = repr(item)
+        if not isinstance(text, bytes):
+            text = text.encode('utf-8')
+        self.sha.update(text + b'\n')
+
+    def pv_group_start(self, parser):
+        self._update('group {')
+
+    def pv_group_end(self, parser):
+        self._update('}')
+
+    def pv_sleep(self, parser, sleep_time):
+        self._update(('sleep', sleep_time))
+
+    def pv_single(self, parser):
+        """
+        Add the single statement to the digest
+        :param parser: parser
+        :type parser: PvParser
+        :return: list of warning messages
+        :rtype: list
+        """
+        value_list = _value_list(parser)
+        if value_list is None:
+            value_list = ('raw', parser.single_value_list, parser.single_scale_list)
+        index_list = normalized_indices(parser.single_index_list, len(parser.single_value_list))
+        self._update((parser.single_percent, parser.single_type_name, parser.single_name,
+                      parser.single_count, index_list, value_list))
+        return []
+
+    def hexdigest(self):
+        return self.sha.hexdigest()
+
+
+class PvFormatter(PvHandler):
+    """
+    Parser handler that writes the items in canonical or compact form
+    """
+
+    def __init__(self, f_out, compact=False, keep_comments=True):
+        """
+        :param f_out: output file
+        :type f_out: file
+        :param compact: write the compact form
+        :type compact: bool
+        :param keep_comments: copy the comments to the output
+        :type keep_comments: bool
+        """
+        self.f_out = f_out
+        self.compact = compact
+        self.keep_comments = keep_comments
+        self.indent = ''
+        self.skipped = 0  # statements that could not be formatted
+        # The last item is written when the next one is found, so a comment that
+        # follows it in the same line can be appended to it.
+        self.pending = None  # (line number, text)
+
+    def _flush(self, parser):
+        """
+        Write the pending item and the comments found before the current item
+        """
+        comment_list = parser.lex.comment_list
+        parser.lex.comment_list = []
+        if self.pending is not None:
+            line_number, text = self.pending
+            if comment_list and comment_list[0][0] == line_number:
+                text += (' ' if self.compact else '  ') + comment_list.pop(0)[1]
+            self.f_out.write(text + '\n')
+            self.pending = None
+        for line_number, comment in comment_list:
+            self.f_out.write(self.indent + comment + '\n')
+
+    def _write(self, parser, text):
+        self._flush(parser)
+        self.pending = (parser.lex.line_number, self.indent + text)
+
+    def pv_file_start(self, parser):
+        parser.lex.keep_comments = self.keep_comments
+
+    def pv_file_end(self, parser):
+        self._flush(parser)
+        parser.lex.keep_comments = False
+
+    def pv_group_start(self, parser):
+        self._write(parser, 'group{' if self.compact else 'group {')
+        if not self.compact:
+            self.indent = '    '
+
+    def pv_group_end(self, parser):
+        self._flush(parser)
+        self.indent = ''
+        self._write(parser, '}')
+
+    def pv_sleep(self, parser, sleep_time):
+        if sleep_time is None:
+            self._write(parser, 'sleep;')
+        else:
+            self._write(parser, 'sleep ' + self.format_number(sleep_time) + ';')
+
+    def pv_single(self, parser):
+        """
+        Write the single statement
+        :param parser: parser
+        :type parser: PvParser
+        :return: list of warning messages
+        :rtype: list
+        """
+        index_count = len(parser.single_index_list)
+        if index_count and index_count != len(parser.single_value_list):
+            # the parser does not keep which values have an index
+            self.skipped += 1
+            return [('statement_skipped', 'statement not formatted (some values have no index)')]
+        self._write(parser, self.format_single(parser))
+        return []
+
+    def format_number(self, value):
+        return compact_float(value) if self.compact else format_float(value)
+
+    def format_value(self, data_type, value):
+        """
+        Format an evaluated value
+        :param data_type: basic data type
+        :type data_type: int
+        :param value: value
+        :rtype: str
+        """
+        if data_type == TYPE_STRING:
+            return '"' + value + '"'
+        elif data_type == TYPE_INTEGER:
+            return str(int(value))
+        else:
+            return self.format_number(value)
+
+    def format_single(self, parser):
+        """
+        Format the single statement found by the parser. Values that do not match the
+        statement type cannot be evaluated, so they are written as they are, followed
+        by their scale factor. So are the values of integer statements that the evaluation
+        would truncate (e.g. 7 / 2).
+        :param parser: parser
+        :type parser: PvParser
+        :return: statement text (without end of line)
+        :rtype: str
+        """
+        data_type = parser.single_basic_type()
+        value_list = _value_list(parser)
+        if data_type == TYPE_INTEGER and value_list is not None and \
+                not exact_integers(parser.single_value_list, parser.single_scale_list):
+            value_list = None  # keep the values and scales as they are
+        if value_list is None:
+            space = '' if self.compact else ' '
+            text_list = [value + ('' if scale == NO_SCALE else space + scale[0] + space + _operand_text(scale[1]))
+                         for value, scale in zip(parser.single_value_list, parser.single_scale_list)]
+        else:
+            text_list = [self.format_value(data_type, value) for value in value_list]
+
+        index_list = parser.single_index_list
+        if self.compact:
+            index_list = normalized_indices(index_list, len(text_list))
+        space = '' if self.compact else ' '
+        if index_list:
+            text_list = ['[' + str(index) + ']' + space + text for index, text in zip(index_list, text_list)]
+
+        head = '%' if parser.single_percent else ''
+        if parser.single_type_name:
+            head += parser.single_type_name + ' '
+        head += parser.single_name
+        if parser.single_count != 1:
+            head += '[' + str(parser.single_count) + ']'
+        if len(text_list) == 1 and not index_list:
+            body = text_list[0]
+        else:
+            body = '{' + space + (',' + space).join(text_list) + space + '}'
+        return head + space + '=' + space + body + ';'
+
+
+def format_file(input_file_name, output_file_name=None, compact=False, keep_comments=True, verify=True,
+                message_file=None):
+    """
+    Rewrite a pvload file in canonical or compact form. The output is written to a
+    temporary file, checked and then renamed (or copied to the standard output).
+    :param input_file_name: input file name
+    :type input_file_name: str
+    :param output_file_name: output file name (None for the standard output)
+    :type output_file_name: str
+    :param compact: write the compact form
+    :type compact: bool
+    :param keep_comments: copy the comments to the output
+    :type keep_comments: bool
+    :param verify: check that the output has the same meaning as the input
+    :type verify: bool
+    :param message_file: file for the parser messages (default: standard error)
+    :type message_file: file
+    :return: input and output size in bytes
+    :rtype: tuple
+    :raises: IOError, ValueError if the input has errors, the output is different
+             or a compressed file would be replaced
+    """
+    if message_file is None:
+        message_file = sys.stderr
+    if output_file_name and file_compression(input_file_name) is not None and \
+            os.path.abspath(output_file_name) == os.path.abspath(input_file_name):
+        # the output is always text, it would replace the archive with an uncompressed file
+        raise ValueError(input_file_name + ': compressed files cannot be formatted in place')
+    output_dir = os.path.dirname(os.path.abspath(output_file_name)) if output_file_name else None
+    fd, temp_file_name = tempfile.mkstemp(suffix='.pv', dir=output_dir)
+    try:
+        f_out = os.fdopen(fd, 'w')
+        digest = PvDigest()
+        pv_parser = PvParser(message_file=message_file)
+        formatter = PvFormatter(f_out, compact, keep_comments)
+        pv_parser.add_handler(digest)
+        pv_parser.add_handler(formatter)
+        found = pv_parser.pv_file(input_file_name)
+        f_out.close()
+        if not found:
+            raise IOError('cannot read ' + input_file_name)
+        if pv_parser.errors:
+            raise ValueError(input_file_name + ': ' + str(pv_parser.errors) + ' syntax errors, file not formatted')
+        if formatter.skipped:
+            raise ValueError(input_file_name + ': ' + str(formatter.skipped) + ' statements cannot be formatted, '
+                             'file not formatted')
+
+        if verify:
+            output_digest = PvDigest()
+            with open(os.devnull, 'w') as f_null:
+                pv_parser = PvParser(message_file=f_null)
+                pv_parser.add_handler(output_digest)
+                pv_parser.pv_file(temp_file_name)
+            if pv_parser.errors or output_digest.hexdigest() != digest.hexdigest():
+                raise ValueError(input_file_name + ': the formatted file does not match the input, file not formatted')
+
+        sizes = (os.path.getsize(input_file_name), os.path.getsize(temp_file_name))
+        if output_file_name:
+            shutil.copymode(input_file_name, temp_file_name)
+            os.rename(temp_file_name, output_file_name)
+        else:
+            with open(temp_file_name, 'r') as f_in:
+                shutil.copyfileobj(f_in, sys.stdout)
+        return sizes
+    finally:
+        if os.path.exists(temp_file_name):
+            os.remove(temp_file_name)
@@ -0,0 +1,115 @@
+"""
+Output of single statements in canonical pvload form: basic type names, values
+with the scale applied, no padding and one statement per line, e.g.
+
+    double arr1.VAL[3] = { 0.1, 0.2, 0.3 };
+    long arr2[2] = { [0] 4, [1] 6 };
+    string $(sadtop)cc:name.VAL = "GBD";
+
+Statements with no type are written with no type. Infinity and nan have no constant
+in pvload files, so they are written as expressions that evaluate to them.
+"""
+from pvparser import TYPE_NONE, TYPE_INTEGER, TYPE_FLOAT, TYPE_STRING
+from pvscale import expand_indices
+
+# Canonical pvload type names for each basic type
+TYPE_NAMES = {TYPE_NONE: '', TYPE_INTEGER: 'long', TYPE_FLOAT: 'double', TYPE_STRING: 'string'}
+
+INFINITY = float('inf')
+
+
+def format_non_finite(value, space=' '):
+    """
+    Text of an infinite or nan value that reads back as the same value: 1e999 is
+    out of the float range and reads as infinity, and infinity times zero is nan.
+    :param value: value
+    :type value: float
+    :param space: white space around the '*' operator
+    :type space: str
+    :return: value text, or None if the value is finite
+    :rtype: str
+    """
+    if value != value:
+        return '1e999' + space + '*' + space + '0'
+    elif value == INFINITY:
+        return '1e999'
+    elif value == -INFINITY:
+        return '-1e999'
+    return None
+
+
+def format_float(value):
+    """
+    Canonical text of a real value: the shortest text that reads back as the same
+    value, written with a decimal point, in exponent form when that is shorter
+    (e.g. 0.1 -> '0.1', 100.0 -> '100.0', 450000000.0 -> '4.5e8').
+    :param value: value
+    :type value: float
+    :rtype: str
+    """
+    value = float(value)
+    text = format_non_finite(value)
+    if text is not None:
+        return text
+    text = repr(value)
+    for precision in range(17):
+        exponent_text = '%.*e' % (precision, value)
+        if float(exponent_text) == value:
+            break
+    mantissa, e, exponent = exponent_text.partition('e')
+    if '.' not in mantissa:
+        mantissa += '.0'
+    exponent_text = mantissa + 'e' + str(int(exponent))
+    return exponent_text if len(exponent_text) < len(text) else text
+
+
+def format_value(data_type, value):
+    """
+    Format a single value in canonical form
+    :param data_type: basic data type (TYPE_NONE for a statement with no type, which
+                      has string or float values)
+    :type data_type: int
+    :param value: value
+    :return: value text
+    :rtype: str
+    """
+    if data_type == TYPE_STRING or (data_type == TYPE_NONE and isinstance(value, str)):
+        return '"' + value + '"'
+    elif data_type == TYPE_INTEGER:
+        return str(int(value))
+    else:
+        return format_float(value)
+
+
+def format_single(data_type, name, count, index_list, value_list):
+    """
+    Format a single statement in canonical form.
+    The array count is only written for arrays, and the value list is enclosed in
+    braces whenever there is more than one value or the values have indices.
+    :param data_type: basic data type (TYPE_NONE for a statement with no type)
+    :type data_type: int
+    :param name: pv name
+    :type name: str
+    :param count: array size
+    :type count: int
+    :param index_list: list of indices (empty if not used), one per value or for the
+                       first values (see expand_indices)
+    :type index_list: list
+    :param value_list: list of values (already scaled)
+    :type value_list: list
+    :return: statement text (without end of line)
+    :rtype: str
+    """
+    value_text_list = [format_value(data_type, value) for value in value_list]
+    index_list = expand_indices(index_list, len(value_list))
+    if index_list:
+        value_text_list = ['[' + str(index) + '] ' + text for index, text in zip(index_list, value_text_list)]
+    type_name = TYPE_NAMES[data_type]
+    head = (type_name + ' ' if type_name else '') + name
+    if count > 1:
+        head += '[' + str(count) + ']'
+    if len(value_text_list) == 1 and not index_list:
+        body = value_text_list[0]
+    else:
+        body = '{ ' + ', '.join(value_text_list) + ' }'
+    return head + ' = ' + body + ';'
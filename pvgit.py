@@ -0,0 +1,57 @@
+"""
+Selection of the pvload files changed in a local git repository, used to check only
+the files touched by a commit or a branch (e.g. in a pre-commit hook or a CI job).
+
+The changed files are the ones that differ between a revision and the working tree
+(committed, staged or not), plus the new files not yet added to the repository.
+Deleted files are left out. Only the local repository is used, no remote is contacted.
+"""
+import os
+import subprocess
+
+from pvindex import PV_EXTENSIONS
+
+
+def _git(arg_list):
+    """
+    Run a git command in the current directory
+    :param arg_list: git arguments
+    :type arg_list: list
+    :return: standard output
+    :rtype: str
+    :raises: OSError if git cannot be run, ValueError if the command fails
+    """
+    process = subprocess.Popen(['git'] + arg_list, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = process.communicate()
+    if process.returncode != 0:
+        raise ValueError('git ' + arg_list[0] + ': ' + err.decode('utf-8', 'replace').strip())
+    return out.decode('utf-8')
+
+
+def changed_files(revision, path_list=None):
+    """
+    Return the pvload files that changed since a revision
+    :param revision: git revision (e.g. HEAD, origin/master or a commit id)
+    :type revision: str
+    :param path_list: files and directories the search is limited to (None for the whole repository)
+    :type path_list: list
+    :return: sorted list of file names, relative to the current directory
+    :rtype: list
+    :raises: OSError if git cannot be run, ValueError if the revision is not valid
+    """
+    path_spec = ['--'] + (path_list if path_list else [])
+    top = _git(['rev-parse', '--show-toplevel']).strip()
+    try:
+        _git(['rev-parse', '--verify', '--quiet', revision + '^{commit}'])
+    except ValueError:
+        raise ValueError('unknown revision ' + revision)
+    name_list = _git(['diff', '--name-only', '--diff-filter=d', '-z', revision] + path_spec).split('\0')
+    name_list += _git(['ls-files', '--others', '--exclude-standard', '--full-name', '-z'] + path_spec).split('\0')
+
+    file_list = []
+    for name in name_list:
+        if name and name.endswith(tuple(PV_EXTENSIONS)):
+            file_name = os.path.join(top, name)
+            if os.path.isfile(file_name):
+                file_list.append(os.path.relpath(file_name))
+    return sorted(set(file_list))
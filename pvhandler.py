@@ -0,0 +1,69 @@
+class PvHandler:
+    """
+    Base class for the objects that process the items found by the parser.
+    Handlers are registered with PvParser.add_handler() and are called in the order
+    they were added, every time the parser recognizes a complete item. The parser is
+    passed to all the routines so the handler can access the parser state (e.g. the
+    single statement data).
+    Routines that check the items return a list of (kind, warning message) tuples,
+    which are reported by the parser. An empty list (or None) means no warnings.
+    """
+
+    def pv_file_start(self, parser):
+        """
+        Called before parsing a file
+        :param parser: parser
+        :type parser: PvParser
+        :return: None
+        """
+        pass
+
+    def pv_file_end(self, parser):
+        """
+        Called after parsing a file
+        :param parser: parser
+        :type parser: PvParser
+        :return: None
+        """
+        pass
+
+    def pv_group_start(self, parser):
+        """
+        Called after the start of a group
+        :param parser: parser
+        :type parser: PvParser
+        :return: None
+        """
+        pass
+
+    def pv_group_end(self, parser):
+        """
+        Called after the end of a group
+        :param parser: parser
+        :type parser: PvParser
+        :return: None
+        """
+        pass
+
+    def pv_sleep(self, parser, sleep_time):
+        """
+        Called after a sleep statement
+        :param parser: parser
+        :type parser: PvParser
+        :param sleep_time: sleep time in seconds (None if not specified)
+        :type sleep_time: float
+        :return: None
+        """
+        pass
+
+    def pv_single(self, parser):
+        """
+        Called after a single statement is checked. The statement data is available
+        in the parser single_* attributes. Warnings are returned as (kind, message)
+        tuples, where kind is a fixed identifier used to count them (e.g. in the metrics).
+        :param parser: parser
+        :type parser: PvParser
+        :return: list of (kind, warning message) tuples
+        :rtype: list
+        """
+        return []
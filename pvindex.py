@@ -0,0 +1,418 @@
+"""
+Index of the pvs written by a tree of pvload files, used to find which files set
+which pvs without parsing the files again.
+
+The index keeps, for every single statement, the pv name (as written, with the
+macros not expanded), the file, the line where the statement starts, the type and
+the number of elements. Entries are sorted by pv name, so prefix and glob queries
+only look at the names that share the literal prefix of the pattern. The file is
+memory mapped and searched in place, so a query only reads the few pages it needs:
+
+    magic           8 bytes 'PVINDX01'
+    header          4 little endian uint32: number of entries, number of files,
+                    file table bytes, name bytes
+    file table      utf-8 JSON list of [file name, mtime, size]
+    name offsets    uint32 x (entries + 1)
+    names           utf-8 bytes
+    entries         one column per field: file (uint32), line (uint32),
+                    count (uint32), type (uint8)
+
+Every section starts at a multiple of 8 bytes. The index is updated incrementally:
+only the files whose modification time or size changed are parsed again.
+"""
+import os
+import json
+import mmap
+import struct
+import fnmatch
+import tempfile
+
+from pvhandler import PvHandler
+from pvparser import PvParser
+
+MAGIC = b'PVINDX01'
+HEADER_FORMAT = '<4I'
+ALIGNMENT = 8
+
+# File extensions of the pvload files searched for in directories
+# (compressed files are read as well, see pvcompress)
+PV_EXTENSIONS = ['.pv', '.pv.gz', '.pv.xz', '.pv.bz2']
+
+# Type names, as written in the files, stored as their position in this list
+TYPE_NAME_LIST = ['', 'string', 'int', 'short', 'float', 'enum', 'char', 'long', 'double']
+TYPE_CODES = dict([(name, code) for code, name in enumerate(TYPE_NAME_LIST)])
+
+# Entry columns after the names, with their struct format
+COLUMNS = [
+    ('file', 'I'),
+    ('line', 'I'),
+    ('count', 'I'),
+    ('type', 'B'),
+]
+
+# Characters that start a wildcard in a glob pattern
+GLOB_CHARACTERS = '*?['
+
+
+def _to_bytes(text):
+    return text if isinstance(text, bytes) else text.encode('utf-8')
+
+
+def _from_bytes(data):
+    return data if str is bytes else data.decode('utf-8')
+
+
+def _padding(size):
+    return b'\0' * (-size % ALIGNMENT)
+
+
+def find_pv_files(path_list):
+    """
+    Expand a list of files and directories into a list of pvload files.
+    Directories are searched recursively.
+    :param path_list: list of file and directory names
+    :type path_list: list
+    :return: sorted list of absolute file names
+    :rtype: list
+    """
+    file_list = []
+    for path in path_list:
+        if os.path.isdir(path):
+            for dir_path, dir_names, file_names in os.walk(path):
+                for file_name in file_names:
+                    if file_name.endswith(tuple(PV_EXTENSIONS)):
+                        file_list.append(os.path.abspath(os.path.join(dir_path, file_name)))
+        else:
+            file_list.append(os.path.abspath(path))
+    return sorted(set(file_list))
+
+
+def literal_prefix(pattern):
+    """
+    Return the part of a glob pattern before the first wildcard
+    :param pattern: glob pattern
+    :type pattern: str
+    :rtype: str
+    """
+    for i, c in enumerate(pattern):
+        if c in GLOB_CHARACTERS:
+            return pattern[:i]
+    return pattern
+
+
+def duplicate_message(name, file_name, line_number):
+    """
+    Warning message for a pv that is also set in another file
+    :param name: pv name
+    :type name: str
+    :param file_name: the other file
+    :type file_name: str
+    :param line_number: line of the statement in the other file
+    :type line_number: int
+    :rtype: str
+    """
+    return name + ' is also set in ' + os.path.relpath(file_name) + ', line ' + str(line_number)
+
+
+class PvIndexCollector(PvHandler):
+    """
+    Parser handler that collects the index entries of a file
+    """
+
+    def __init__(self):
+        self.entry_list = []  # (name, line, count, type code)
+
+    def pv_file_start(self, parser):
+        self.entry_list = []
+
+    def pv_single(self, parser):
+        """
+        Add an entry for the single statement
+        :param parser: parser
+        :type parser: PvParser
+        :return: list of warning messages
+        :rtype: list
+        """
+        count = max(parser.single_count, len(parser.single_value_list))
+        self.entry_list.append((parser.single_name, parser.single_line_number, count,
+                                TYPE_CODES.get(parser.single_type_name, 0)))
+        return []
+
+
+class PvIndex:
+    """
+    Index reader. The file is memory mapped and searched in place.
+    """
+
+    def __init__(self, file_name):
+        """
+        :param file_name: index file name
+        :type file_name: str
+        :raises: IOError, ValueError if the file is not an index
+        """
+        self.file_name = file_name
+        with open(file_name, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.data) < len(MAGIC) + struct.calcsize(HEADER_FORMAT) or self.data[:len(MAGIC)] != MAGIC:
+            self.data.close()
+            raise ValueError(file_name + ' is not an index file')
+        self.n_entries, n_files, file_table_bytes, name_bytes = struct.unpack_from(HEADER_FORMAT, self.data,
+                                                                                   len(MAGIC))
+        pos = len(MAGIC) + struct.calcsize(HEADER_FORMAT)
+        self.file_list = json.loads(_from_bytes(self.data[pos:pos + file_table_bytes]))
+        pos += file_table_bytes
+        pos += -pos % ALIGNMENT
+        self.offsets_pos = pos
+        pos += 4 * (self.n_entries + 1)
+        pos += -pos % ALIGNMENT
+        self.names_pos = pos
+        pos += name_bytes
+        pos += -pos % ALIGNMENT
+        self.columns = {}
+        for name, fmt in COLUMNS:
+            self.columns[name] = (pos, '<' + fmt, struct.calcsize(fmt))
+            pos += struct.calcsize(fmt) * self.n_entries
+            pos += -pos % ALIGNMENT
+        if pos > len(self.data) or len(self.file_list) != n_files:
+            self.data.close()
+            raise ValueError(file_name + ' is truncated')
+
+    def __len__(self):
+        return self.n_entries
+
+    def close(self):
+        self.data.close()
+
+    def _value(self, column, i):
+        pos, fmt, size = self.columns[column]
+        return struct.unpack_from(fmt, self.data, pos + size * i)[0]
+
+    def _name_bytes(self, i):
+        start, end = struct.unpack_from('<2I', self.data, self.offsets_pos + 4 * i)
+        return self.data[self.names_pos + start:self.names_pos + end]
+
+    def __getitem__(self, i):
+        """
+        Return an entry
+        :param i: entry number
+        :type i: int
+        :return: pv name, file name, line number, type name and number of elements
+        :rtype: tuple
+        """
+        if i < 0 or i >= self.n_entries:
+            raise IndexError('entry number out of range')
+        return (_from_bytes(self._name_bytes(i)), self.file_list[self._value('file', i)][0],
+                self._value('line', i), TYPE_NAME_LIST[self._value('type', i)], self._value('count', i))
+
+    def lower_bound(self, prefix):
+        """
+        Binary search for the first entry whose name is not smaller than a prefix
+        :param prefix: name prefix
+        :type prefix: str
+        :return: entry number
+        :rtype: int
+        """
+        key = _to_bytes(prefix)
+        lo, hi = 0, self.n_entries
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._name_bytes(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def lookup(self, name):
+        """
+        Find the entries of a pv name (no wildcards)
+        :param name: pv name
+        :type name: str
+        :return: iterator of (name, file name, line number, type name, count) tuples
+        """
+        key = _to_bytes(name)
+        for i in range(self.lower_bound(key), self.n_entries):
+            if self._name_bytes(i) != key:
+                break
+            yield self[i]
+
+    def query(self, pattern):
+        """
+        Find the entries whose pv name matches a glob pattern ('*', '?' and '[...]').
+        :param pattern: glob pattern, or a name to look for an exact match
+        :type pattern: str
+        :return: iterator of (name, file name, line number, type name, count) tuples, sorted by name
+        """
+        prefix = _to_bytes(literal_prefix(pattern))
+        for i in range(self.lower_bound(prefix), self.n_entries):
+            name = self._name_bytes(i)
+            if not name.startswith(prefix):
+                break
+            if fnmatch.fnmatchcase(_from_bytes(name), pattern):
+                yield self[i]
+
+    def file_entries(self):
+        """
+        Return the entries grouped by file, as needed to update the index
+        :return: dictionary file name -> ((mtime, size), entry list)
+        :rtype: dict
+        """
+        file_map = {}
+        for file_name, mtime, size in self.file_list:
+            file_map[file_name] = ((mtime, size), [])
+        for i in range(self.n_entries):
+            file_name = self.file_list[self._value('file', i)][0]
+            file_map[file_name][1].append((_from_bytes(self._name_bytes(i)), self._value('line', i),
+                                           self._value('count', i), self._value('type', i)))
+        return file_map
+
+
+class PvDuplicateCheck(PvHandler):
+    """
+    Parser handler that warns about pvs set by more than one file. The pvs are looked
+    up in the files checked in the same run and, when an index is given, in the
+    indexed files, so a few changed files can be checked against a whole tree without
+    parsing it again. The index entries of the checked files, and of the files that
+    no longer exist, are ignored since they may be out of date.
+    """
+
+    def __init__(self, index=None, checked_list=None):
+        """
+        :param index: index of the other files (None to only compare the checked files)
+        :type index: PvIndex
+        :param checked_list: names of the files that are going to be checked
+        :type checked_list: list
+        """
+        self.index = index
+        self.ignored_set = set([os.path.abspath(file_name) for file_name in (checked_list or [])])
+        self.stale_files = 0  # indexed files modified after the index was written
+        if index is not None:
+            for file_name, mtime, size in index.file_list:
+                try:
+                    st = os.stat(file_name)
+                except OSError:
+                    self.ignored_set.add(file_name)
+                    continue
+                if file_name not in self.ignored_set and (st.st_mtime, st.st_size) != (mtime, size):
+                    self.stale_files += 1
+        self.seen_map = {}  # pv name -> (file name, line number) of the first statement checked
+        self.file_name = ''
+
+    def pv_file_start(self, parser):
+        self.file_name = os.path.abspath(parser.file_name)
+
+    def pv_single(self, parser):
+        """
+        Check whether the pv is also set by another file
+        :param parser: parser
+        :type parser: PvParser
+        :return: list of warning messages
+        :rtype: list
+        """
+        name = parser.single_name
+        if name in self.seen_map:
+            file_name, line_number = self.seen_map[name]
+            if file_name != self.file_name:
+                return [('duplicate_pv', duplicate_message(name, file_name, line_number))]
+            return []
+        self.seen_map[name] = (self.file_name, parser.single_line_number)
+        if self.index is not None:
+            for entry in self.index.lookup(name):
+                file_name, line_number = entry[1], entry[2]
+                if file_name != self.file_name and file_name not in self.ignored_set:
+                    return [('duplicate_pv', duplicate_message(name, file_name, line_number))]
+        return []
+
+
+def write_index(file_name, file_map):
+    """
+    Write an index file. The file is written under a temporary name and renamed,
+    so readers never see a partial index.
+    :param file_name: index file name
+    :type file_name: str
+    :param file_map: dictionary file name -> ((mtime, size), entry list)
+    :type file_map: dict
+    :return: None
+    """
+    file_list = sorted(file_map)
+    entry_list = []
+    for file_id, pv_file_name in enumerate(file_list):
+        for name, line, count, type_code in file_map[pv_file_name][1]:
+            entry_list.append((_to_bytes(name), file_id, line, count, type_code))
+    entry_list.sort()
+
+    file_table = _to_bytes(json.dumps([[name, file_map[name][0][0], file_map[name][0][1]] for name in file_list]))
+    name_data = b''.join([entry[0] for entry in entry_list])
+    offsets = [0]
+    for entry in entry_list:
+        offsets.append(offsets[-1] + len(entry[0]))
+
+    chunks = [MAGIC, struct.pack(HEADER_FORMAT, len(entry_list), len(file_list), len(file_table), len(name_data))]
+    chunks += [file_table, _padding(len(MAGIC) + struct.calcsize(HEADER_FORMAT) + len(file_table))]
+    chunks += [struct.pack('<' + str(len(offsets)) + 'I', *offsets), _padding(4 * len(offsets))]
+    chunks += [name_data, _padding(len(name_data))]
+    for column, (name, fmt) in enumerate(COLUMNS):
+        data = struct.pack('<' + str(len(entry_list)) + fmt, *[entry[column + 1] for entry in entry_list])
+        chunks += [data, _padding(len(data))]
+
+    fd, temp_file_name = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(file_name)))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(temp_file_name, 0o666 & ~umask)
+        os.rename(temp_file_name, file_name)
+    finally:
+        if os.path.exists(temp_file_name):
+            os.remove(temp_file_name)
+
+
+def build_index(path_list, index_file_name):
+    """
+    Build or update the index of a list of pvload files and directories.
+    Only the files that changed since the index was written are parsed.
+    :param path_list: list of pvload files and directories
+    :type path_list: list
+    :param index_file_name: index file name
+    :type index_file_name: str
+    :return: number of files, number of files parsed and number of entries
+    :rtype: tuple
+    :raises: IOError, OSError if a file cannot be read or the index cannot be written
+    """
+    signature_map = {}
+    for file_name in find_pv_files(path_list):
+        st = os.stat(file_name)
+        signature_map[file_name] = (st.st_mtime, st.st_size)
+
+    # The entries are only decoded if the index has to be written again
+    try:
+        index = PvIndex(index_file_name)
+        old_signature_map = dict([(name, (mtime, size)) for name, mtime, size in index.file_list])
+        if old_signature_map == signature_map:
+            entries = len(index)
+            index.close()
+            return len(signature_map), 0, entries
+        old_file_map = index.file_entries()
+        index.close()
+    except (IOError, OSError, ValueError):
+        old_file_map = {}
+
+    collector = PvIndexCollector()
+    file_map = {}
+    parsed_files = 0
+    with open(os.devnull, 'w') as f_null:
+        pv_parser = PvParser(message_file=f_null)
+        pv_parser.add_handler(collector)
+        for file_name in sorted(signature_map):
+            signature = signature_map[file_name]
+            if file_name in old_file_map and tuple(old_file_map[file_name][0]) == signature:
+                file_map[file_name] = old_file_map[file_name]
+            else:
+                if not pv_parser.pv_file(file_name):
+                    raise IOError('cannot read ' + file_name)
+                file_map[file_name] = (signature, collector.entry_list)
+                parsed_files += 1
+
+    write_index(index_file_name, file_map)
+    return len(file_map), parsed_files, sum([len(entry_list) for signature, entry_list in file_map.values()])
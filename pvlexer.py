@@ -1,4 +1,5 @@
 import re
+from collections import OrderedDict
 from pvtoken import PvToken
 
 # Token definitions
@@ -32,6 +33,24 @@ TOKEN_RIGHT_BRACKET = 43
 # used to flag unknown tokens
 TOKEN_ERROR = -1
 
+# String literal: the text between two quotes, where a backslash escapes the next
+# character (e.g. "say \"hi\""). The match stops at the first unescaped quote and
+# never backtracks, so it takes linear time even on lines with many quotes or on
+# unterminated strings.
+STRING_PATTERN = r'"[^"\\]*(?:\\.[^"\\]*)*"'
+
+# Token names, used in reports
+TOKEN_NAMES = {
+    TOKEN_EOF: 'eof', TOKEN_COMMENT: 'comment',
+    TOKEN_INTEGER: 'integer', TOKEN_FLOAT: 'float', TOKEN_STRING: 'string', TOKEN_PVNAME: 'pvname',
+    TOKEN_TYPE: 'type', TOKEN_UNIT: 'unit', TOKEN_GROUP: 'group', TOKEN_SLEEP: 'sleep',
+    TOKEN_SEMICOLON: 'semicolon', TOKEN_COMMA: 'comma', TOKEN_EQUALS: 'equals', TOKEN_TIMES: 'times',
+    TOKEN_DIVIDED: 'divided', TOKEN_PERCENT: 'percent',
+    TOKEN_LEFT_BRACE: 'left_brace', TOKEN_RIGHT_BRACE: 'right_brace',
+    TOKEN_LEFT_BRACKET: 'left_bracket', TOKEN_RIGHT_BRACKET: 'right_bracket',
+    TOKEN_ERROR: 'error',
+}
+
 
 class PvLexer:
     # Lexer regular expressions. The order matters!
@@ -39,8 +58,8 @@ class PvLexer:
     lexer_patterns = [
         (r'[\s]+', TOKEN_WHITESPACE),
         (r'-?0[xX][\da-fA-F]+', TOKEN_INTEGER),
-        (r'[-+]?(\d+([.]\d*)?|[.,]\d+)([eE][-+]?\d+)?', TOKEN_NUMBER),
-        (r'".+"', TOKEN_STRING),
+        (r'[-+]?(\d+([.]\d*)?|[.]\d+)([eE][-+]?\d+)?', TOKEN_NUMBER),
+        (STRING_PATTERN, TOKEN_STRING),
         (r'string|int|short|float|enum|char|long|double', TOKEN_TYPE),
         (r'arcsec|deg', TOKEN_UNIT),
         (r'microns|um', TOKEN_UNIT),
@@ -62,74 +81,366 @@ class PvLexer:
         (r'\]', TOKEN_RIGHT_BRACKET),
     ]
 
-    def __init__(self):
+    # Identifier-first mode (the default): a token is recognized by its first character.
+    # Runs of name characters are scanned once and then classified with the keyword
+    # table, so keywords are only recognized as whole words (e.g. 'mirror:pos' is a pv
+    # name, not the unit 'm' followed by 'irror:pos'). Numbers are classified as
+    # integer or real by the same regular expression that finds them.
+    keyword_map = {
+        'string': TOKEN_TYPE, 'int': TOKEN_TYPE, 'short': TOKEN_TYPE, 'float': TOKEN_TYPE,
+        'enum': TOKEN_TYPE, 'char': TOKEN_TYPE, 'long': TOKEN_TYPE, 'double': TOKEN_TYPE,
+        'arcsec': TOKEN_UNIT, 'deg': TOKEN_UNIT, 'microns': TOKEN_UNIT, 'um': TOKEN_UNIT,
+        'millimeters': TOKEN_UNIT, 'millimetres': TOKEN_UNIT, 'mm': TOKEN_UNIT,
+        'meters': TOKEN_UNIT, 'metres': TOKEN_UNIT, 'm': TOKEN_UNIT,
+        'group': TOKEN_GROUP,
+        'sleep': TOKEN_SLEEP,
+    }
+    symbol_map = {
+        ';': TOKEN_SEMICOLON, '=': TOKEN_EQUALS, ',': TOKEN_COMMA, '*': TOKEN_TIMES, '/': TOKEN_DIVIDED,
+        '%': TOKEN_PERCENT, '{': TOKEN_LEFT_BRACE, '}': TOKEN_RIGHT_BRACE, '[': TOKEN_LEFT_BRACKET,
+        ']': TOKEN_RIGHT_BRACKET, '#': TOKEN_COMMENT,
+    }
+    number_start = '0123456789+-.'
+    whitespace_pattern = r'\s+'
+    number_pattern = r'-?0[xX][\da-fA-F]+|[-+]?(?:\d+(?P<point>[.]\d*)?|(?P<fraction>[.]\d+))(?P<exponent>[eE][-+]?\d+)?'
+    name_pattern = r'[\w:\(\)\$]+(\.[\w]+)?'
+    string_pattern = STRING_PATTERN
+
+    # Maximum number of characters read from the input file at a time.
+    # Lines longer than this are lexed in chunks, so memory use is bounded
+    # by the chunk size (plus the longest token) regardless of the line length.
+    chunk_size = 64 * 1024
+
+    # Number of characters that must follow a token in the chunk for the match to
+    # be final. It has to be larger than what any of the patterns looks ahead.
+    token_margin = 16
+
+    # Tokens split between chunks are recognized up to this length (e.g. strings)
+    max_token_length = 4096
+
+    # Maximum number of characters of a line kept for error messages
+    max_line_length = 256
+
+    # Estimated memory used by a line in the token cache, besides the characters of
+    # the line, and by each token of the line, besides its characters (see set_cache_size)
+    cache_line_overhead = 200
+    cache_token_overhead = 160
+
+    # Tokens that have a fixed set of values. Their token objects are shared by all
+    # the lines in the token cache.
+    shared_token_ids = frozenset([TOKEN_TYPE, TOKEN_UNIT, TOKEN_GROUP, TOKEN_SLEEP, TOKEN_SEMICOLON, TOKEN_COMMA,
+                                  TOKEN_EQUALS, TOKEN_TIMES, TOKEN_DIVIDED, TOKEN_PERCENT, TOKEN_LEFT_BRACE,
+                                  TOKEN_RIGHT_BRACE, TOKEN_LEFT_BRACKET, TOKEN_RIGHT_BRACKET])
+
+    def __init__(self, identifier_first=True, cache_size=0):
         """
         Initialize a lex object.
         Compile all the lexer regular expressions for speed.
+        :param identifier_first: use the identifier-first mode, otherwise try the
+                                 lexer_patterns in order for every token
+        :type identifier_first: bool
+        :param cache_size: memory used by the token cache in bytes (0 for no cache, see set_cache_size)
+        :type cache_size: int
         """
         self.last_line = ''
         self.line_number = 0
-        self.token_list = []
+        self.buffer = ''  # current chunk of the line being lexed
+        self.buffer_pos = 0  # position of the next character to lex in the buffer
+        self.line_done = True  # true when the buffer holds the end of the line
+        # True when a string scan found no closing quote in the buffer. Every later quote
+        # in the same buffer is escaped, so no string can start there either and it's not
+        # scanned again. Cleared every time the buffer changes.
+        self.unterminated = False
+        self.keep_comments = False  # keep the comments in comment_list instead of discarding them
+        self.comment_list = []  # (line number, comment text) tuples, consumed by the caller
+
+        # counters for all the files read, never reset
+        self.lines = 0
+        self.characters = 0  # characters read (bytes in python 2)
+        self.token_counts = {}  # token id -> number of tokens (whitespace not included)
+
+        # tokens of the lines seen before, kept across files (see set_cache_size)
+        self.cache = None  # stripped line -> tuple of tokens, least recently used first
+        self.cache_size = 0
+        self.cache_bytes = 0  # estimated memory used by the cache
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.cache_evictions = 0
+        self.shared_tokens = {}  # (token id, text) -> token
+        self.line_tokens = ()  # tokens of the current line, when it's in the cache
+        self.line_token_pos = 0  # position of the next token to return in line_tokens
+
         self.compiled_patterns = []
         for pattern, token_id in self.lexer_patterns:
             self.compiled_patterns.append((re.compile(pattern), token_id))
+        self.whitespace_re = re.compile(self.whitespace_pattern)
+        self.number_re = re.compile(self.number_pattern)
+        self.name_re = re.compile(self.name_pattern)
+        self.string_re = re.compile(self.string_pattern)
+        self._get_token = self._get_token_identifier if identifier_first else self._get_token_patterns
+        self.set_cache_size(cache_size)
 
-    def _get_token_list(self, line):
+    def reset(self):
         """
-        Split a line into tokens. This is where most of the lexical analysing
-        is done. White spaces and comments are stripped down in this routine.
-        :param line:
-        :type line: str
-        :return: list of Tokens
-        :rtype: list
+        Reset the lexer state before reading a new file.
+        :return: None
+        """
+        self.last_line = ''
+        self.line_number = 0
+        self.buffer = ''
+        self.buffer_pos = 0
+        self.line_done = True
+        self.unterminated = False
+        self.comment_list = []
+        self.line_tokens = ()
+        self.line_token_pos = 0
+
+    def set_cache_size(self, cache_size):
+        """
+        Set the size of the token cache. Lines that fit in one chunk are split into
+        tokens once, and the tokens are kept, under the line text without leading and
+        trailing white space, until the estimated memory used by the cache goes over
+        the size. Then the lines used least recently are dropped. This pays off when
+        the same lines appear in many files (e.g. files generated from templates).
+        :param cache_size: estimated memory used by the cache in bytes (0 for no cache)
+        :type cache_size: int
+        :return: None
+        """
+        self.cache_size = cache_size
+        if cache_size <= 0:
+            self.cache = None
+            self.cache_bytes = 0
+            self.shared_tokens = {}
+            return
+        if self.cache is None:
+            self.cache = OrderedDict()
+        self._evict(0)
+
+    def cache_stats(self):
+        """
+        Return the token cache statistics
+        :return: dictionary with the hits, misses, hit rate, evictions, lines and estimated memory used
+        :rtype: dict
+        """
+        lookups = self.cache_hits + self.cache_misses
+        return {'hits': self.cache_hits,
+                'misses': self.cache_misses,
+                'hit_rate': self.cache_hits / float(lookups) if lookups else 0.0,
+                'evictions': self.cache_evictions,
+                'lines': len(self.cache) if self.cache is not None else 0,
+                'bytes': self.cache_bytes,
+                'size': self.cache_size}
+
+    def _evict(self, needed):
+        """
+        Drop the lines used least recently from the token cache until there is room for more
+        :param needed: estimated memory needed in bytes
+        :type needed: int
+        :return: None
+        """
+        while self.cache and self.cache_bytes + needed > self.cache_size:
+            key, token_tuple = self.cache.popitem(last=False)
+            self.cache_bytes -= self._entry_bytes(key, token_tuple)
+            self.cache_evictions += 1
+
+    def _entry_bytes(self, key, token_tuple):
+        """
+        Estimate the memory used by a line in the token cache
+        :rtype: int
+        """
+        size = self.cache_line_overhead + len(key) + 8 * len(token_tuple)
+        for token in token_tuple:
+            if token.id not in self.shared_token_ids:
+                size += self.cache_token_overhead + len(token.value)
+        return size
+
+    def _lex_line(self, text):
+        """
+        Split a whole line into tokens for the token cache. A comment, if any, is the
+        last token, with the text up to the end of the line as its value.
+        :param text: line, without leading and trailing white space
+        :type text: str
+        :return: tokens, white space not included
+        :rtype: tuple
         """
-        # print '_get_token_list'
-        m = None
-        line_pos = 0
-        line_length = len(line)
         token_list = []
-        # print line_length
-
-        # Traverse the line starting from the first character
-        while line_pos < line_length:
-
-            # Assign a default value so the IDE doesn't complain
-            t_id = TOKEN_NONE
-
-            # Loop over all the possible patterns looking for a match.
-            # Break the loop if one is found and proceed to the next step.
-            # Comments and whitespaces are ignored at this point.
-            # In the case of number contants, the type is reassigned to make
-            # the distincton between an integer and a real.
-            for t_pat, t_id in self.compiled_patterns:
-                # print str(line_pos) + ': [' + str(line[line_pos:]) + ']'
-                m = t_pat.match(line, line_pos)
-                if m:
-                    # print '+ [' + m.group() + '] ' + str(t_id)
-                    if t_id != TOKEN_WHITESPACE and t_id != TOKEN_COMMENT:
-                        if t_id == TOKEN_NUMBER:
-                            try:
-                                int(m.group(0))
-                                t_id = TOKEN_INTEGER
-                            except ValueError:
-                                t_id = TOKEN_FLOAT
-                        token_list.append(PvToken(t_id, m.group(0)))
-                    break
-
-            # If a match was found then move the character counter
-            # to the next non-processed character in the line.
-            # The rest of the comment line is stripped at this point.
+        pos = 0
+        self.unterminated = False
+        while pos < len(text):
+            t_id, t_value, t_end = self._get_token(text, pos)
+            if t_id == TOKEN_COMMENT:
+                token_list.append(PvToken(TOKEN_COMMENT, text[pos:]))
+                break
+            if t_id in self.shared_token_ids:
+                token = self.shared_tokens.get((t_id, t_value))
+                if token is None:
+                    token = self.shared_tokens[(t_id, t_value)] = PvToken(t_id, t_value)
+                token_list.append(token)
+            elif t_id != TOKEN_WHITESPACE:
+                token_list.append(PvToken(t_id, t_value))
+            pos = t_end
+        self.unterminated = False
+        return tuple(token_list)
+
+    def _cached_tokens(self, text):
+        """
+        Return the tokens of a line from the token cache, adding them if needed
+        :param text: line, without leading and trailing white space
+        :type text: str
+        :return: tokens, white space not included
+        :rtype: tuple
+        """
+        token_tuple = self.cache.pop(text, None)
+        if token_tuple is not None:
+            self.cache_hits += 1
+            self.cache[text] = token_tuple  # most recently used
+            return token_tuple
+        self.cache_misses += 1
+        token_tuple = self._lex_line(text)
+        size = self._entry_bytes(text, token_tuple)
+        if size <= self.cache_size:
+            self._evict(size)
+            self.cache[text] = token_tuple
+            self.cache_bytes += size
+        return token_tuple
+
+    def _get_token_identifier(self, line, line_pos):
+        """
+        Match a single token starting at a given position in a line (identifier-first mode).
+        The first character selects the kind of token, so at most one regular expression
+        is tried per token.
+        :param line: line (or chunk of a line)
+        :type line: str
+        :param line_pos: position of the first character of the token
+        :type line_pos: int
+        :return: token id, token text and position of the first character after the token
+        :rtype: tuple
+        """
+        c = line[line_pos]
+        t_id = self.symbol_map.get(c)
+        if t_id is not None:
+            return t_id, c, line_pos + 1
+        if c.isspace():
+            m = self.whitespace_re.match(line, line_pos)
+            return TOKEN_WHITESPACE, m.group(0), m.end()
+        if c in self.number_start:
+            m = self.number_re.match(line, line_pos)
             if m:
-                if t_id != TOKEN_COMMENT:
-                    line_pos += len(m.group())
+                if m.group('point') is None and m.group('fraction') is None and m.group('exponent') is None:
+                    t_id = TOKEN_INTEGER
                 else:
-                    break  # skip the rest of the line after a comment
+                    t_id = TOKEN_FLOAT
+                return t_id, m.group(0), m.end()
+        elif c == '"':
+            if not self.unterminated:
+                m = self.string_re.match(line, line_pos)
+                if m:
+                    return TOKEN_STRING, m.group(0), m.end()
+                self.unterminated = True
+        else:
+            m = self.name_re.match(line, line_pos)
+            if m:
+                text = m.group(0)
+                return self.keyword_map.get(text, TOKEN_PVNAME), text, m.end()
+        return TOKEN_ERROR, c, line_pos + 1
+
+    def _get_token_patterns(self, line, line_pos):
+        """
+        Match a single token starting at a given position in a line, trying the
+        lexer_patterns in order.
+        :param line: line (or chunk of a line)
+        :type line: str
+        :param line_pos: position of the first character of the token
+        :type line_pos: int
+        :return: token id, token text and position of the first character after the token
+        :rtype: tuple
+        """
+        # Loop over all the possible patterns looking for a match.
+        # In the case of number contants, the type is reassigned to make
+        # the distincton between an integer and a real.
+        for t_pat, t_id in self.compiled_patterns:
+            if t_id == TOKEN_STRING and self.unterminated:
+                continue
+            m = t_pat.match(line, line_pos)
+            if m:
+                if t_id == TOKEN_NUMBER:
+                    try:
+                        int(m.group(0))
+                        t_id = TOKEN_INTEGER
+                    except ValueError:
+                        t_id = TOKEN_FLOAT
+                return t_id, m.group(0), m.end()
+            elif t_id == TOKEN_STRING and line[line_pos] == '"':
+                self.unterminated = True
+        return TOKEN_ERROR, line[line_pos], line_pos + 1
+
+    def _read_chunk(self, f_in):
+        """
+        Read the next chunk of the current line from the input file.
+        The end of line character is not returned.
+        :param f_in: input file
+        :type f_in: file
+        :return: chunk of text (empty at the end of the file)
+        :rtype: str
+        """
+        chunk = f_in.readline(self.chunk_size)
+        self.characters += len(chunk)
+        if chunk.endswith('\n'):
+            chunk = chunk[:-1]
+            self.line_done = True
+        else:
+            self.line_done = len(chunk) == 0
+        return chunk
+
+    def _read_line(self, f_in):
+        """
+        Start lexing a new line. Only the first chunk of the line is read.
+        :param f_in: input file
+        :type f_in: file
+        :return: false at the end of the file
+        :rtype: bool
+        """
+        line = f_in.readline(self.chunk_size)
+        if len(line) == 0:
+            return False
+        self.characters += len(line)
+        self.lines += 1
+        self.line_number += 1
+        self.buffer_pos = 0
+        self.unterminated = False
+        if line.endswith('\n'):
+            self.buffer = line[:-1]
+            self.line_done = True
+        else:
+            self.buffer = line
+            self.line_done = False
+
+        # Keep (the beginning of) the last non comment and non white line
+        text = self.buffer.strip()
+        if len(text) > 0 and not text.startswith('#'):
+            if len(text) > self.max_line_length or not self.line_done:
+                self.last_line = text[:self.max_line_length] + ' ...'
             else:
-                token_list.append(PvToken(TOKEN_ERROR, line[line_pos]))
-                break
+                self.last_line = text
 
-        # print '-', token_list
-        return token_list
+        # Whole lines are taken from the token cache instead of the buffer. Blank and
+        # comment only lines have no tokens to keep, and would only inflate the hit rate.
+        if self.cache is not None and self.line_done and text and not text.startswith('#'):
+            self.line_tokens = self._cached_tokens(text)
+            self.line_token_pos = 0
+            self.buffer = ''
+        return True
+
+    def _fill_buffer(self, f_in):
+        """
+        Append the next chunk of the line to the characters not processed yet.
+        :param f_in: input file
+        :type f_in: file
+        :return: None
+        """
+        self.buffer = self.buffer[self.buffer_pos:] + self._read_chunk(f_in)
+        self.buffer_pos = 0
+        self.unterminated = False
 
     def get_last_line(self):
         return self.line_number, self.last_line
@@ -139,34 +450,86 @@ class PvLexer:
         Return next token in the file.
         This is the main routine that will be called by the parser.
         It was not implemented as an iterator because of the parser requirements.
+        Tokens are produced one at a time, resuming from the position where
+        the previous token ended. White spaces and comments are stripped here.
         :param f_in: input file
         :type f_in: file
         :return: next token
         :rtype: PvToken
         """
-        if len(self.token_list) == 0:
-            # print 'empty'
-            try:
-                # Look for the next non comment and non white line in the line
-                while True:
-                    line = f_in.next().strip()
-                    self.line_number += 1
-                    if re.search(r'^#', line) is None and len(line) > 0:
-                        break
-                self.token_list = self._get_token_list(line)
-                self.last_line = line
-            except StopIteration:
-                self.token_list = [PvToken(TOKEN_EOF, '')]
-
-        return self.token_list.pop(0)
-
-    def flush(self):
-        """
-        Throw away the list of token that are buffered to force reading a new line.
+        while True:
+            # Get more text when the buffer is exhausted
+            if self.buffer_pos >= len(self.buffer):
+                if self.line_token_pos < len(self.line_tokens):
+                    token = self.line_tokens[self.line_token_pos]
+                    self.line_token_pos += 1
+                    self.token_counts[token.id] = self.token_counts.get(token.id, 0) + 1
+                    if token.id != TOKEN_COMMENT:
+                        return token
+                    if self.keep_comments:
+                        self.comment_list.append((self.line_number, token.value))
+                    continue
+                if self.line_done:
+                    if not self._read_line(f_in):
+                        self.token_counts[TOKEN_EOF] = self.token_counts.get(TOKEN_EOF, 0) + 1
+                        return PvToken(TOKEN_EOF, '')
+                else:
+                    self._fill_buffer(f_in)
+                continue
+
+            t_id, t_value, t_end = self._get_token(self.buffer, self.buffer_pos)
+
+            # A token that ends close to the end of an incomplete line might continue
+            # in the next chunk (e.g. the field of a pv name, or an exponent).
+            # The same applies to an unknown character, since it could be the start
+            # of a token split between chunks.
+            if not self.line_done:
+                if t_id == TOKEN_ERROR:
+                    needed = self.max_token_length
+                else:
+                    needed = t_end - self.buffer_pos + self.token_margin
+                if len(self.buffer) - self.buffer_pos < needed:
+                    self._fill_buffer(f_in)
+                    continue
+
+            if t_id != TOKEN_WHITESPACE:
+                self.token_counts[t_id] = self.token_counts.get(t_id, 0) + 1
+            if t_id == TOKEN_COMMENT:
+                if self.keep_comments:
+                    self._keep_comment(f_in)
+                self.flush(f_in)  # skip the rest of the line after a comment
+            else:
+                self.buffer_pos = t_end
+                if t_id != TOKEN_WHITESPACE:
+                    return PvToken(t_id, t_value)
+
+    def _keep_comment(self, f_in):
+        """
+        Save the comment that starts at the current position, up to the end of the line.
+        :param f_in: input file
+        :type f_in: file
+        :return: None
+        """
+        text = self.buffer[self.buffer_pos:]
+        while not self.line_done:
+            text += self._read_chunk(f_in)
+        self.comment_list.append((self.line_number, text.rstrip()))
+
+    def flush(self, f_in=None):
+        """
+        Throw away the rest of the current line to force reading a new line.
         This routine is intended to recover from a syntax error and continue parsing.
+        :param f_in: input file, needed to skip the remaining chunks of a long line
+        :type f_in: file
         :return:
         """
-        self.token_list = []
+        self.buffer = ''
+        self.buffer_pos = 0
+        self.unterminated = False
+        self.line_tokens = ()
+        self.line_token_pos = 0
+        while not self.line_done and f_in is not None:
+            self._read_chunk(f_in)
 
 
 if __name__ == '__main__':
@@ -176,6 +539,6 @@ if __name__ == '__main__':
     with open('example2.pv') as f:
         while True:
             t = lex.next_token(f)
-            print t
+            print(t)
             if t.id == TOKEN_EOF:
                 break
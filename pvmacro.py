@@ -0,0 +1,48 @@
+"""
+EPICS style macro substitution for pv names, e.g. $(top)cc:state.VAL or ${top}cc:state.VAL
+"""
+import re
+
+macro_pattern = re.compile(r'\$\((\w+)\)|\$\{(\w+)\}')
+
+
+def parse_macros(text):
+    """
+    Parse a macro definition string of the form 'name1=value1,name2=value2'.
+    :param text: macro definitions
+    :type text: str
+    :return: dictionary with the macro values
+    :rtype: dict
+    :raises: ValueError if a definition is not valid
+    """
+    macro_dict = {}
+    for definition in text.split(','):
+        definition = definition.strip()
+        if len(definition) == 0:
+            continue
+        if '=' not in definition:
+            raise ValueError('invalid macro definition \'' + definition + '\'')
+        name, value = definition.split('=', 1)
+        macro_dict[name.strip()] = value.strip()
+    return macro_dict
+
+
+def expand_macros(name, macro_dict):
+    """
+    Replace all the macros in a pv name by their values.
+    Undefined macros are left unchanged.
+    :param name: pv name
+    :type name: str
+    :param macro_dict: dictionary with the macro values
+    :type macro_dict: dict
+    :return: expanded name
+    :rtype: str
+    """
+    if not macro_dict or '$' not in name:
+        return name
+
+    def replace(m):
+        macro_name = m.group(1) or m.group(2)
+        return macro_dict.get(macro_name, m.group(0))
+
+    return macro_pattern.sub(replace, name)
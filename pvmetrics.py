@@ -0,0 +1,187 @@
+"""
+Run level metrics: throughput, item counts, errors and warnings by kind, and the time
+spent in each phase of a run.
+
+The counters come from three places: the lexer (lines, characters, tokens of each
+type and token cache lookups), the parser (errors, warnings and phase times, when timing is enabled) and
+PvMetrics itself, a parser handler that counts the items found in the files.
+Errors and warnings are counted by kind, a fixed identifier given where each message
+is reported (e.g. 'expected_semicolon' or 'duplicate_pv'), so the number of kinds does
+not depend on the files checked.
+
+The phases are:
+- open: opening the input files
+- decompress: reading and decompressing the compressed files
+- lex: reading the files and splitting them into tokens (not including decompress)
+- check: checking the single statements, including the handlers (e.g. database checks)
+- parse: everything else in the parser
+
+The metrics can be written as JSON or in the Prometheus text exposition format, to be
+picked up by the node exporter textfile collector. All the Prometheus metrics are gauges
+that describe the last run.
+"""
+import os
+import json
+
+from pvhandler import PvHandler
+from pvparser import timer
+from pvlexer import TOKEN_NAMES
+
+# Phases reported, in order
+PHASES = ['open', 'decompress', 'lex', 'parse', 'check']
+
+# Prometheus metric name prefix
+METRIC_PREFIX = 'pvcheck_'
+
+
+def _rate(count, total):
+    return count / float(total) if total else 0.0
+
+
+def _label_value(text):
+    return text.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class PvMetrics(PvHandler):
+    """
+    Parser handler that counts the items of a run and builds the metrics summary
+    """
+
+    def __init__(self):
+        self.start = timer()
+        self.files = 0
+        self.statements = 0
+        self.groups = 0
+        self.sleeps = 0
+        self.elements = 0
+
+    def pv_file_end(self, parser):
+        self.files += 1
+
+    def pv_group_end(self, parser):
+        self.groups += 1
+
+    def pv_sleep(self, parser, sleep_time):
+        self.sleeps += 1
+
+    def pv_single(self, parser):
+        """
+        Count the single statement and its array elements
+        :param parser: parser
+        :type parser: PvParser
+        :return: list of warning messages
+        :rtype: list
+        """
+        self.statements += 1
+        self.elements += max(parser.single_count, len(parser.single_value_list))
+        return []
+
+    def summary(self, parser):
+        """
+        Collect the metrics of the run
+        :param parser: parser used in the run
+        :type parser: PvParser
+        :return: metrics
+        :rtype: dict
+        """
+        wall_time = timer() - self.start
+        lex = parser.lex
+        token_counts = dict([(TOKEN_NAMES.get(t_id, str(t_id)), count) for t_id, count in lex.token_counts.items()])
+        tokens = sum(token_counts.values())
+        phase_times = dict([(phase, parser.phase_times[phase]) for phase in ['open', 'decompress', 'lex', 'check']])
+        phase_times['parse'] = max(parser.phase_times['total'] - sum(phase_times.values()), 0.0)
+        return {'files': self.files,
+                'lines': lex.lines,
+                'characters': lex.characters,
+                'tokens': tokens,
+                'token_counts': token_counts,
+                'token_cache': lex.cache_stats(),
+                'statements': self.statements,
+                'groups': self.groups,
+                'sleeps': self.sleeps,
+                'elements': self.elements,
+                'errors': parser.errors,
+                'warnings': parser.warnings,
+                'error_counts': dict(parser.error_counts),
+                'warning_counts': dict(parser.warning_counts),
+                'error_rate': _rate(parser.errors, self.statements),
+                'warning_rate': _rate(parser.warnings, self.statements),
+                'wall_time': wall_time,
+                'phase_times': phase_times,
+                'files_per_second': _rate(self.files, wall_time),
+                'tokens_per_second': _rate(tokens, wall_time),
+                'characters_per_second': _rate(lex.characters, wall_time)}
+
+    @staticmethod
+    def write_json(f_out, summary):
+        """
+        Write the metrics as JSON
+        :param f_out: output file
+        :type f_out: file
+        :param summary: metrics, as returned by summary()
+        :type summary: dict
+        :return: None
+        """
+        json.dump(summary, f_out, indent=1, sort_keys=True, separators=(',', ': '))
+        f_out.write('\n')
+
+    @staticmethod
+    def write_prometheus(f_out, summary):
+        """
+        Write the metrics in the Prometheus text exposition format
+        :param f_out: output file
+        :type f_out: file
+        :param summary: metrics, as returned by summary()
+        :type summary: dict
+        :return: None
+        """
+        def metric(name, help_text, sample_list):
+            f_out.write('# HELP ' + METRIC_PREFIX + name + ' ' + help_text + '\n')
+            f_out.write('# TYPE ' + METRIC_PREFIX + name + ' gauge\n')
+            for labels, value in sample_list:
+                f_out.write(METRIC_PREFIX + name + labels + ' ' + repr(float(value)) + '\n')
+
+        def labelled(label, value_map):
+            return [('{' + label + '="' + _label_value(key) + '"}', value_map[key]) for key in sorted(value_map)]
+
+        metric('files', 'Files checked in the last run.', [('', summary['files'])])
+        metric('lines', 'Lines read in the last run.', [('', summary['lines'])])
+        metric('characters', 'Characters read in the last run (after decompressing).', [('', summary['characters'])])
+        metric('tokens', 'Tokens found in the last run, by type.', labelled('type', summary['token_counts']))
+        cache = summary['token_cache']
+        metric('token_cache_lookups', 'Token cache lookups in the last run, by result.',
+               [('{result="hit"}', cache['hits']), ('{result="miss"}', cache['misses'])])
+        metric('token_cache_hit_rate', 'Lines found in the token cache per lookup.', [('', cache['hit_rate'])])
+        metric('token_cache_bytes', 'Estimated memory used by the token cache.', [('', cache['bytes'])])
+        metric('statements', 'Single statements found in the last run.', [('', summary['statements'])])
+        metric('groups', 'Groups found in the last run.', [('', summary['groups'])])
+        metric('sleeps', 'Sleep statements found in the last run.', [('', summary['sleeps'])])
+        metric('elements', 'Array elements written by the single statements.', [('', summary['elements'])])
+        metric('errors', 'Errors found in the last run, by kind.', labelled('kind', summary['error_counts']))
+        metric('warnings', 'Warnings found in the last run, by kind.', labelled('kind', summary['warning_counts']))
+        metric('error_rate', 'Errors per single statement.', [('', summary['error_rate'])])
+        metric('warning_rate', 'Warnings per single statement.', [('', summary['warning_rate'])])
+        metric('wall_seconds', 'Duration of the last run.', [('', summary['wall_time'])])
+        metric('phase_seconds', 'Time spent in each phase of the last run.',
+               [('{phase="' + phase + '"}', summary['phase_times'][phase]) for phase in PHASES])
+        metric('files_per_second', 'Files checked per second.', [('', summary['files_per_second'])])
+        metric('tokens_per_second', 'Tokens found per second.', [('', summary['tokens_per_second'])])
+        metric('characters_per_second', 'Characters read per second.', [('', summary['characters_per_second'])])
+
+
+def write_metrics_file(file_name, write, summary):
+    """
+    Write a metrics file under a temporary name and rename it, so that collectors
+    never read a partial file.
+    :param file_name: output file name
+    :type file_name: str
+    :param write: routine that writes the metrics (e.g. PvMetrics.write_json)
+    :param summary: metrics, as returned by PvMetrics.summary()
+    :type summary: dict
+    :return: None
+    :raises: IOError, OSError
+    """
+    temp_file_name = file_name + '.tmp'
+    with open(temp_file_name, 'w') as f_out:
+        write(f_out, summary)
+    os.rename(temp_file_name, file_name)
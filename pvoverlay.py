@@ -0,0 +1,183 @@
+"""
+Effective state of an ordered list of pvload files, as left by loading them one
+after the other (e.g. site defaults, then instrument settings, then local overrides).
+
+The last statement written to a pv wins. A statement with indices only updates the
+array elements it names, so
+
+    double arr[4] = { 1.0, 2.0, 3.0, 4.0 };
+    double arr[4] = { [2] 7.5 };
+
+leaves arr as { 1.0, 2.0, 7.5, 4.0 }. The array count is the largest one written,
+and the indices are dropped when the elements set are 0 to n-1. A partial update of
+a pv that had values of another kind (strings and numbers) replaces them.
+
+Statements are folded into one record per pv name as they are parsed, so memory use
+depends on the number of distinct pvs rather than on the number of statements. When
+the records do not fit in the memory budget they are spilled to disk in sorted runs,
+which are merged at the end (see PvStatementStore). The state is written sorted by
+pv name, as canonical pvload text or as a JSON object:
+
+    {
+    "arr": {"count": 4, "type": "double", "values": [1.0, 2.0, 7.5, 4.0]},
+    "x": {"count": 8, "indices": [0, 5], "type": "long", "values": [1, 3]}
+    }
+"""
+import json
+import heapq
+
+from pvdiff import PvStatementStore, BUFFER_SIZE, element_map, _read_run
+from pvmacro import expand_macros
+from pvformat import format_single, TYPE_NAMES
+from pvparser import TYPE_INTEGER, TYPE_STRING
+
+
+def overlay_record(record_a, record_b):
+    """
+    Apply a statement to the state of a pv. The result does not depend on how the
+    statements are grouped, so runs can be merged in any grouping.
+    :param record_a: state of the pv, as (data type, count, index list, value list, replace)
+                     where replace is true if the record replaces any earlier state
+    :type record_a: tuple
+    :param record_b: statement (or state) written after it
+    :type record_b: tuple
+    :return: new state of the pv
+    :rtype: tuple
+    """
+    type_b, count_b, index_list_b, value_list_b, replace_b = record_b
+    type_a, count_a, index_list_a, value_list_a, replace_a = record_a
+    if replace_b:
+        return record_b
+    if (type_a == TYPE_STRING) != (type_b == TYPE_STRING):
+        return type_b, count_b, index_list_b, value_list_b, True
+    elements = element_map(index_list_a, value_list_a)
+    elements.update(element_map(index_list_b, value_list_b))
+    index_list = sorted(elements)
+    value_list = [elements[index] for index in index_list]
+    if index_list[-1] == len(index_list) - 1:
+        index_list = []  # sequential indices are not needed
+    return type_b, max(count_a, count_b), index_list, value_list, replace_a
+
+
+def _overlay_by_name(item_iterator):
+    """
+    Fold consecutive records with the same name (sorted by name and sequence number)
+    into the effective state of the pv
+    """
+    last = None
+    for item in item_iterator:
+        if last is not None and item[0] == last[0]:
+            last = (item[0], item[1], overlay_record(last[2], item[2]))
+            continue
+        if last is not None:
+            yield last
+        last = item
+    if last is not None:
+        yield last
+
+
+class PvOverlay(PvStatementStore):
+    """
+    Parser handler that keeps the effective state of the pvs written by one or more
+    files, within a memory budget. Records have one more field than the ones of
+    PvStatementStore: true if the record replaces the earlier state of the pv.
+    """
+
+    skip_message = ('statement_skipped', 'statement not included in the overlay (values do not match the type)')
+
+    def __init__(self, macro_dict=None, buffer_size=BUFFER_SIZE):
+        """
+        :param macro_dict: macros used to expand the pv names
+        :type macro_dict: dict
+        :param buffer_size: memory budget in number of values
+        :type buffer_size: int
+        """
+        PvStatementStore.__init__(self, macro_dict, buffer_size)
+        self.record_map = {}  # name -> (sequence number, record) of the pvs not spilled yet
+
+    def add(self, name, data_type, count, index_list, value_list):
+        """
+        Apply a statement to the state. The index list has one index per value
+        (see expand_indices).
+        :return: None
+        """
+        name = expand_macros(name, self.macro_dict)
+        record = (data_type, count, list(index_list), list(value_list), not index_list)
+        item = self.record_map.get(name)
+        if item is not None:
+            self.size -= 1 + len(item[1][3])
+            record = overlay_record(item[1], record)
+        elif index_list:
+            # sort the elements and drop sequential indices, as when merging
+            record = overlay_record((data_type, 0, [], [], False), record)
+        self.record_map[name] = (self.sequence, record)
+        self.sequence += 1
+        self.size += 1 + len(record[3])
+        if self.size > self.buffer_size:
+            self._spill()
+
+    def _spill(self):
+        self.item_list = [(name, sequence, record) for name, (sequence, record) in self.record_map.items()]
+        self.record_map = {}
+        PvStatementStore._spill(self)
+
+    def close(self):
+        PvStatementStore.close(self)
+        self.record_map = {}
+
+    def sorted_items(self):
+        """
+        Iterate over the effective state of the pvs, sorted by name
+        :return: iterator of (name, sequence, record) tuples
+        """
+        item_list = sorted([(name, sequence, record) for name, (sequence, record) in self.record_map.items()])
+        iterator_list = [_read_run(f) for f in self.run_list] + [iter(item_list)]
+        return _overlay_by_name(heapq.merge(*iterator_list))
+
+
+def write_text(item_iterator, f_out):
+    """
+    Write the state as canonical pvload text
+    :param item_iterator: state, as returned by PvOverlay.sorted_items()
+    :param f_out: output file
+    :type f_out: file
+    :return: number of pvs
+    :rtype: int
+    """
+    pvs = 0
+    for name, sequence, (data_type, count, index_list, value_list, replace) in item_iterator:
+        f_out.write(format_single(data_type, name, count, index_list, value_list) + '\n')
+        pvs += 1
+    return pvs
+
+
+def write_json(item_iterator, f_out):
+    """
+    Write the state as a JSON object, one pv per line
+    :param item_iterator: state, as returned by PvOverlay.sorted_items()
+    :param f_out: output file
+    :type f_out: file
+    :return: number of pvs
+    :rtype: int
+    """
+    pvs = 0
+    f_out.write('{')
+    for name, sequence, (data_type, count, index_list, value_list, replace) in item_iterator:
+        if data_type == TYPE_INTEGER:
+            value_list = [int(value) for value in value_list]
+        elif data_type != TYPE_STRING:
+            value_list = [float(value) for value in value_list]
+        state = {'type': TYPE_NAMES[data_type], 'count': count, 'values': value_list}
+        if index_list:
+            state['indices'] = index_list
+        f_out.write((',\n' if pvs else '\n') + json.dumps(name) + ': ' + json.dumps(state, sort_keys=True))
+        pvs += 1
+    f_out.write('\n}\n')
+    return pvs
+
+
+# Writer function for each output format
+FORMATS = {
+    'pv': write_text,
+    'json': write_json,
+}
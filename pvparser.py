@@ -145,6 +145,9 @@ single_index_or_count
     | /* empty */
     ;
 """
+import sys
+import time
+
 from pvtoken import PvToken
 from pvlexer import PvLexer
 
@@ -156,6 +159,10 @@ from pvlexer import TOKEN_EQUALS, TOKEN_TIMES, TOKEN_DIVIDED, TOKEN_PERCENT
 from pvlexer import TOKEN_LEFT_BRACE, TOKEN_RIGHT_BRACE, TOKEN_LEFT_BRACKET, TOKEN_RIGHT_BRACKET
 from pvlexer import TOKEN_ERROR
 
+from pvscale import unit_factor, is_number, to_int, evaluate_integers, evaluate_floats, evaluate_strings, NO_SCALE
+from pvreport import PvTextWriter
+from pvcompress import open_input, PvDecompressError
+
 # Pvload defines a total of eight possible types for EPICS channels.
 # They can be grouped into three different basic types.
 TYPE_NONE = 0  # not defined yet (internal use)
@@ -163,28 +170,86 @@ TYPE_INTEGER = 1
 TYPE_FLOAT = 2
 TYPE_STRING = 3
 
+# Clock used to measure the time spent in each phase
+timer = getattr(time, 'perf_counter', time.time)
+
+
+class PvFileSection:
+    """
+    Part of an input file that is parsed on its own, as if it was a whole file.
+    Reading stops after a number of lines.
+    """
+
+    def __init__(self, f_in, line_count):
+        """
+        :param f_in: input file, positioned at the start of the section
+        :type f_in: file
+        :param line_count: number of lines in the section
+        :type line_count: int
+        """
+        self.f_in = f_in
+        self.line_count = line_count
+
+    def readline(self, size=-1):
+        if self.line_count <= 0:
+            return ''
+        line = self.f_in.readline(size)
+        if not line or line.endswith('\n'):
+            self.line_count -= 1
+        return line
+
+    def close(self):
+        self.f_in.close()
+
 
 class PvParser:
     class PvSyntaxError(Exception):
         def __init___(self, message):
             Exception.__init__(self, message)
 
-    def __init__(self, debug=False, verbose=False):
+    def __init__(self, debug=False, verbose=False, print_values=False, message_file=None, reporter=None):
         self.f_in = None
         self.file_name = ''
         self.lex = PvLexer()
         self.token = None
 
+        # number of braces opened and not yet closed (used for error recovery)
+        self.brace_level = 0
+
         # output control
         self.debug = debug
         self.verbose = verbose
+        self.print_values = print_values
+
+        # error and warning messages are written by the reporter (see pvreport),
+        # by default as text to the message file (standard output by default)
+        if reporter is None:
+            reporter = PvTextWriter(message_file if message_file is not None else sys.stdout)
+        self.reporter = reporter
+        self.errors = 0
+        self.warnings = 0
+        self.error_counts = {}  # message kind -> number of errors
+        self.warning_counts = {}  # message kind -> number of warnings
+
+        # time spent in each phase, only measured when timing is true (always in verbose
+        # mode, where the times of the compressed files are printed)
+        self.timing = verbose
+        self.phase_times = {'open': 0.0, 'decompress': 0.0, 'lex': 0.0, 'check': 0.0, 'total': 0.0}
+
+        # objects that process the items found in the file (see PvHandler)
+        self.handler_list = []
 
         # the following variables are used for simple statement checks
+        self.single_line_number = 0
+        self.single_percent = False
+        self.single_type_name = ''
         self.single_data_type = TYPE_NONE
         self.single_name = ''
         self.single_count = 0
         self.single_value_list = []
         self.single_index_list = []
+        self.single_index_position_list = []
+        self.single_scale_list = []
 
         # initialize state
         self.flush_token()
@@ -209,11 +274,16 @@ class PvParser:
         Clear/reset the variables used to store the single statement elements.
         :return: None
         """
+        self.single_line_number = 0  # line where the statement starts
+        self.single_percent = False  # statement starts with '%'
+        self.single_type_name = ''  # type as written in the file
         self.single_data_type = TYPE_NONE  # data type
         self.single_name = ''  # pv name
         self.single_count = 1  # array size
         self.single_value_list = []  # value list
         self.single_index_list = []  # index list
+        self.single_index_position_list = []  # position in the value list of the value of each index
+        self.single_scale_list = []  # (operator, operand) scale list (one per value)
 
     def check_single(self):
         """
@@ -222,42 +292,109 @@ class PvParser:
         """
         # Check for array consistency
         if self.single_count != len(self.single_value_list):
-            self.pv_warning('list of values does not match array size')
+            self.pv_warning('list of values does not match array size', 'array_size_mismatch')
         if len(self.single_index_list) != len(set(self.single_index_list)):
-            self.pv_warning('repeated indices')
+            self.pv_warning('repeated indices', 'repeated_indices')
         if len(self.single_index_list) and (len(self.single_value_list) != len(self.single_index_list)):
-            self.pv_warning('missing indices?')
+            self.pv_warning('missing indices?', 'missing_indices')
 
         # Check for type consistency
         if self.single_data_type == TYPE_NONE:
-            self.pv_warning('type not defined')
+            self.pv_warning('type not defined', 'type_not_defined')
         elif self.single_data_type == TYPE_INTEGER:
             for value in self.single_value_list:
                 try:
                     int(value)
                 except ValueError:
-                    self.pv_warning('type mismatch')
+                    self.pv_warning('type mismatch', 'type_mismatch')
                     break
         elif self.single_data_type == TYPE_FLOAT:
             for value in self.single_value_list:
                 try:
                     float(value)
                 except ValueError:
-                    self.pv_warning('type mismatch')
+                    self.pv_warning('type mismatch', 'type_mismatch')
                     break
         elif self.single_data_type == TYPE_STRING:
             for value in self.single_value_list:
                 try:
                     int(value)
-                    self.pv_warning('type mismatch')
+                    self.pv_warning('type mismatch', 'type_mismatch')
                 except ValueError:
                     pass
                 try:
                     float(value)
-                    self.pv_warning('type mismatch')
+                    self.pv_warning('type mismatch', 'type_mismatch')
                 except ValueError:
                     pass
 
+    def add_handler(self, handler):
+        """
+        Register an object that will process the items found in the input files.
+        :param handler: handler
+        :type handler: PvHandler
+        :return: None
+        """
+        self.handler_list.append(handler)
+
+    def process_single(self):
+        """
+        Pass the single statement to all the handlers, reporting their warnings.
+        :return: None
+        """
+        for handler in self.handler_list:
+            message_list = handler.pv_single(self)
+            if message_list:
+                for kind, message in message_list:
+                    self.pv_warning(message, kind)
+
+    def single_basic_type(self):
+        """
+        Return the basic data type of the single statement. Statements with no type
+        are taken as floats, or strings if any of the values is not a number.
+        :return: basic data type
+        :rtype: int
+        """
+        if self.single_data_type != TYPE_NONE:
+            return self.single_data_type
+        for value in self.single_value_list:
+            if not is_number(value):
+                return TYPE_STRING
+        return TYPE_FLOAT
+
+    def evaluate_single(self):
+        """
+        Evaluate the values of the single statement. The scale factors and units are
+        applied and the values are converted to the basic data type of the statement
+        (see single_basic_type()).
+        :return: list of values (a numpy array for large numeric arrays), or None
+                 if the values cannot be converted to the statement type
+        :rtype: list
+        """
+        data_type = self.single_basic_type()
+        try:
+            if data_type == TYPE_INTEGER:
+                return evaluate_integers(self.single_value_list, self.single_scale_list)
+            elif data_type == TYPE_FLOAT:
+                return evaluate_floats(self.single_value_list, self.single_scale_list)
+            else:
+                return evaluate_strings(self.single_value_list)
+        except ValueError:
+            return None  # type mismatch, already reported by check_single()
+
+    def print_single_values(self):
+        """
+        Print the pv name and the evaluated values of the single statement.
+        :return: None
+        """
+        values = self.evaluate_single()
+        if values is not None:
+            self.reporter.flush()
+            # repr gives the shortest text that reads back as the same value (str only
+            # keeps 12 digits in python 2)
+            print(self.single_name + ' = ' + ', '.join([repr(float(value)) if isinstance(value, float) else str(value)
+                                                        for value in values]))
+
     @staticmethod
     def map_type(token):
         """
@@ -279,13 +416,15 @@ class PvParser:
         else:
             return TYPE_NONE
 
-    def pv_error(self, text=''):
+    def pv_error(self, text='', kind='syntax_error'):
         """
         Print an error message. Used to report syntax errors in the pvload file.
         It generates an exception. It is up to the caller to decide whether to
         abort of try to recover from it.
         :param text: error message
         :type text: str
+        :param kind: fixed identifier of the message, used to count the errors by kind
+        :type kind: str
         :raises: PvSyntaxError
         """
         line_number, line_text = self.lex.get_last_line()
@@ -296,22 +435,24 @@ class PvParser:
         else:
             format_string = 'Error: at \'{0}\', file {1}, line {2}\n>> {3}'
             message = format_string.format(token_value, self.file_name, line_number, line_text)
-        raise self.PvSyntaxError(message)
+        self.errors += 1
+        self.error_counts[kind] = self.error_counts.get(kind, 0) + 1
+        error = self.PvSyntaxError(message)
+        error.details = (self.file_name, line_number, text, line_text, token_value)
+        raise error
 
-    def pv_warning(self, text=''):
+    def pv_warning(self, text='', kind='warning'):
         """
-        Print a warning message. Used to report minor inconsistencies in the pvload file.
+        Report a warning message. Used to report minor inconsistencies in the pvload file.
         :param text: error message
         :type text: str
+        :param kind: fixed identifier of the message, used to count the warnings by kind
+        :type kind: str
         """
         line_number, line_text = self.lex.get_last_line()
-        if text:
-            format_string = 'Warning: file {0}, line {1} -> {2}\n>> {3}'
-            message = format_string.format(self.file_name, line_number, text, line_text)
-        else:
-            format_string = 'Warning: {0}, line {1}\n>> {2}'
-            message = format_string.format(self.file_name, line_number, line_text)
-        print message
+        self.warnings += 1
+        self.warning_counts[kind] = self.warning_counts.get(kind, 0) + 1
+        self.reporter.warning(self.file_name, line_number, text, line_text)
         return
 
     def trace(self, text):
@@ -323,7 +464,7 @@ class PvParser:
         :return: None
         """
         if self.debug:
-            print '> ' + text, self.token
+            print('> ' + text + ' ' + str(self.token))
 
     def get_token(self):
         """
@@ -336,7 +477,12 @@ class PvParser:
         :rtype: PvToken
         """
         if self.token.match(TOKEN_NONE):
-            self.token = self.lex.next_token(self.f_in)
+            if self.timing:
+                start = timer()
+                self.token = self.lex.next_token(self.f_in)
+                self.phase_times['lex'] += timer() - start
+            else:
+                self.token = self.lex.next_token(self.f_in)
             # trap lexer errors here
             if self.token.match(TOKEN_ERROR):
                 self.pv_error()
@@ -352,6 +498,35 @@ class PvParser:
         self.trace('flush_token')
         self.token = PvToken(TOKEN_NONE, 'none')
 
+    def pv_recover(self, level=0):
+        """
+        Panic mode error recovery. Tokens are skipped until the end of the statement
+        where the error was found. Parsing resumes after the next TOKEN_SEMICOLON, or
+        before the TOKEN_RIGHT_BRACE that closes the enclosing block (e.g. a group).
+        Braces opened while skipping are matched so that the closing brace of a value
+        list is not mistaken for the end of the block. Lexer errors are skipped as well,
+        so only one error is reported per statement.
+        :param level: brace level of the block where parsing resumes
+        :type level: int
+        :return: None
+        """
+        self.trace('pv_recover')
+        self.clear_single()
+        token = self.token
+        while not token.match(TOKEN_EOF):
+            if token.match(TOKEN_SEMICOLON):
+                self.flush_token()
+                break
+            elif token.match(TOKEN_LEFT_BRACE):
+                self.brace_level += 1
+            elif token.match(TOKEN_RIGHT_BRACE):
+                if self.brace_level <= level:
+                    break  # leave it for the enclosing block
+                self.brace_level -= 1
+            token = self.lex.next_token(self.f_in)
+            self.token = token
+        self.brace_level = level
+
     def flush_and_get_token(self):
         """
         Handy way of to calling flush_token() and get_token() in one call.
@@ -370,7 +545,7 @@ class PvParser:
     # - File
     # --------------------------------------------------------
 
-    def pv_file(self, input_file_name):
+    def pv_file(self, input_file_name, section=None):
         """
         A file is a list of items. Files can be empty.
         ---
@@ -382,33 +557,78 @@ class PvParser:
         ---
         :param input_file_name: input file name
         :type input_file_name: str
+        :param section: only parse part of the file, given as the byte offset where it starts,
+                        its first line number and its number of lines (see pvschedule),
+                        not supported for compressed files
+        :type section: tuple
         :return: file found?
         :rtype: bool
         """
         self.trace('pv_file')
+        start = timer()
         try:
-            self.f_in = open(input_file_name, 'r')
+            # compressed files are decompressed as they are read (see pvcompress)
+            self.f_in, decompressor = open_input(input_file_name)
             self.file_name = input_file_name
         except IOError:
             return False
+        if section is not None:
+            offset, first_line_number, line_count = section
+            self.f_in.seek(offset)
+            self.f_in = PvFileSection(self.f_in, line_count)
+        if self.timing:
+            self.phase_times['open'] += timer() - start
+        lex_seconds = self.phase_times['lex']
 
         if self.verbose:
-            print self.file_name
+            self.reporter.flush()
+            print(self.file_name)
 
-        while True:
-            try:
-                if not self.pv_item():
-                    break
-            except self.PvSyntaxError as e:
-                print e
-                self.flush_token()
-                self.clear_single()
-                self.lex.flush()
+        for handler in self.handler_list:
+            handler.pv_file_start(self)
+
+        # the end of file token of the previous file must not be seen by this one
+        self.lex.reset()
+        if section is not None:
+            self.lex.line_number = first_line_number - 1
+        self.flush_token()
+        self.brace_level = 0
+        try:
+            while True:
+                try:
+                    if not self.pv_item():
+                        break
+                except self.PvSyntaxError as e:
+                    self.reporter.error(*e.details)
+                    self.pv_recover()
+                    # a stray right brace cannot be closing anything at this level
+                    if self.get_token().match(TOKEN_RIGHT_BRACE):
+                        self.flush_token()
+        except PvDecompressError as e:
+            # the rest of the file cannot be read
+            self.errors += 1
+            self.error_counts['decompress_error'] = self.error_counts.get('decompress_error', 0) + 1
+            self.reporter.file_error(self.file_name, str(e))
+
+        for handler in self.handler_list:
+            handler.pv_file_end(self)
+        self.reporter.flush()
+
+        if decompressor is not None and self.timing:
+            # the data is decompressed while lexing
+            self.phase_times['lex'] -= decompressor.seconds
+            self.phase_times['decompress'] += decompressor.seconds
+            if self.verbose:
+                print('{0}: {1}, {2} -> {3} bytes, decompressed in {4:.3f} s, lexed in {5:.3f} s'.format(
+                    self.file_name, decompressor.compression, decompressor.compressed_bytes(), decompressor.bytes,
+                    decompressor.seconds, self.phase_times['lex'] - lex_seconds))
 
         self.f_in.close()
         self.f_in = None
         self.file_name = ''
 
+        if self.timing:
+            self.phase_times['total'] += timer() - start
         return True
 
     # --------------------------------------------------------
@@ -458,10 +678,16 @@ class PvParser:
         if self.pv_group_head():
             if self.get_token().match(TOKEN_LEFT_BRACE):
                 self.flush_token()
+                self.brace_level += 1
+                for handler in self.handler_list:
+                    handler.pv_group_start(self)
                 self.pv_group_body()
-                self.pv_group_tail()
                 if self.get_token().match(TOKEN_RIGHT_BRACE):
                     self.flush_token()
+                    self.brace_level -= 1
+                    for handler in self.handler_list:
+                        handler.pv_group_end(self)
+                    self.pv_group_tail()
                     return True
                 else:
                     self.pv_error()
@@ -489,6 +715,8 @@ class PvParser:
     def pv_group_body(self):
         """
         The group body is a list on single statements. A group can be empty.
+        Syntax errors are recovered from within the group, so one bad statement
+        does not cause the rest of the group to be reported as errors.
         ---
         group_body
         : group_body single
@@ -499,8 +727,14 @@ class PvParser:
         :return:
         """
         self.trace('pv_group_body')
-        while self.pv_single():
-            pass
+        level = self.brace_level
+        while True:
+            try:
+                if not self.pv_single():
+                    break
+            except self.PvSyntaxError as e:
+                self.reporter.error(*e.details)
+                self.pv_recover(level)
         return True
 
     def pv_group_tail(self):
@@ -541,15 +775,19 @@ class PvParser:
         if self.get_token().match(TOKEN_SLEEP):
             token = self.flush_and_get_token()
             if token.match(TOKEN_INTEGER) or token.match(TOKEN_FLOAT):
+                sleep_time = float(self.scale_factor(token))
                 if self.flush_and_get_token().match(TOKEN_SEMICOLON):
                     self.flush_token()
                 else:
-                    self.pv_error('expected \';\'')
+                    self.pv_error('expected \';\'', 'expected_semicolon')
             elif token.match(TOKEN_SEMICOLON):
-                self.pv_warning('no time specified in sleep')
+                self.pv_warning('no time specified in sleep', 'sleep_without_time')
+                sleep_time = None
                 self.flush_token()
             else:
-                self.pv_error('expected integer or float value')
+                self.pv_error('expected integer or float value', 'expected_number')
+            for handler in self.handler_list:
+                handler.pv_sleep(self, sleep_time)
             return True
         return False
 
@@ -572,11 +810,17 @@ class PvParser:
             if self.pv_single_equals():
                 if self.pv_single_body():
                     if self.get_token().match(TOKEN_SEMICOLON):
+                        start = timer() if self.timing else 0.0
                         self.check_single()
+                        self.process_single()
+                        if self.print_values:
+                            self.print_single_values()
+                        if self.timing:
+                            self.phase_times['check'] += timer() - start
                         self.flush_token()
                         return True
                     else:
-                        self.pv_error('expected \';\'')
+                        self.pv_error('expected \';\'', 'expected_semicolon')
         return False
 
     # --------------------------------------------------------
@@ -611,7 +855,10 @@ class PvParser:
         :rtype: bool
         """
         self.trace('pv_single_start')
-        if self.get_token().match(TOKEN_PERCENT):
+        token = self.get_token()
+        self.single_line_number = self.lex.line_number
+        if token.match(TOKEN_PERCENT):
+            self.single_percent = True
             self.flush_token()
         return True
 
@@ -631,6 +878,7 @@ class PvParser:
         token = self.get_token()
         if token.match(TOKEN_TYPE):
             self.single_data_type = self.map_type(token)
+            self.single_type_name = token.get_value()
             self.flush_token()
         return True
 
@@ -690,7 +938,7 @@ class PvParser:
             self.flush_token()
             return True
         else:
-            self.pv_error('\'=\' expected')
+            self.pv_error('\'=\' expected', 'expected_equals')
 
     # --------------------------------------------------------
     # - Single body
@@ -713,12 +961,14 @@ class PvParser:
         self.trace('pv_single_body')
         if self.get_token().match(TOKEN_LEFT_BRACE):
             self.flush_token()
+            self.brace_level += 1
             self.pv_single_value_list()
             if self.get_token().match(TOKEN_RIGHT_BRACE):
                 self.flush_token()
+                self.brace_level -= 1
                 return True
             else:
-                self.pv_error('expected \'}\'')
+                self.pv_error('expected \'}\'', 'expected_right_brace')
         else:
             return self.pv_single_individual_value()
 
@@ -779,6 +1029,7 @@ class PvParser:
         index = self.pv_single_index_or_count()
         if index is not None:
             self.single_index_list.append(index)
+            self.single_index_position_list.append(len(self.single_value_list))
         return True
 
     def pv_single_value(self):
@@ -802,12 +1053,14 @@ class PvParser:
             self.flush_token()
             return True
         else:
-            self.pv_error('expected string, float or integer value')
+            self.pv_error('expected string, float or integer value', 'expected_value')
 
     def pv_single_scale(self):
         """
         A single statement scale can be a integer or floating point factor,
-        or any of the predefined scaling units.
+        or any of the predefined scaling units. The scale is stored as an
+        (operator, operand) tuple, so divisions are evaluated as divisions
+        (NO_SCALE if no scale is given).
         ---
         single_scale
             : TOKEN_TIMES TOKEN_INTEGER
@@ -834,24 +1087,51 @@ class PvParser:
         :raises: PvSyntaxError
         """
         self.trace('pv_single_scale')
+        scale = NO_SCALE
         if self.get_token().match(TOKEN_TIMES):
             token = self.flush_and_get_token()
-            if token in [TOKEN_INTEGER, TOKEN_FLOAT]:
+            if token.is_in([TOKEN_INTEGER, TOKEN_FLOAT]):
+                scale = ('*', self.scale_factor(token))
                 self.flush_token()
             else:
-                self.pv_error('expected integer or float value')
+                self.pv_error('expected integer or float value', 'expected_number')
         elif self.get_token().match(TOKEN_DIVIDED):
             token = self.flush_and_get_token()
-            if token in [TOKEN_INTEGER, TOKEN_FLOAT, TOKEN_UNIT]:
+            if token.is_in([TOKEN_INTEGER, TOKEN_FLOAT, TOKEN_UNIT]):
+                divisor = self.scale_factor(token)
+                if divisor == 0:
+                    self.pv_error('division by zero', 'division_by_zero')
+                scale = ('/', divisor)
                 self.flush_token()
             else:
-                self.pv_error('expected integer/float value or unit qualifier')
+                self.pv_error('expected integer/float value or unit qualifier', 'expected_scale')
         else:
             token = self.get_token()
-            if token in [TOKEN_INTEGER, TOKEN_FLOAT, TOKEN_UNIT]:
+            if token.is_in([TOKEN_INTEGER, TOKEN_FLOAT, TOKEN_UNIT]):
+                scale = ('*', self.scale_factor(token))
                 self.flush_token()
+        self.single_scale_list.append(scale)
         return True
 
+    def scale_factor(self, token):
+        """
+        Return the scale factor represented by a number or unit token.
+        :param token: integer, float or unit token
+        :type token: PvToken
+        :return: scale factor (an int for integer tokens, so it's written back as it was)
+        :rtype: float
+        :raises: PvSyntaxError if the token is not a valid number or unit
+        """
+        try:
+            if token.match(TOKEN_UNIT):
+                return unit_factor(token.get_value())
+            elif token.match(TOKEN_INTEGER):
+                return to_int(token.get_value())
+            else:
+                return float(token.get_value())
+        except (KeyError, ValueError):
+            self.pv_error('invalid number or unit', 'invalid_scale')
+
     def pv_single_index_or_count(self):
         """
         This an common routine used to parse both an index or an array count.
@@ -871,13 +1151,13 @@ class PvParser:
         if self.get_token().match(TOKEN_LEFT_BRACKET):
             token = self.flush_and_get_token()
             if token.match(TOKEN_INTEGER):
-                value = int(token.get_value())
+                value = to_int(token.get_value())
                 if self.flush_and_get_token().match(TOKEN_RIGHT_BRACKET):
                     self.flush_token()
                 else:
-                    self.pv_error('expected \']\'')
+                    self.pv_error('expected \']\'', 'expected_right_bracket')
             else:
-                self.pv_error('integer value expected')
+                self.pv_error('integer value expected', 'expected_index')
         return value
 
 
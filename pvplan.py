@@ -0,0 +1,259 @@
+"""
+Execution planner for pvload files.
+
+pvload executes a file strictly in order: every single statement outside a group is
+written and waited for before the next one. The planner turns the file into a list of
+steps that can be executed faster while keeping the file semantics:
+
+- Sleep statements, groups and the end of each file are barriers. Nothing is moved
+  across a barrier.
+- The puts of a group are already concurrent in pvload, so a group becomes one step.
+- The single statements between two barriers are independent unless they write the
+  same record. They are placed in concurrent batches, where a statement goes into the
+  batch after the last one that wrote the same record, so the order of the writes to
+  a record is kept.
+- The puts in a batch are clustered by IOC (the pv name prefix up to the first ':'
+  after expanding macros), and the clusters and puts with the largest arrays are
+  scheduled first.
+
+The plan is written as JSON. Infinite and nan values, which JSON cannot represent,
+are written as the pvload text that reads back as the same value ("1e999",
+"-1e999" and "1e999 * 0").
+"""
+import json
+
+from pvhandler import PvHandler
+from pvmacro import expand_macros
+from pvformat import TYPE_NAMES, format_non_finite
+
+PLAN_VERSION = 1
+
+# Step types
+STEP_BATCH = 'batch'
+STEP_GROUP = 'group'
+STEP_SLEEP = 'sleep'
+
+
+def ioc_prefix(name):
+    """
+    Return the part of a pv name that identifies the IOC (up to the first ':').
+    :param name: pv name (with macros expanded)
+    :type name: str
+    :rtype: str
+    """
+    return name.split(':', 1)[0] if ':' in name else name.split('.', 1)[0]
+
+
+def json_value(value):
+    """
+    Return a value that can be written as JSON: infinite and nan values are replaced
+    by their pvload text.
+    :param value: value
+    :return: value, or the text of the non-finite value
+    """
+    if isinstance(value, float):
+        text = format_non_finite(value)
+        if text is not None:
+            return text
+    return value
+
+
+def record_name(name):
+    """
+    :return: record part of a pv name
+    :rtype: str
+    """
+    return name.split('.', 1)[0]
+
+
+class PvPut:
+    """
+    A channel put, as found in a single statement
+    """
+
+    def __init__(self, name, data_type, count, index_list, value_list, file_name, line_number):
+        self.name = name
+        self.ioc = ioc_prefix(name)
+        self.data_type = data_type
+        self.count = count
+        self.index_list = index_list
+        self.value_list = value_list
+        self.file_name = file_name
+        self.line_number = line_number
+        self.elements = max(count, len(value_list))
+
+    def to_dict(self, include_values=False):
+        d = {'pv': self.name, 'ioc': self.ioc, 'type': TYPE_NAMES[self.data_type], 'count': self.count,
+             'elements': self.elements, 'file': self.file_name, 'line': self.line_number}
+        if include_values:
+            value_list = self.value_list.tolist() if hasattr(self.value_list, 'tolist') else self.value_list
+            d['values'] = [json_value(value) for value in value_list]
+            if self.index_list:
+                d['indices'] = list(self.index_list)
+        return d
+
+
+class PvStep:
+    """
+    A step of the plan: a batch of concurrent puts, a group or a sleep
+    """
+
+    def __init__(self, step_type, put_list=None, sleep_time=None):
+        self.step_type = step_type
+        self.put_list = put_list if put_list is not None else []
+        self.sleep_time = sleep_time
+
+    def clusters(self):
+        """
+        Return the puts of the step clustered by IOC
+        :return: list of (ioc, put list) tuples
+        :rtype: list
+        """
+        cluster_map = {}
+        for put in self.put_list:
+            cluster_map.setdefault(put.ioc, []).append(put)
+        ioc_list = sorted(cluster_map, key=lambda ioc: (-sum([put.elements for put in cluster_map[ioc]]), ioc))
+        return [(ioc, cluster_map[ioc]) for ioc in ioc_list]
+
+    def to_dict(self, include_values=False):
+        if self.step_type == STEP_SLEEP:
+            return {'type': self.step_type, 'time': json_value(self.sleep_time)}
+        cluster_list = []
+        for ioc, put_list in self.clusters():
+            cluster_list.append({'ioc': ioc,
+                                 'elements': sum([put.elements for put in put_list]),
+                                 'puts': [put.to_dict(include_values) for put in put_list]})
+        return {'type': self.step_type, 'puts': len(self.put_list), 'clusters': cluster_list}
+
+
+class PvPlanner(PvHandler):
+    """
+    Parser handler that builds the execution plan
+    """
+
+    def __init__(self, macro_dict=None, max_batch=0, default_sleep=1.0, concurrent=True):
+        """
+        :param macro_dict: macros used to expand the pv names
+        :type macro_dict: dict
+        :param max_batch: maximum number of puts in a batch (0 for no limit)
+        :type max_batch: int
+        :param default_sleep: time used for sleep statements with no time
+        :type default_sleep: float
+        :param concurrent: batch the single statements, otherwise keep one put per step as pvload does
+        :type concurrent: bool
+        """
+        self.macro_dict = macro_dict if macro_dict else {}
+        self.max_batch = max_batch if concurrent else 1
+        self.concurrent = concurrent
+        self.default_sleep = default_sleep
+        self.file_list = []
+        self.step_list = []
+        self.segment = []  # single statements since the last barrier
+        self.group = None  # puts of the current group
+        self.sequential_round_trips = 0  # round trips executing the files as pvload does
+
+    def pv_file_start(self, parser):
+        self.file_list.append(parser.file_name)
+
+    def pv_file_end(self, parser):
+        if self.group is not None:  # group not closed because of a syntax error
+            self.pv_group_end(parser)
+        self.flush_segment()
+
+    def pv_group_start(self, parser):
+        self.flush_segment()
+        self.group = []
+
+    def pv_group_end(self, parser):
+        self.step_list.append(PvStep(STEP_GROUP, self.group))
+        self.sequential_round_trips += 1
+        self.group = None
+
+    def pv_sleep(self, parser, sleep_time):
+        self.flush_segment()
+        self.step_list.append(PvStep(STEP_SLEEP, sleep_time=self.default_sleep if sleep_time is None else sleep_time))
+
+    def pv_single(self, parser):
+        """
+        Add the single statement to the current group or segment
+        :param parser: parser
+        :type parser: PvParser
+        :return: list of warning messages
+        :rtype: list
+        """
+        value_list = parser.evaluate_single()
+        if value_list is None:
+            return [('statement_skipped', 'statement not included in the plan (values do not match the type)')]
+        put = PvPut(expand_macros(parser.single_name, self.macro_dict), parser.single_basic_type(),
+                    parser.single_count, list(parser.single_index_list), value_list,
+                    parser.file_name, parser.single_line_number)
+        if self.group is not None:
+            self.group.append(put)
+        else:
+            self.segment.append(put)
+            self.sequential_round_trips += 1
+        return []
+
+    def flush_segment(self):
+        """
+        Turn the single statements since the last barrier into batches
+        :return: None
+        """
+        if not self.concurrent:
+            for put in self.segment:
+                self.step_list.append(PvStep(STEP_BATCH, [put]))
+            self.segment = []
+            return
+        batch_list = []
+        last_batch = {}  # record name -> batch of the last write
+        for put in self.segment:
+            key = record_name(put.name)
+            n = last_batch.get(key, -1) + 1
+            if n == len(batch_list):
+                batch_list.append([])
+            batch_list[n].append(put)
+            last_batch[key] = n
+        for put_list in batch_list:
+            put_list.sort(key=lambda p: -p.elements)
+            step = PvStep(STEP_BATCH, put_list)
+            # keep the clustered order, then split the batch if it's too large
+            ordered = []
+            for ioc, cluster in step.clusters():
+                ordered.extend(cluster)
+            if self.max_batch > 0:
+                for i in range(0, len(ordered), self.max_batch):
+                    self.step_list.append(PvStep(STEP_BATCH, ordered[i:i + self.max_batch]))
+            else:
+                self.step_list.append(PvStep(STEP_BATCH, ordered))
+        self.segment = []
+
+    def summary(self):
+        """
+        :return: plan summary
+        :rtype: dict
+        """
+        batches = len([step for step in self.step_list if step.step_type == STEP_BATCH])
+        groups = len([step for step in self.step_list if step.step_type == STEP_GROUP])
+        return {'puts': sum([len(step.put_list) for step in self.step_list]),
+                'steps': len(self.step_list),
+                'batches': batches,
+                'groups': groups,
+                'sleeps': len([step for step in self.step_list if step.step_type == STEP_SLEEP]),
+                'sequential_round_trips': self.sequential_round_trips,
+                'planned_round_trips': batches + groups}
+
+    def write(self, f_out, include_values=False):
+        """
+        Write the plan as JSON
+        :param f_out: output file
+        :type f_out: file
+        :param include_values: include the values of each put
+        :type include_values: bool
+        :return: None
+        """
+        plan = {'version': PLAN_VERSION,
+                'files': self.file_list,
+                'summary': self.summary(),
+                'steps': [step.to_dict(include_values) for step in self.step_list]}
+        json.dump(plan, f_out, indent=1, sort_keys=True, separators=(',', ': '), allow_nan=False)
+        f_out.write('\n')
@@ -0,0 +1,330 @@
+"""
+Replay of pvload files against a channel access stand-in, used to measure restore
+throughput without touching a live IOC. Requires Python 3.7 or later (asyncio).
+
+The files are turned into steps by PvPlanner, either with the strict pvload order
+(one put per step) or with the concurrent batches of the plan. The steps are executed
+in order: the puts of a step are issued concurrently, with at most a given number of
+puts in flight, and the next step starts when all of them are done. Sleep statements
+are honoured (optionally scaled down).
+
+Two backends are provided:
+- PvFakeBackend: in-process fake server, the put completes after a configurable delay.
+- PvLoopbackBackend: client of a PvLoopbackServer running on the loopback interface,
+  so the socket and serialization costs are included. Requests are JSON lines.
+
+Other backends (e.g. a real channel access client) only need to implement PvBackend.
+"""
+import json
+import time
+import random
+import asyncio
+
+from pvplan import STEP_SLEEP
+from pvparser import TYPE_STRING
+from pvestimate import ELEMENT_SIZE
+
+
+def _value_list(put):
+    """
+    :return: values of a put as a list (the planner can give numpy arrays)
+    :rtype: list
+    """
+    return put.value_list.tolist() if hasattr(put.value_list, 'tolist') else list(put.value_list)
+
+
+class PvBackend:
+    """
+    Base class for the replay backends
+    """
+
+    async def start(self):
+        pass
+
+    async def put(self, put):
+        """
+        Write a value and wait for the put to complete
+        :param put: put
+        :type put: PvPut
+        """
+        raise NotImplementedError
+
+    async def stop(self):
+        pass
+
+
+class PvFakeServer:
+    """
+    Fake pv server. It keeps the last value written to every pv and simulates
+    the time taken by each put.
+    """
+
+    def __init__(self, latency=0.001, jitter=0.0, bandwidth=0.0, seed=None):
+        """
+        :param latency: fixed delay of every put in seconds
+        :type latency: float
+        :param jitter: maximum random delay added to every put in seconds
+        :type jitter: float
+        :param bandwidth: bandwidth in bytes per second used to delay large puts (0 for none)
+        :type bandwidth: float
+        :param seed: random generator seed
+        :type seed: int
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.bandwidth = bandwidth
+        self.random = random.Random(seed)
+        self.value_map = {}
+        self.puts = 0
+
+    def delay(self, data_type, elements):
+        """
+        :return: time taken by a put
+        :rtype: float
+        """
+        delay = self.latency + (self.random.uniform(0.0, self.jitter) if self.jitter > 0 else 0.0)
+        if self.bandwidth > 0:
+            delay += elements * ELEMENT_SIZE.get(data_type, ELEMENT_SIZE[TYPE_STRING]) / float(self.bandwidth)
+        return delay
+
+    def store(self, name, index_list, value_list):
+        """
+        Keep the value written to a pv. Indexed values update only those elements.
+        """
+        if index_list:
+            old_value_list = self.value_map.get(name, [])
+            if len(old_value_list) <= max(index_list):
+                old_value_list = old_value_list + [None] * (max(index_list) + 1 - len(old_value_list))
+            for index, value in zip(index_list, value_list):
+                old_value_list[index] = value
+            self.value_map[name] = old_value_list
+        else:
+            self.value_map[name] = value_list
+        self.puts += 1
+
+    async def put(self, name, data_type, index_list, value_list):
+        await asyncio.sleep(self.delay(data_type, len(value_list)))
+        self.store(name, index_list, value_list)
+
+
+class PvFakeBackend(PvBackend):
+    """
+    Backend that writes to an in-process fake server
+    """
+
+    def __init__(self, server):
+        """
+        :param server: fake server
+        :type server: PvFakeServer
+        """
+        self.server = server
+
+    async def put(self, put):
+        await self.server.put(put.name, put.data_type, put.index_list, _value_list(put))
+
+
+class PvLoopbackServer:
+    """
+    Fake server listening on the loopback interface. Each request is a JSON line with
+    the request id, pv name, type, indices and values. Requests are served concurrently
+    and the reply is a JSON line with the request id.
+    """
+
+    def __init__(self, fake_server, host='127.0.0.1', port=0):
+        """
+        :param fake_server: server that keeps the values and simulates the delays
+        :type fake_server: PvFakeServer
+        :param host: address to listen on
+        :type host: str
+        :param port: port (0 to use any free port)
+        :type port: int
+        """
+        self.fake_server = fake_server
+        self.host = host
+        self.port = port
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._serve, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def _serve(self, reader, writer):
+        task_set = set()
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            task = asyncio.ensure_future(self._request(json.loads(line.decode('utf-8')), writer))
+            task_set.add(task)
+            task.add_done_callback(task_set.discard)
+        if task_set:
+            await asyncio.gather(*task_set)
+        writer.close()
+
+    async def _request(self, request, writer):
+        await self.fake_server.put(request['pv'], request['type'], request.get('indices'), request['values'])
+        writer.write((json.dumps({'id': request['id']}) + '\n').encode('utf-8'))
+
+
+class PvLoopbackBackend(PvBackend):
+    """
+    Backend that writes to a PvLoopbackServer through one TCP connection
+    """
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.reader = None
+        self.writer = None
+        self.reader_task = None
+        self.pending = {}  # request id -> future
+        self.next_id = 0
+
+    async def start(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        self.reader_task = asyncio.ensure_future(self._read_replies())
+
+    async def stop(self):
+        self.writer.close()
+        await self.reader_task
+
+    async def _read_replies(self):
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                break
+            future = self.pending.pop(json.loads(line.decode('utf-8'))['id'], None)
+            if future is not None and not future.done():
+                future.set_result(None)
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError('connection to the fake server closed'))
+
+    async def put(self, put):
+        request_id = self.next_id
+        self.next_id += 1
+        future = asyncio.get_event_loop().create_future()
+        self.pending[request_id] = future
+        request = {'id': request_id, 'pv': put.name, 'type': put.data_type, 'values': _value_list(put)}
+        if put.index_list:
+            request['indices'] = list(put.index_list)
+        self.writer.write((json.dumps(request) + '\n').encode('utf-8'))
+        await future
+
+
+def percentile(sorted_list, fraction):
+    """
+    Nearest rank percentile of a sorted list
+    :param sorted_list: sorted values
+    :type sorted_list: list
+    :param fraction: percentile as a fraction (e.g. 0.99)
+    :type fraction: float
+    :rtype: float
+    """
+    if not sorted_list:
+        return 0.0
+    rank = int(round(fraction * len(sorted_list) + 0.5)) - 1
+    return sorted_list[min(max(rank, 0), len(sorted_list) - 1)]
+
+
+class PvReplay:
+    """
+    Executes the steps of a plan against a backend and measures the performance
+    """
+
+    def __init__(self, backend, concurrency=16, sleep_scale=1.0):
+        """
+        :param backend: backend
+        :type backend: PvBackend
+        :param concurrency: maximum number of puts in flight
+        :type concurrency: int
+        :param sleep_scale: factor applied to the sleep times (0 to skip them)
+        :type sleep_scale: float
+        """
+        self.backend = backend
+        self.concurrency = concurrency
+        self.sleep_scale = sleep_scale
+        self.latency_list = []
+        self.sleep_time = 0.0
+        self.wall_time = 0.0
+        self.semaphore = None
+
+    async def _put(self, put):
+        async with self.semaphore:
+            start = time.perf_counter()
+            await self.backend.put(put)
+            self.latency_list.append(time.perf_counter() - start)
+
+    async def run(self, step_list):
+        """
+        Execute the steps in order
+        :param step_list: list of steps
+        :type step_list: list
+        """
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        start = time.perf_counter()
+        await self.backend.start()
+        try:
+            for step in step_list:
+                if step.step_type == STEP_SLEEP:
+                    sleep_time = step.sleep_time * self.sleep_scale
+                    self.sleep_time += sleep_time
+                    await asyncio.sleep(sleep_time)
+                elif len(step.put_list) == 1:
+                    await self._put(step.put_list[0])
+                else:
+                    await asyncio.gather(*[self._put(put) for put in step.put_list])
+        finally:
+            await self.backend.stop()
+        self.wall_time = time.perf_counter() - start
+
+    def report(self, f_out):
+        """
+        Write the replay statistics
+        :param f_out: output file
+        :type f_out: file
+        """
+        latency_list = sorted(self.latency_list)
+        puts = len(latency_list)
+        f_out.write('puts:           {0}\n'.format(puts))
+        f_out.write('wall time:      {0:.3f} s ({1:.3f} s sleeping)\n'.format(self.wall_time, self.sleep_time))
+        f_out.write('puts/s:         {0:.1f}\n'.format(puts / self.wall_time if self.wall_time > 0 else 0.0))
+        f_out.write('latency (ms):   p50 {0:.3f}  p90 {1:.3f}  p99 {2:.3f}  max {3:.3f}\n'.format(
+            1e3 * percentile(latency_list, 0.50), 1e3 * percentile(latency_list, 0.90),
+            1e3 * percentile(latency_list, 0.99), 1e3 * (latency_list[-1] if latency_list else 0.0)))
+
+
+async def replay(step_list, fake_server, loopback=False, concurrency=16, sleep_scale=1.0):
+    """
+    Replay a list of steps against a fake server
+    :param step_list: list of steps
+    :type step_list: list
+    :param fake_server: fake server
+    :type fake_server: PvFakeServer
+    :param loopback: go through a loopback TCP connection
+    :type loopback: bool
+    :param concurrency: maximum number of puts in flight
+    :type concurrency: int
+    :param sleep_scale: factor applied to the sleep times
+    :type sleep_scale: float
+    :return: replay object, with the statistics
+    :rtype: PvReplay
+    """
+    if loopback:
+        server = PvLoopbackServer(fake_server)
+        await server.start()
+        backend = PvLoopbackBackend(server.host, server.port)
+    else:
+        server = None
+        backend = PvFakeBackend(fake_server)
+    pv_replay = PvReplay(backend, concurrency, sleep_scale)
+    try:
+        await pv_replay.run(step_list)
+    finally:
+        if server is not None:
+            await server.stop()
+    return pv_replay
@@ -0,0 +1,233 @@
+"""
+Writers for the errors and warnings found by the parser.
+
+Three formats are supported:
+- text: the messages printed by pvcheck, meant to be read by people
+- jsonl: one JSON object per message (JSON Lines), e.g.
+  {"file": "a.pv", "line": 3, "message": "expected ';'", "severity": "error", "source": "...", "token": "x"}
+- sarif: a SARIF 2.1.0 log with one result per message
+
+Messages are written as they are reported, so memory use does not depend on the
+number of messages. They are collected in a buffer that is written to the output
+file when it's full and at the end of every input file, instead of once per message.
+"""
+import json
+
+# Message severities
+SEVERITY_ERROR = 'error'
+SEVERITY_WARNING = 'warning'
+
+# Number of characters kept in the buffer before writing to the output file
+BUFFER_SIZE = 64 * 1024
+
+SARIF_VERSION = '2.1.0'
+SARIF_SCHEMA = 'https://json.schemastore.org/sarif-2.1.0.json'
+
+
+class PvReportWriter:
+    """
+    Base class of the message writers
+    """
+
+    def __init__(self, f_out, buffer_size=BUFFER_SIZE):
+        """
+        :param f_out: output file
+        :type f_out: file
+        :param buffer_size: number of characters buffered before writing
+        :type buffer_size: int
+        """
+        self.f_out = f_out
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.size = 0
+
+    def _write(self, text):
+        self.buffer.append(text)
+        self.size += len(text)
+        if self.size >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the buffered messages to the output file
+        :return: None
+        """
+        if self.buffer:
+            self.f_out.write(''.join(self.buffer))
+            self.buffer = []
+            self.size = 0
+
+    def close(self):
+        """
+        Finish the output (the output file is not closed)
+        :return: None
+        """
+        self.flush()
+
+    def error(self, file_name, line_number, text, line_text, token_value):
+        """
+        Report a syntax error
+        :param file_name: file name
+        :type file_name: str
+        :param line_number: line number
+        :type line_number: int
+        :param text: error message (empty for a generic syntax error)
+        :type text: str
+        :param line_text: text of the line
+        :type line_text: str
+        :param token_value: token where the error was found
+        :type token_value: str
+        :return: None
+        """
+        self.report(SEVERITY_ERROR, file_name, line_number, text if text else 'syntax error', line_text, token_value)
+
+    def warning(self, file_name, line_number, text, line_text):
+        """
+        Report a warning
+        :param file_name: file name
+        :type file_name: str
+        :param line_number: line number
+        :type line_number: int
+        :param text: warning message
+        :type text: str
+        :param line_text: text of the line
+        :type line_text: str
+        :return: None
+        """
+        self.report(SEVERITY_WARNING, file_name, line_number, text if text else 'warning', line_text, None)
+
+    def file_error(self, file_name, text):
+        """
+        Report an error about a whole file (e.g. it cannot be decompressed),
+        not found at any line
+        :param file_name: file name
+        :type file_name: str
+        :param text: error message
+        :type text: str
+        :return: None
+        """
+        self.report(SEVERITY_ERROR, file_name, 0, text, '', None)
+
+    def report(self, severity, file_name, line_number, text, line_text, token_value):
+        raise NotImplementedError
+
+
+class PvTextWriter(PvReportWriter):
+    """
+    Messages in the pvcheck text format
+    """
+
+    def error(self, file_name, line_number, text, line_text, token_value):
+        if text:
+            format_string = 'Error: at \'{0}\', file {1}, line {2} -> {3}\n>> {4}\n'
+            self._write(format_string.format(token_value, file_name, line_number, text, line_text))
+        else:
+            format_string = 'Error: at \'{0}\', file {1}, line {2}\n>> {3}\n'
+            self._write(format_string.format(token_value, file_name, line_number, line_text))
+
+    def file_error(self, file_name, text):
+        self._write('Error: file {0} -> {1}\n'.format(file_name, text))
+
+    def warning(self, file_name, line_number, text, line_text):
+        if text:
+            format_string = 'Warning: file {0}, line {1} -> {2}\n>> {3}\n'
+            self._write(format_string.format(file_name, line_number, text, line_text))
+        else:
+            format_string = 'Warning: {0}, line {1}\n>> {2}\n'
+            self._write(format_string.format(file_name, line_number, line_text))
+
+
+class PvJsonLinesWriter(PvReportWriter):
+    """
+    Messages as JSON Lines
+    """
+
+    def report(self, severity, file_name, line_number, text, line_text, token_value):
+        record = {'severity': severity, 'file': file_name, 'line': line_number, 'message': text,
+                  'source': line_text}
+        if token_value is not None:
+            record['token'] = token_value
+        self._write(json.dumps(record, sort_keys=True) + '\n')
+
+
+class PvSarifWriter(PvReportWriter):
+    """
+    Messages as a SARIF log. The results are written one at a time inside the
+    results array, which is closed by close().
+    """
+
+    def __init__(self, f_out, buffer_size=BUFFER_SIZE):
+        PvReportWriter.__init__(self, f_out, buffer_size)
+        self.results = 0
+        self._write('{"$schema": ' + json.dumps(SARIF_SCHEMA) + ', "version": ' + json.dumps(SARIF_VERSION) +
+                    ', "runs": [{"tool": {"driver": {"name": "pvcheck"}}, "results": [\n')
+
+    def report(self, severity, file_name, line_number, text, line_text, token_value):
+        location = {'artifactLocation': {'uri': file_name}}
+        if line_number > 0:
+            location['region'] = {'startLine': line_number, 'snippet': {'text': line_text}}
+        result = {'level': severity, 'message': {'text': text}, 'locations': [{'physicalLocation': location}]}
+        self._write((',\n' if self.results else '') + json.dumps(result, sort_keys=True))
+        self.results += 1
+
+    def close(self):
+        self._write('\n]}]}\n')
+        self.flush()
+
+
+class PvMessageRecorder(PvReportWriter):
+    """
+    Keeps the messages, and any other text written to it, so they can be written
+    later by another writer (e.g. messages found by a worker process).
+    It can also stand in for the standard output.
+    """
+
+    def __init__(self):
+        PvReportWriter.__init__(self, None)
+        self.event_list = []  # ('error', 'file_error' or 'warning', message arguments) or ('text', text)
+
+    def write(self, text):
+        self.event_list.append(('text', text))
+
+    def flush(self):
+        pass
+
+    def error(self, file_name, line_number, text, line_text, token_value):
+        self.event_list.append((SEVERITY_ERROR, (file_name, line_number, text, line_text, token_value)))
+
+    def file_error(self, file_name, text):
+        self.event_list.append(('file_error', (file_name, text)))
+
+    def warning(self, file_name, line_number, text, line_text):
+        self.event_list.append((SEVERITY_WARNING, (file_name, line_number, text, line_text)))
+
+    @staticmethod
+    def replay(event_list, writer, f_text):
+        """
+        Write recorded messages and text
+        :param event_list: events, as kept in event_list
+        :type event_list: list
+        :param writer: writer for the messages
+        :type writer: PvReportWriter
+        :param f_text: file for the other text (e.g. standard output)
+        :type f_text: file
+        :return: None
+        """
+        for kind, item in event_list:
+            if kind == SEVERITY_ERROR:
+                writer.error(*item)
+            elif kind == 'file_error':
+                writer.file_error(*item)
+            elif kind == SEVERITY_WARNING:
+                writer.warning(*item)
+            else:
+                writer.flush()
+                f_text.write(item)
+
+
+# Writer class for each output format
+WRITERS = {
+    'text': PvTextWriter,
+    'jsonl': PvJsonLinesWriter,
+    'sarif': PvSarifWriter,
+}
@@ -0,0 +1,255 @@
+"""
+Evaluation of the values in pvload single statements. The scale factors and units
+that follow each value are applied the same way pvload does, and the values are
+converted to the basic data type of the statement.
+
+Angles are converted to degrees and lengths to millimetres. The scale of a value
+is kept by the parser as an (operator, operand) tuple, e.g. '* 2' is ('*', 2),
+'/ 1e3' is ('/', 1000.0), 'arcsec' is ('*', 1/3600.0) and '/ um' is ('/', 0.001).
+Divisions are kept as such, so 'x / n' gives the same result as in pvload instead
+of 'x * (1 / n)', which can differ in the last digit (or by one once truncated to
+an integer, e.g. 49 / 49).
+
+NumPy is used to convert whole arrays at once when it's available.
+"""
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Conversion factors from the pvload units to the internal units (degrees and millimetres)
+UNIT_FACTORS = {
+    'arcsec': 1.0 / 3600.0,
+    'deg': 1.0,
+    'microns': 1.0e-3,
+    'um': 1.0e-3,
+    'millimeters': 1.0,
+    'millimetres': 1.0,
+    'mm': 1.0,
+    'meters': 1.0e3,
+    'metres': 1.0e3,
+    'm': 1.0e3,
+}
+
+# Scale of the values written with no scale factor or unit
+NO_SCALE = ('*', 1.0)
+
+# Arrays smaller than this are not worth converting with numpy
+NUMPY_THRESHOLD = 64
+
+
+def unit_factor(unit):
+    """
+    Return the factor used to convert a value in a given unit to internal units.
+    :param unit: unit name, as returned by the lexer
+    :type unit: str
+    :return: conversion factor
+    :rtype: float
+    :raises: KeyError if the unit is not known
+    """
+    return UNIT_FACTORS[unit]
+
+
+def to_int(value):
+    """
+    Convert the text of an integer constant (decimal or hexadecimal) into an integer.
+    Real constants are truncated the same way a C cast would.
+    :param value: integer or real constant
+    :type value: str
+    :return: integer value
+    :rtype: int
+    :raises: ValueError, also for real constants out of the float range (e.g. 1e999)
+    """
+    if value.lstrip('-+')[:2] in ['0x', '0X']:
+        return int(value, 16)
+    try:
+        return int(value)
+    except ValueError:
+        try:
+            return int(float(value))
+        except OverflowError:
+            raise ValueError('integer value out of range: ' + value)
+
+
+def to_string(value):
+    """
+    Remove the quotes around a string constant. Other constants are returned unchanged.
+    :param value: constant
+    :type value: str
+    :return: string value
+    :rtype: str
+    """
+    if len(value) > 1 and value.startswith('"') and value.endswith('"'):
+        return value[1:-1]
+    return value
+
+
+def is_number(value):
+    """
+    Check whether a constant is a number (integer or real, including the ones out
+    of the float range, which read as infinity)
+    :param value: constant
+    :type value: str
+    :rtype: bool
+    """
+    try:
+        float(value)
+        return True
+    except ValueError:
+        pass
+    try:
+        to_int(value)
+        return True
+    except ValueError:
+        return False
+
+
+def expand_indices(index_list, value_count, position_list=None):
+    """
+    Return the index of every value of a statement where only some values have an index.
+    A value with no index goes to the element after the previous value (the first element
+    if it's the first value), as pvload does, e.g. { [0] 1, 2, 3 } sets elements 0, 1 and 2.
+    :param index_list: indices given in the statement
+    :type index_list: list
+    :param value_count: number of values
+    :type value_count: int
+    :param position_list: position in the value list of the value of each index
+                          (None if the indices belong to the first values)
+    :type position_list: list
+    :return: one index per value, or an empty list if no value has an index
+    :rtype: list
+    """
+    if not index_list or len(index_list) >= value_count:
+        return list(index_list)
+    if position_list is None:
+        position_list = range(len(index_list))
+    position_map = dict(zip(position_list, index_list))
+    full_index_list = []
+    index = -1
+    for position in range(value_count):
+        index = position_map.get(position, index + 1)
+        full_index_list.append(index)
+    return full_index_list
+
+
+def _use_numpy(value_list, use_numpy):
+    """
+    Decide whether an array is worth converting with numpy
+    :rtype: bool
+    """
+    return use_numpy and numpy is not None and len(value_list) >= NUMPY_THRESHOLD
+
+
+def _no_scale(scale_list):
+    """
+    Check whether a list of scales has no effect on the values
+    :rtype: bool
+    """
+    return scale_list is None or scale_list.count(NO_SCALE) == len(scale_list)
+
+
+def apply_scale(value, scale):
+    """
+    Apply a scale to a value
+    :param value: value
+    :type value: float
+    :param scale: (operator, operand) tuple, the operator is '*' or '/'
+    :type scale: tuple
+    :return: scaled value
+    :rtype: float
+    """
+    operator, operand = scale
+    if operator == '/':
+        return value / float(operand)
+    return value * float(operand)
+
+
+def _scale_arrays(scale_list):
+    """
+    :return: numpy arrays with the factor and the divisor of each value (1.0 if not used)
+    :rtype: tuple
+    """
+    factors = numpy.array([float(operand) if operator == '*' else 1.0 for operator, operand in scale_list],
+                          dtype=numpy.float64)
+    divisors = numpy.array([float(operand) if operator == '/' else 1.0 for operator, operand in scale_list],
+                           dtype=numpy.float64)
+    return factors, divisors
+
+
+def evaluate_integers(value_list, scale_list=None, use_numpy=True):
+    """
+    Apply the scale factors to a list of integer constants.
+    Scaled values are truncated towards zero, as pvload does when writing to integer channels.
+    :param value_list: list of value constants, as returned by the lexer
+    :type value_list: list
+    :param scale_list: list of scales, one per value (None if no value is scaled)
+    :type scale_list: list
+    :param use_numpy: use numpy for large arrays if available
+    :type use_numpy: bool
+    :return: list (or numpy array) of integers
+    :rtype: list
+    :raises: ValueError if any of the values is not a number
+    """
+    if _no_scale(scale_list):
+        scale_list = None
+    if _use_numpy(value_list, use_numpy):
+        try:
+            values = numpy.array(value_list, dtype=numpy.int64)
+        except (ValueError, TypeError, OverflowError):
+            values = None  # hexadecimal or real constants, use the slow path
+        if values is not None:
+            if scale_list is not None:
+                factors, divisors = _scale_arrays(scale_list)
+                values = numpy.trunc(values * factors / divisors).astype(numpy.int64)
+            return values
+    if scale_list is None:
+        return [to_int(value) for value in value_list]
+    else:
+        return [int(apply_scale(to_int(value), scale)) for value, scale in zip(value_list, scale_list)]
+
+
+def evaluate_floats(value_list, scale_list=None, use_numpy=True):
+    """
+    Apply the scale factors to a list of real (or integer) constants.
+    :param value_list: list of value constants, as returned by the lexer
+    :type value_list: list
+    :param scale_list: list of scales, one per value (None if no value is scaled)
+    :type scale_list: list
+    :param use_numpy: use numpy for large arrays if available
+    :type use_numpy: bool
+    :return: list (or numpy array) of floats
+    :rtype: list
+    :raises: ValueError if any of the values is not a number
+    """
+    if _no_scale(scale_list):
+        scale_list = None
+    if _use_numpy(value_list, use_numpy):
+        try:
+            values = numpy.array(value_list, dtype=numpy.float64)
+        except (ValueError, TypeError):
+            values = None  # hexadecimal constants, use the slow path
+        if values is not None:
+            if scale_list is not None:
+                factors, divisors = _scale_arrays(scale_list)
+                values = values * factors / divisors
+            return values
+    values = []
+    for value in value_list:
+        try:
+            values.append(float(value))
+        except ValueError:
+            values.append(float(to_int(value)))
+    if scale_list is not None:
+        values = [apply_scale(value, scale) for value, scale in zip(values, scale_list)]
+    return values
+
+
+def evaluate_strings(value_list):
+    """
+    Convert a list of constants to strings. Strings are never scaled.
+    :param value_list: list of value constants, as returned by the lexer
+    :type value_list: list
+    :return: list of strings
+    :rtype: list
+    """
+    return [to_string(value) for value in value_list]
@@ -0,0 +1,276 @@
+"""
+Checking of many pvload files with a pool of worker processes.
+
+Jobs are started longest first, so a large file does not end up being parsed alone
+at the end of the run while the other workers are idle. The cost of a file is the
+time it took to parse in previous runs, kept in a cache file together with the file
+size, or estimated from its size when the file was never parsed.
+
+Large files can be split into sections that are parsed independently. Sections end
+at a statement boundary: the end of a line outside any braces whose last character,
+not counting strings and comments, is a semicolon.
+
+Workers record the messages and the output of each job, and the main process writes
+them in the order of the files and sections, so the output is the same as in a run
+without workers.
+"""
+import os
+import re
+import sys
+import json
+import tempfile
+import multiprocessing
+
+from pvparser import PvParser, timer
+from pvlexer import STRING_PATTERN
+from pvreport import PvMessageRecorder
+from pvcompress import file_compression
+
+# Version of the cache file format. Caches with a different version are ignored.
+CACHE_VERSION = 2
+
+# Parse speed (bytes per second) assumed for the files never parsed when there are
+# no times for the other files either. Only the ratio between costs matters.
+DEFAULT_SPEED = 1000000.0
+
+_string_re = re.compile(STRING_PATTERN.encode('ascii'))
+
+
+def split_file(file_name, section_size):
+    """
+    Split a file into sections at statement boundaries
+    :param file_name: file name
+    :type file_name: str
+    :param section_size: minimum section size in bytes
+    :type section_size: int
+    :return: list of (byte offset, first line number, number of lines) tuples
+    :rtype: list
+    :raises: IOError, OSError if the file cannot be read
+    """
+    section_list = []
+    start = offset = 0
+    first_line_number = line_number = 1
+    depth = 0
+    with open(file_name, 'rb') as f:
+        for line_number, line in enumerate(f, 1):
+            offset += len(line)
+            code = line
+            if b'"' in code:
+                code = _string_re.sub(b'', code)
+            if b'#' in code:
+                code = code[:code.find(b'#')]
+            if b'{' in code or b'}' in code:
+                depth = max(depth + code.count(b'{') - code.count(b'}'), 0)
+            if offset - start >= section_size and depth == 0 and code.rstrip().endswith(b';'):
+                section_list.append((start, first_line_number, line_number - first_line_number + 1))
+                start = offset
+                first_line_number = line_number + 1
+    if offset > start or not section_list:
+        section_list.append((start, first_line_number, line_number - first_line_number + 1))
+    return section_list
+
+
+def read_times(cache_file_name):
+    """
+    Read the parse times of the previous runs. A missing, unreadable or old cache is treated as empty.
+    :param cache_file_name: cache file name
+    :type cache_file_name: str
+    :return: dictionary file name -> (size, seconds)
+    :rtype: dict
+    """
+    if not cache_file_name:
+        return {}
+    try:
+        with open(cache_file_name, 'r') as f:
+            data = json.load(f)
+        if data['version'] != CACHE_VERSION:
+            return {}
+        return dict([(file_name, (int(size), float(seconds))) for file_name, (size, seconds) in data['times'].items()])
+    except (IOError, OSError, ValueError, TypeError, KeyError, AttributeError):
+        return {}
+
+
+def write_times(cache_file_name, time_map):
+    """
+    Write the parse times. They are written to a temporary file which is then renamed,
+    so an interrupted run does not leave a partial cache. Failing to write the cache
+    is not an error.
+    :param cache_file_name: cache file name
+    :type cache_file_name: str
+    :param time_map: dictionary file name -> (size, seconds)
+    :type time_map: dict
+    :return: None
+    """
+    temp_file_name = None
+    try:
+        fd, temp_file_name = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(cache_file_name)))
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'version': CACHE_VERSION, 'times': time_map}, f)
+        os.rename(temp_file_name, cache_file_name)
+    except (IOError, OSError):
+        if temp_file_name is not None and os.path.exists(temp_file_name):
+            os.remove(temp_file_name)
+
+
+def plan_jobs(file_list, time_map, section_size=0):
+    """
+    Build the job list, longest job first
+    :param file_list: list of file names
+    :type file_list: list
+    :param time_map: parse times of the previous runs, as returned by read_times()
+    :type time_map: dict
+    :param section_size: split the files larger than this into sections of about this size (0 for no split)
+    :type section_size: int
+    :return: list of (file number, section number, file name, section) tuples, where
+             section is None for a whole file (see PvParser.pv_file)
+    :rtype: list
+    """
+    total_size = sum([size for size, seconds in time_map.values()])
+    total_seconds = sum([seconds for size, seconds in time_map.values()])
+    speed = total_size / total_seconds if total_size and total_seconds else DEFAULT_SPEED
+
+    cost_list = []
+    for file_number, file_name in enumerate(file_list):
+        try:
+            size = os.path.getsize(file_name)
+        except OSError:
+            size = 0  # the parser reports it as missing
+        old_size, seconds = time_map.get(os.path.abspath(file_name), (0, 0.0))
+        cost = seconds * size / old_size if old_size else size / speed
+        # compressed files cannot be split, the sections are byte ranges of the file
+        if section_size and size > section_size and file_compression(file_name) is None:
+            try:
+                section_list = split_file(file_name, section_size)
+            except (IOError, OSError):
+                section_list = [None]
+        else:
+            section_list = [None]
+        for section_number, section in enumerate(section_list):
+            if section is None:
+                section_cost = cost
+            else:
+                end = section_list[section_number + 1][0] if section_number + 1 < len(section_list) else size
+                section_cost = cost * (end - section[0]) / size
+            cost_list.append((-section_cost, file_number, section_number, file_name, section))
+    cost_list.sort(key=lambda item: item[:3])
+    return [item[1:] for item in cost_list]
+
+
+# Parser of a worker process, created by _init_worker()
+_worker_parser = None
+
+
+def _init_worker(debug, verbose, print_values, handler_list, token_cache_size):
+    global _worker_parser
+    _worker_parser = PvParser(debug, verbose, print_values, reporter=PvMessageRecorder())
+    _worker_parser.lex.set_cache_size(token_cache_size)
+    for handler in handler_list:
+        _worker_parser.add_handler(handler)
+
+
+def record_file(pv_parser, file_name, section=None):
+    """
+    Parse a file, recording the messages and the standard output instead of writing them
+    :param pv_parser: parser
+    :type pv_parser: PvParser
+    :param file_name: file name
+    :type file_name: str
+    :param section: part of the file to parse (see PvParser.pv_file)
+    :type section: tuple
+    :return: parse time in seconds and recorded events (see PvMessageRecorder)
+    :rtype: tuple
+    """
+    recorder = PvMessageRecorder()
+    reporter = pv_parser.reporter
+    pv_parser.reporter = recorder
+    stdout = sys.stdout
+    sys.stdout = recorder
+    try:
+        start = timer()
+        pv_parser.pv_file(file_name, section)
+        seconds = timer() - start
+    finally:
+        sys.stdout = stdout
+        pv_parser.reporter = reporter
+    return seconds, recorder.event_list
+
+
+def _run_job(job):
+    """
+    Parse a file or a section in a worker process
+    :param job: job, as returned by plan_jobs()
+    :type job: tuple
+    :return: file number, section number, parse time and recorded events
+    :rtype: tuple
+    """
+    file_number, section_number, file_name, section = job
+    verbose = _worker_parser.verbose
+    # the file name is only printed once
+    _worker_parser.verbose = verbose and section_number == 0
+    try:
+        seconds, event_list = record_file(_worker_parser, file_name, section)
+    finally:
+        _worker_parser.verbose = verbose
+    return file_number, section_number, seconds, event_list
+
+
+def check_files(file_list, jobs, reporter, handler_list=None, debug=False, verbose=False, print_values=False,
+                section_size=0, cache_file_name=None, token_cache_size=0):
+    """
+    Check a list of files with a pool of worker processes
+    :param file_list: list of file names
+    :type file_list: list
+    :param jobs: number of worker processes
+    :type jobs: int
+    :param reporter: writer for the error and warning messages
+    :type reporter: PvReportWriter
+    :param handler_list: parser handlers, copied to every worker
+    :type handler_list: list
+    :param debug: parser debug output
+    :type debug: bool
+    :param verbose: print the file names
+    :type verbose: bool
+    :param print_values: print the values of each pv
+    :type print_values: bool
+    :param section_size: split the files larger than this into sections of about this size (0 for no split)
+    :type section_size: int
+    :param cache_file_name: parse time cache file name (None for no cache)
+    :type cache_file_name: str
+    :param token_cache_size: token cache size of every worker in bytes (see PvLexer.set_cache_size)
+    :type token_cache_size: int
+    :return: None
+    """
+    time_map = read_times(cache_file_name)
+    job_list = plan_jobs(file_list, time_map, section_size)
+    section_counts = [0] * len(file_list)
+    for file_number, section_number, file_name, section in job_list:
+        section_counts[file_number] += 1
+
+    # results are written in file and section order, as soon as they are available
+    result_map = {}
+    file_seconds = [0.0] * len(file_list)
+    next_job = (0, 0)
+    sys.stdout.flush()
+    pool = multiprocessing.Pool(jobs, _init_worker, (debug, verbose, print_values, handler_list or [],
+                                                    token_cache_size))
+    try:
+        for file_number, section_number, seconds, event_list in pool.imap_unordered(_run_job, job_list):
+            result_map[(file_number, section_number)] = event_list
+            file_seconds[file_number] += seconds
+            while next_job in result_map:
+                PvMessageRecorder.replay(result_map.pop(next_job), reporter, sys.stdout)
+                if next_job[1] + 1 < section_counts[next_job[0]]:
+                    next_job = (next_job[0], next_job[1] + 1)
+                else:
+                    reporter.flush()
+                    next_job = (next_job[0] + 1, 0)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+    if cache_file_name:
+        for file_number, file_name in enumerate(file_list):
+            if os.path.isfile(file_name):
+                time_map[os.path.abspath(file_name)] = (os.path.getsize(file_name), file_seconds[file_number])
+        write_times(cache_file_name, time_map)
@@ -0,0 +1,230 @@
+"""
+Checking of a list of files split over several machines (shards), with no shared
+service: every shard writes a result file and the results are merged afterwards.
+
+The files are given to the shards largest first, each one to the shard with the
+least bytes so far, so the shards get about the same number of bytes. The split only
+depends on the file list and the file sizes, so every shard computes the same split
+without talking to the others, as long as they are given the same files.
+
+A result file is JSON:
+
+    {"version": 1, "shard": 2, "shards": 4, "input": "<sha1 of the file list and sizes>",
+     "files": [{"position": 3, "name": "a.pv", "events": [...], "entries": [...]}, ...]}
+
+where position is the place of the file in the input list, events are the messages
+and output of the file (see PvMessageRecorder) and entries are the index entries of
+the file, used to find the pvs set by more than one file when the results are merged:
+[name, line, count, type code, event position, warning line]. The last two tell where
+a warning about the statement goes: the number of events recorded before it, and the
+line reported by the parser (the last line of the statement).
+"""
+import os
+import sys
+import json
+import hashlib
+import linecache
+
+from pvlexer import PvLexer
+from pvindex import PvIndexCollector, duplicate_message
+from pvreport import PvMessageRecorder, SEVERITY_WARNING
+from pvschedule import record_file
+
+# Version of the result file format
+RESULT_VERSION = 1
+
+
+class PvShardCollector(PvIndexCollector):
+    """
+    Parser handler that collects the index entries of a file and where a warning about
+    each statement would be reported. It must be the last handler, and the parser
+    reporter a PvMessageRecorder.
+    """
+
+    def pv_single(self, parser):
+        PvIndexCollector.pv_single(self, parser)
+        self.entry_list[-1] += (len(parser.reporter.event_list), parser.lex.line_number)
+        return []
+
+
+def _source_line(file_name, line_number):
+    """
+    Text of a line, as shown in the messages, or an empty string if the file is not available
+    """
+    text = linecache.getline(file_name, line_number).strip()
+    if len(text) > PvLexer.max_line_length:
+        text = text[:PvLexer.max_line_length] + ' ...'
+    return text
+
+
+def parse_shard(text):
+    """
+    Parse a shard specification
+    :param text: shard number and number of shards (e.g. '2/4'), the first shard is 1
+    :type text: str
+    :return: shard number and number of shards
+    :rtype: tuple
+    :raises: ValueError if the specification is not valid
+    """
+    shard, slash, shards = text.partition('/')
+    try:
+        shard, shards = int(shard), int(shards)
+    except ValueError:
+        raise ValueError('expected a shard as I/N (e.g. 2/4), got ' + text)
+    if shards < 1 or shard < 1 or shard > shards:
+        raise ValueError('the shard must be between 1 and the number of shards, got ' + text)
+    return shard, shards
+
+
+def input_digest(file_list):
+    """
+    Digest of a file list and the file sizes, used to check that all the shards
+    were given the same files
+    :param file_list: list of file names
+    :type file_list: list
+    :rtype: str
+    """
+    sha = hashlib.sha1()
+    for file_name in file_list:
+        size = os.path.getsize(file_name) if os.path.isfile(file_name) else -1
+        sha.update((file_name + '\0' + str(size) + '\n').encode('utf-8'))
+    return sha.hexdigest()
+
+
+def shard_files(file_list, shard, shards):
+    """
+    Select the files of a shard
+    :param file_list: list of file names
+    :type file_list: list
+    :param shard: shard number (the first shard is 1)
+    :type shard: int
+    :param shards: number of shards
+    :type shards: int
+    :return: positions of the files of the shard in the list, in increasing order
+    :rtype: list
+    """
+    size_list = [os.path.getsize(file_name) if os.path.isfile(file_name) else 0 for file_name in file_list]
+    load_list = [0] * shards
+    position_list = []
+    for position in sorted(range(len(file_list)), key=lambda i: (-size_list[i], file_list[i], i)):
+        target = min(range(shards), key=lambda i: (load_list[i], i))
+        load_list[target] += size_list[position]
+        if target == shard - 1:
+            position_list.append(position)
+    return sorted(position_list)
+
+
+def check_shard(pv_parser, file_list, shard, shards, reporter, result_file_name):
+    """
+    Check the files of a shard, writing the messages as usual and saving them, with
+    the index entries of the files, to a result file
+    :param pv_parser: parser
+    :type pv_parser: PvParser
+    :param file_list: list of file names (all the shards)
+    :type file_list: list
+    :param shard: shard number (the first shard is 1)
+    :type shard: int
+    :param shards: number of shards
+    :type shards: int
+    :param reporter: writer for the error and warning messages
+    :type reporter: PvReportWriter
+    :param result_file_name: result file name
+    :type result_file_name: str
+    :return: None
+    :raises: IOError, OSError if the result file cannot be written
+    """
+    collector = PvShardCollector()
+    pv_parser.add_handler(collector)
+    result_list = []
+    for position in shard_files(file_list, shard, shards):
+        collector.entry_list = []  # not cleared by the parser if the file does not exist
+        seconds, event_list = record_file(pv_parser, file_list[position])
+        PvMessageRecorder.replay(event_list, reporter, sys.stdout)
+        reporter.flush()
+        result_list.append({'position': position, 'name': file_list[position], 'events': event_list,
+                            'entries': collector.entry_list})
+    pv_parser.handler_list.remove(collector)
+
+    result = {'version': RESULT_VERSION, 'shard': shard, 'shards': shards, 'input': input_digest(file_list),
+              'files': result_list}
+    temp_file_name = result_file_name + '.tmp'
+    with open(temp_file_name, 'w') as f_out:
+        json.dump(result, f_out, sort_keys=True)
+        f_out.write('\n')
+    os.rename(temp_file_name, result_file_name)
+
+
+def read_results(result_file_list):
+    """
+    Read the result files of all the shards
+    :param result_file_list: result file names, one per shard, in any order
+    :type result_file_list: list
+    :return: results of the files, in the order of the input list
+    :rtype: list
+    :raises: IOError, OSError if a file cannot be read, ValueError if the results
+             are not valid, are missing or do not belong to the same run
+    """
+    result_map = {}
+    shards = digest = None
+    for result_file_name in result_file_list:
+        with open(result_file_name, 'r') as f:
+            try:
+                result = json.load(f)
+            except ValueError:
+                raise ValueError(result_file_name + ' is not a result file')
+        if not isinstance(result, dict) or result.get('version') != RESULT_VERSION:
+            raise ValueError(result_file_name + ' is not a result file, or was written by another version')
+        if shards is None:
+            shards, digest = result['shards'], result['input']
+        elif result['shards'] != shards or result['input'] != digest:
+            raise ValueError(result_file_name + ' is not from the same run as ' + result_file_list[0])
+        if result['shard'] in result_map:
+            raise ValueError(result_file_name + ': shard ' + str(result['shard']) + ' given twice')
+        result_map[result['shard']] = result
+    missing = [str(shard) for shard in range(1, (shards or 0) + 1) if shard not in result_map]
+    if missing:
+        raise ValueError('missing shards ' + ', '.join(missing) + ' of ' + str(shards))
+
+    file_result_list = []
+    for result in result_map.values():
+        file_result_list.extend(result['files'])
+    file_result_list.sort(key=lambda file_result: file_result['position'])
+    return file_result_list
+
+
+def merge_results(file_result_list, reporter, duplicates=False):
+    """
+    Write the messages of the shards in the order of the input list, as a check of
+    all the files in one run would. The pvs set by more than one file are reported
+    where --duplicates would report them.
+    :param file_result_list: results, as returned by read_results()
+    :type file_result_list: list
+    :param reporter: writer for the error and warning messages
+    :type reporter: PvReportWriter
+    :param duplicates: warn about the pvs set by more than one file
+    :type duplicates: bool
+    :return: number of duplicate warnings
+    :rtype: int
+    """
+    seen_map = {}  # pv name -> (file name, line number) of the first statement
+    warnings = 0
+    for file_result in file_result_list:
+        file_name = file_result['name']
+        event_list = file_result['events']
+        if duplicates:
+            merged_list = []
+            start = 0
+            for name, line_number, count, type_code, event_position, warning_line in file_result['entries']:
+                if name not in seen_map:
+                    seen_map[name] = (file_name, line_number)
+                elif seen_map[name][0] != file_name:
+                    merged_list.extend(event_list[start:event_position])
+                    start = event_position
+                    merged_list.append((SEVERITY_WARNING, (file_name, warning_line,
+                                                           duplicate_message(name, *seen_map[name]),
+                                                           _source_line(file_name, warning_line))))
+                    warnings += 1
+            event_list = merged_list + event_list[start:]
+        PvMessageRecorder.replay(event_list, reporter, sys.stdout)
+        reporter.flush()
+    return warnings
@@ -0,0 +1,324 @@
+"""
+Compact binary snapshots of parsed pvload files.
+
+A snapshot keeps, for every single statement, the pv name, the basic data type,
+the array count, the indices and the values after applying scales and units.
+Groups and sleep statements are not kept. Loading a snapshot costs one read
+(or a memory map) instead of lexing and parsing the text file again.
+
+The file is organized in columns. All the strings (pv names and string values)
+are stored once in a string table, and the numeric data in packed arrays:
+
+    magic           8 bytes 'PVSNAP02'
+    header          8 little endian uint32: number of statements, strings, string
+                    table bytes, integer values, float values, string values,
+                    indices, reserved
+    string offsets  uint32 x (strings + 1)
+    string table    utf-8 bytes
+    statements      one column per field: name (uint32), type (uint8, basic data type
+                    plus UNTYPED for statements with no type), count (uint32),
+                    value offset (uint32), value length (uint32), index offset (uint32),
+                    index length (uint32)
+    values          int64 (integer values), float64 (float values),
+                    uint32 (string table id of string values)
+    indices         int32
+
+Every section starts at a multiple of 8 bytes. Numeric data is little endian.
+Value offsets are relative to the value column of the statement type.
+
+Version 01 files, written before statements with no type were kept, have the same
+layout and can still be read.
+"""
+import sys
+import mmap
+import struct
+from array import array
+
+from pvhandler import PvHandler
+from pvparser import TYPE_NONE, TYPE_INTEGER, TYPE_FLOAT, TYPE_STRING
+from pvscale import expand_indices
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+MAGIC = b'PVSNAP02'
+MAGIC_LIST = [b'PVSNAP01', MAGIC]  # versions that can be read
+HEADER_FORMAT = '<8I'
+ALIGNMENT = 8
+
+
+def _int64_typecode():
+    """
+    Return the array type code of 64 bit integers ('l' is 32 bits on some platforms)
+    :rtype: str
+    """
+    for typecode in ['q', 'l']:
+        try:
+            if array(typecode).itemsize == 8:
+                return typecode
+        except ValueError:
+            pass
+    raise ValueError('no 64 bit integer array type')
+
+
+INT64 = _int64_typecode()
+
+# Array type codes and numpy types of the columns, in file order after the string table
+COLUMNS = [
+    ('name', 'I', '<u4'),
+    ('type', 'B', 'u1'),
+    ('count', 'I', '<u4'),
+    ('value_offset', 'I', '<u4'),
+    ('value_length', 'I', '<u4'),
+    ('index_offset', 'I', '<u4'),
+    ('index_length', 'I', '<u4'),
+    ('int_values', INT64, '<i8'),
+    ('float_values', 'd', '<f8'),
+    ('string_values', 'I', '<u4'),
+    ('indices', 'i', '<i4'),
+]
+
+# Value column used by each basic type
+VALUE_COLUMNS = {TYPE_INTEGER: 'int_values', TYPE_FLOAT: 'float_values', TYPE_STRING: 'string_values'}
+
+# Flag added to the type of the statements with no type
+UNTYPED = 0x80
+
+
+def _to_bytes(text):
+    return text if isinstance(text, bytes) else text.encode('utf-8')
+
+
+def _from_bytes(data):
+    return data if str is bytes else data.decode('utf-8')
+
+
+def _array_bytes(a):
+    """
+    Return the contents of an array as little endian bytes
+    """
+    if sys.byteorder != 'little':
+        a = array(a.typecode, a)
+        a.byteswap()
+    return a.tobytes() if hasattr(a, 'tobytes') else a.tostring()
+
+
+def _padding(size):
+    return b'\0' * (-size % ALIGNMENT)
+
+
+class PvSnapshotWriter(PvHandler):
+    """
+    Parser handler that collects the single statements of one or more files
+    and writes them as a snapshot.
+    """
+
+    def __init__(self):
+        self.string_map = {}  # string -> string table id
+        self.string_list = []
+        self.columns = dict([(name, array(typecode)) for name, typecode, dtype in COLUMNS])
+
+    def __len__(self):
+        return len(self.columns['name'])
+
+    def _string_id(self, text):
+        """
+        Return the id of a string in the string table, adding it if needed.
+        :rtype: int
+        """
+        string_id = self.string_map.get(text)
+        if string_id is None:
+            string_id = len(self.string_list)
+            self.string_map[text] = string_id
+            self.string_list.append(text)
+        return string_id
+
+    def add(self, name, data_type, count, index_list, value_list, typed=True):
+        """
+        Add a single statement to the snapshot.
+        :param name: pv name
+        :type name: str
+        :param data_type: basic data type (TYPE_INTEGER, TYPE_FLOAT or TYPE_STRING)
+        :type data_type: int
+        :param count: array size
+        :type count: int
+        :param index_list: list of indices, one per value (empty if not used)
+        :type index_list: list
+        :param value_list: values (already scaled and converted to the data type)
+        :type value_list: list
+        :param typed: false if the statement has no type
+        :type typed: bool
+        :return: None
+        """
+        columns = self.columns
+        value_column = columns[VALUE_COLUMNS[data_type]]
+        columns['name'].append(self._string_id(name))
+        columns['type'].append(data_type if typed else data_type | UNTYPED)
+        columns['count'].append(count)
+        columns['value_offset'].append(len(value_column))
+        columns['value_length'].append(len(value_list))
+        columns['index_offset'].append(len(columns['indices']))
+        columns['index_length'].append(len(index_list))
+        if data_type == TYPE_STRING:
+            value_column.extend([self._string_id(value) for value in value_list])
+        elif data_type == TYPE_INTEGER:
+            value_column.extend([int(value) for value in value_list])
+        else:
+            value_column.extend([float(value) for value in value_list])
+        columns['indices'].extend(index_list)
+
+    def pv_single(self, parser):
+        """
+        Add the single statement found by the parser
+        :param parser: parser
+        :type parser: PvParser
+        :return: list of warning messages
+        :rtype: list
+        """
+        value_list = parser.evaluate_single()
+        if value_list is None:
+            return [('statement_skipped', 'statement not included in the snapshot (values do not match the type)')]
+        index_list = expand_indices(parser.single_index_list, len(value_list), parser.single_index_position_list)
+        self.add(parser.single_name, parser.single_basic_type(), parser.single_count,
+                 index_list, value_list, parser.single_data_type != TYPE_NONE)
+        return []
+
+    def write(self, file_name):
+        """
+        Write the snapshot file
+        :param file_name: output file name
+        :type file_name: str
+        :return: None
+        :raises: IOError
+        """
+        string_data = [_to_bytes(text) for text in self.string_list]
+        offsets = array('I', [0])
+        for data in string_data:
+            offsets.append(offsets[-1] + len(data))
+        columns = self.columns
+        header = struct.pack(HEADER_FORMAT, len(columns['name']), len(self.string_list), offsets[-1],
+                             len(columns['int_values']), len(columns['float_values']),
+                             len(columns['string_values']), len(columns['indices']), 0)
+        with open(file_name, 'wb') as f:
+            f.write(MAGIC + header)
+            data = _array_bytes(offsets)
+            f.write(data + _padding(len(data)))
+            f.write(b''.join(string_data) + _padding(offsets[-1]))
+            for name, typecode, dtype in COLUMNS:
+                data = _array_bytes(columns[name])
+                f.write(data + _padding(len(data)))
+
+
+class PvSnapshot:
+    """
+    Snapshot reader. The file is memory mapped and the columns are only decoded
+    when they are first used. With numpy the columns are views of the mapped file.
+    """
+
+    def __init__(self, file_name):
+        """
+        :param file_name: snapshot file name
+        :type file_name: str
+        :raises: IOError, ValueError if the file is not a snapshot
+        """
+        self.file_name = file_name
+        with open(file_name, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        header_size = len(MAGIC) + struct.calcsize(HEADER_FORMAT)
+        if self.data[:len(MAGIC)] not in MAGIC_LIST:
+            raise ValueError(file_name + ' is not a snapshot file')
+        (self.n_statements, self.n_strings, string_bytes, n_int_values, n_float_values, n_string_values,
+         n_indices, reserved) = struct.unpack_from(HEADER_FORMAT, self.data, len(MAGIC))
+
+        # Work out where every section starts
+        lengths = {'name': self.n_statements, 'type': self.n_statements, 'count': self.n_statements,
+                   'value_offset': self.n_statements, 'value_length': self.n_statements,
+                   'index_offset': self.n_statements, 'index_length': self.n_statements,
+                   'int_values': n_int_values, 'float_values': n_float_values,
+                   'string_values': n_string_values, 'indices': n_indices}
+        self.sections = {}
+        pos = header_size
+        self.sections['string_offsets'] = (pos, 'I', '<u4', self.n_strings + 1)
+        pos += 4 * (self.n_strings + 1)
+        pos += -pos % ALIGNMENT
+        self.string_pos = pos
+        pos += string_bytes
+        pos += -pos % ALIGNMENT
+        for name, typecode, dtype in COLUMNS:
+            self.sections[name] = (pos, typecode, dtype, lengths[name])
+            pos += array(typecode).itemsize * lengths[name]
+            pos += -pos % ALIGNMENT
+        if pos > len(self.data):
+            raise ValueError(file_name + ' is truncated')
+        self.columns = {}
+
+    def __len__(self):
+        return self.n_statements
+
+    def __iter__(self):
+        for i in range(self.n_statements):
+            yield self[i]
+
+    def close(self):
+        self.columns = {}
+        self.data.close()
+
+    def column(self, name):
+        """
+        Return a column of the snapshot
+        :param name: column name (see COLUMNS)
+        :type name: str
+        :return: column values
+        :rtype: array
+        """
+        if name not in self.columns:
+            pos, typecode, dtype, length = self.sections[name]
+            if numpy is not None:
+                values = numpy.frombuffer(self.data, dtype=dtype, count=length, offset=pos)
+            else:
+                values = array(typecode)
+                raw = self.data[pos:pos + values.itemsize * length]
+                if hasattr(values, 'frombytes'):
+                    values.frombytes(raw)
+                else:
+                    values.fromstring(raw)
+                if sys.byteorder != 'little':
+                    values.byteswap()
+            self.columns[name] = values
+        return self.columns[name]
+
+    def string(self, string_id):
+        """
+        Return a string from the string table
+        :param string_id: string id
+        :type string_id: int
+        :rtype: str
+        """
+        offsets = self.column('string_offsets')
+        start = self.string_pos + int(offsets[string_id])
+        end = self.string_pos + int(offsets[string_id + 1])
+        return _from_bytes(self.data[start:end])
+
+    def __getitem__(self, i):
+        """
+        Return a statement
+        :param i: statement number
+        :type i: int
+        :return: pv name, basic data type (TYPE_NONE for a statement with no type),
+                 count, index list and value list
+        :rtype: tuple
+        """
+        if i < 0 or i >= self.n_statements:
+            raise IndexError('statement number out of range')
+        type_code = int(self.column('type')[i])
+        data_type = type_code & ~UNTYPED
+        offset = int(self.column('value_offset')[i])
+        values = self.column(VALUE_COLUMNS[data_type])[offset:offset + int(self.column('value_length')[i])]
+        if data_type == TYPE_STRING:
+            values = [self.string(int(string_id)) for string_id in values]
+        offset = int(self.column('index_offset')[i])
+        indices = self.column('indices')[offset:offset + int(self.column('index_length')[i])]
+        return (self.string(int(self.column('name')[i])), TYPE_NONE if type_code & UNTYPED else data_type,
+                int(self.column('count')[i]), [int(index) for index in indices], values)
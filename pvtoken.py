@@ -71,7 +71,7 @@ if __name__ == '__main__':
     t1 = PvToken(1, "23")
     t2 = PvToken(2, "abc")
     t3 = PvToken(1, "hello")
-    print t1 == t2
-    print t1 == t3
-    print t2.match(2)
-    print t2.match(4)
+    print(t1 == t2)
+    print(t1 == t3)
+    print(t2.match(2))
+    print(t2.match(4))